@@ -0,0 +1,76 @@
+'''
+Wall time and accuracy of the CLASS precision presets in tools.py.
+
+    python benchmark_precision.py
+    python benchmark_precision.py --presets draft sampling --lmax 30 --tau
+
+runs a few reio_many_tanh models (and CLASS's tanh with tau_reio, with --tau)
+with every preset, without the caches, and prints the time per model and the
+largest fractional EE and TE error at 2 <= ell <= lmax against the 'reference'
+preset. TE goes through zero, so its error is relative to sqrt(TT*EE), like
+in tools.spectra_residual.
+'''
+import time
+import argparse
+import numpy as np
+
+import spectra_cache
+from tools import (PRECISION_PRESETS, compute_model, spectra_residual,
+        PLANCK_2018_TAU)
+
+# (zreio, x_e) of the many_tanh models
+MODELS = [(6.5, 0.), (7.5, 0.05), (9., 0.1)]
+
+
+def benchmark(presets=None, models=MODELS, lmax=100, tau=False,
+        reference='reference'):
+    '''
+    Returns {preset: (seconds per model, max EE error, max TE error)}.
+    '''
+    if presets is None:
+        presets = [p for p in PRECISION_PRESETS if p != reference]
+    runs = [dict(model='many_tanh', zreio=z, x_e=x) for z, x in models]
+    if tau:
+        runs.append(dict(model='tau_reio', tau=PLANCK_2018_TAU))
+    enabled = spectra_cache.ENABLED
+    spectra_cache.ENABLED = False
+    try:
+        results = {}
+        for preset in [reference] + list(presets):
+            compute_model.cache_clear()
+            t0 = time.time()
+            results[preset] = [compute_model(lmax=lmax, precision=preset, **run)
+                    for run in runs]
+            dt = (time.time() - t0)/len(runs)
+            print('{0}: {1:.1f} s per model'.format(preset, dt))
+            results[preset] = (dt, results[preset])
+    finally:
+        spectra_cache.ENABLED = enabled
+        compute_model.cache_clear()
+
+    report = {}
+    for preset in presets:
+        dt, res = results[preset]
+        err = [spectra_residual(a, b, lmax=lmax) for a, b in
+                zip(res, results[reference][1])]
+        report[preset] = (dt, max(e['EE'] for e in err),
+                max(e['TE'] for e in err))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the CLASS precision '
+            'presets and compare them to the reference one.')
+    parser.add_argument('--presets', nargs='+', default=None,
+            choices=list(PRECISION_PRESETS))
+    parser.add_argument('--lmax', type=int, default=100)
+    parser.add_argument('--tau', action='store_true',
+            help='also run a tau_reio model')
+    args = parser.parse_args()
+
+    report = benchmark(args.presets, lmax=args.lmax, tau=args.tau)
+    print('{0:>10s} {1:>10s} {2:>10s} {3:>10s}'.format('preset', 's/model',
+        'EE error', 'TE error'))
+    for preset, (dt, ee, te) in report.items():
+        print('{0:>10s} {1:10.2f} {2:10.1e} {3:10.1e}'.format(preset, dt, ee,
+            te))
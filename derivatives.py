@@ -0,0 +1,220 @@
+'''
+Derivatives of the power spectra, and of tau, tau_lo and tau_hi, with respect
+to model parameters, for the Fisher forecasts.
+
+    J = jacobian('many_tanh', {'zreio': 7, 'x_e': 0.05}, ['zreio', 'x_e'])
+    J['dEE']        # (2, lmax+1), dC_ell^EE/dzreio and dC_ell^EE/dx_e
+    J['dtau_lo']    # (2,)
+
+Each derivative is a second-order central difference (forward, next to a
+lower bound like x_e = 0) at a ladder of steps h, h/2, h/4, ... The estimates
+of consecutive steps are combined by Richardson extrapolation, and for every
+multipole the one with the smallest estimated error, truncation plus CLASS's
+numerical noise amplified by 1/h, is kept. All the CLASS runs of all the
+parameters go to tools.get_spectra_many as one batch, so they are spread over
+a process pool and each reuses the spectra cache.
+
+tau_lo and tau_hi are split at the fiducial model's zsplit at every point of
+the stencils. With the split moving along with each model, their derivatives
+would be of a different quantity, and jump with h, since zsplit comes from
+the thermodynamics grid.
+
+The result is kept on disk with the spectra cache, keyed by the model, the
+fiducial parameters, the steps and the CLASS precision, so that a repeated
+forecast doesn't run CLASS at all.
+'''
+import inspect
+import numpy as np
+
+import spectra_cache
+import tools
+
+# Largest step of each parameter
+STEPS = {'zreio': 0.1, 'x_e': 0.01, 'dz': 0.05, 'z_t': 0.5, 'tau': 0.002,
+        'A_s': 5e-11, 'n_s': 0.01, 'r': 0.01}
+# Parameters whose stencils can't go below a value. x_e is floored at 2e-4 by
+# the many_tanh model.
+LOWER = {'x_e': 2e-4, 'dz': 0., 'tau': 0., 'A_s': 0., 'r': 0.}
+# Relative numerical noise of CLASS spectra, for the roundoff part of the
+# error estimates
+NOISE = 1e-6
+# Scalars of get_spectra_many that are differentiated along with the spectra
+DERIVED = ['tau', 'tau_lo', 'tau_hi']
+
+_jacobians = {}
+
+
+def stencil(x0, h, lower=None):
+    '''
+    Offsets and weights of a second-order finite difference with step h at
+    x0: central, or forward if x0 - h would be below lower.
+    '''
+    if (lower is not None) and (x0 - h < lower):
+        return np.array([0., h, 2*h]), np.array([-1.5, 2., -0.5])/h
+    return np.array([-h, h]), np.array([-0.5, 0.5])/h
+
+
+def richardson(D, h, scale, noise=NOISE):
+    '''
+    Combines the second-order derivative estimates D, shape (n_steps, ...),
+    at the steps h, each half the one before, into Richardson extrapolations
+    and keeps the one with the smallest error estimate element by element.
+    scale is the size of the function, for the noise part of the error.
+    Returns the derivative and its error estimate.
+    '''
+    D = np.asarray(D, dtype=float)
+    if len(D) < 2:
+        raise ValueError('Richardson extrapolation needs at least two steps')
+    h = np.asarray(h, dtype=float).reshape((-1,) + (1,)*(D.ndim - 1))
+    R = np.concatenate([D[:1], (4*D[1:] - D[:-1])/3])
+    err = abs(R[1:] - R[:-1]) + noise*abs(scale)/h[1:]
+    best = np.argmin(err, axis=0)[None]
+    return (np.take_along_axis(R[1:], best, axis=0)[0],
+            np.take_along_axis(err, best, axis=0)[0])
+
+
+def _fiducial(model, fiducial):
+    # The model's defaults filled in, so that equivalent fiducials share a key
+    full = {}
+    for name, p in inspect.signature(tools.MODELS[model]).parameters.items():
+        if p.default is not inspect.Parameter.empty:
+            full[name] = p.default
+    full.update(fiducial)
+    return full
+
+
+def jacobian(model='many_tanh', fiducial=None, params=None, steps=None,
+        n_steps=3, noise=NOISE, lmax=100, rescale=True, r=0,
+        outputs=('TT', 'EE', 'TE'), precision=None, workers=None,
+        verbose=False):
+    '''
+    Derivatives of the spectra in outputs and of DERIVED with respect to
+    params (by default all the keys of fiducial), at the fiducial parameters
+    of model. fiducial can also set r, A_s and n_s (A_s needs rescale=False).
+    steps overrides the largest step of some parameters, STEPS by default,
+    and n_steps >= 2 halvings of it are tried.
+
+    Returns a dict with ell, params, the fiducial spectra and scalars (e.g.
+    'EE', 'tau_lo'), their derivatives ('dEE', shape (n_par, lmax+1), and
+    'dtau_lo', shape (n_par,)), error estimates ('err_EE', 'err_tau_lo'),
+    the second-order estimates of the scalars' derivatives at each step
+    ('steps_tau_lo', shape (n_par, n_steps)) and the fiducial zsplit.
+    '''
+    fiducial = {} if fiducial is None else fiducial
+    params = list(fiducial) if params is None else list(params)
+    fiducial = _fiducial(model, fiducial)
+    steps = dict(STEPS, **({} if steps is None else steps))
+    for p in params:
+        if p not in fiducial:
+            raise ValueError('{0} is not a parameter of the fiducial '
+                    'model {1}'.format(p, fiducial))
+        if p not in steps:
+            raise ValueError('No step size for {0}, pass it in steps'.format(
+                p))
+    precision = tools.PRECISION if precision is None else precision
+    outputs = tools._outputs(outputs)
+    key = spectra_cache.params_key(dict(model=model, fiducial=fiducial,
+        params=params, steps=[steps[p] for p in params], n_steps=n_steps,
+        noise=noise, lmax=lmax, rescale=rescale, r=r, outputs=outputs,
+        precision=tools.PRECISION_PRESETS[precision]), jacobian=True,
+        zsplit='fiducial')
+    if key in _jacobians:
+        return _jacobians[key]
+    cached = spectra_cache.load(key)
+    if cached is not None:
+        J = dict(cached['cls'], params=params)
+        _jacobians[key] = J
+        return J
+
+    # Every point of every stencil, after the fiducial model
+    points = [fiducial]
+    stencils = []
+    for p in params:
+        hs = steps[p]/2.**np.arange(n_steps)
+        stencils.append([])
+        for h in hs:
+            offsets, weights = stencil(fiducial[p], h, LOWER.get(p))
+            index = []
+            for dx in offsets:
+                if dx == 0:
+                    index.append(0)
+                else:
+                    index.append(len(points))
+                    points.append(dict(fiducial, **{p: fiducial[p] + dx}))
+            stencils[-1].append((h, index, weights))
+    if verbose:
+        print('{0} CLASS models for the derivatives with respect to '
+                '{1}'.format(len(points), ', '.join(params)))
+    res = tools.get_spectra_many(points, workers=workers, model=model,
+            lmax=lmax, rescale=rescale, r=r, outputs=outputs,
+            precision=precision, verbose=verbose)
+
+    # tau_lo and tau_hi of every model split at the fiducial zsplit
+    zsplit = res['zsplit'][0]
+    twotau = np.array([tools.get_twotau(thermo, zsplit=zsplit)[1:] for thermo
+        in res['thermo']])
+    res = dict(res, tau_lo=twotau[:,0], tau_hi=twotau[:,1])
+
+    J = {'ell': res['ell'], 'params': params, 'zsplit': zsplit}
+    for name in list(outputs) + DERIVED:
+        values = res[name]
+        if name == 'TE' and (res['TT'] is not None) and (res['EE'] is not None):
+            # TE goes through zero
+            scale = np.sqrt(res['TT'][0]*res['EE'][0])
+        else:
+            scale = values[0]
+        J[name] = values[0]
+        J['d' + name] = np.zeros((len(params),) + np.shape(values[0]))
+        J['err_' + name] = np.zeros_like(J['d' + name])
+        for i, st in enumerate(stencils):
+            D = [np.tensordot(w, values[index], axes=(0, 0)) for h, index, w
+                    in st]
+            J['d' + name][i], J['err_' + name][i] = richardson(D,
+                    [h for h, index, w in st], scale, noise=noise)
+            if name in DERIVED:
+                J.setdefault('steps_' + name, np.zeros((len(params),
+                    n_steps)))[i] = D
+
+    spectra_cache.save(key, dict(model=model, fiducial=fiducial,
+        params=params, lmax=lmax, precision=precision),
+        {k: v for k, v in J.items() if k != 'params'}, None, 0.)
+    _jacobians[key] = J
+    return J
+
+
+def test_richardson(noise=1e-6, seed=0):
+    '''
+    Derivative of sin with noise added to every evaluation, which should be
+    accurate to about the noise divided by the step that gets chosen.
+    '''
+    rng = np.random.RandomState(seed)
+    x0 = np.linspace(0.1, 3, 50)
+    f = lambda x: np.sin(x)*(1 + noise*rng.randn(*np.shape(x)))
+    hs = 0.5/2.**np.arange(5)
+    D = []
+    for h in hs:
+        offsets, weights = stencil(0, h)
+        D.append(sum(w*f(x0 + dx) for dx, w in zip(offsets, weights)))
+    d, err = richardson(D, hs, np.sin(x0), noise=noise)
+    print('largest error {0:.1e}, largest estimate {1:.1e}'.format(
+        np.max(abs(d - np.cos(x0))), np.max(err)))
+    return
+
+
+def test_derived_convergence(fiducial={'zreio': 7, 'x_e': 0.05}, lmax=100,
+        rtol=0.05):
+    '''
+    Checks that the derivatives of tau, tau_lo and tau_hi converge in h: the
+    second-order estimates at the different steps have to agree with the
+    extrapolated derivative to rtol.
+    '''
+    J = jacobian('many_tanh', fiducial, lmax=lmax)
+    for name in DERIVED:
+        d, steps = J['d' + name], J['steps_' + name]
+        for i, p in enumerate(J['params']):
+            spread = np.max(abs(steps[i] - d[i]))/abs(d[i])
+            print('d{0}/d{1} = {2:.4e}, steps {3}, spread {4:.1e}'.format(name,
+                p, d[i], ' '.join('{0:.4e}'.format(x) for x in steps[i]),
+                spread))
+            assert spread < rtol, 'd{0}/d{1} does not converge'.format(name, p)
+    return
@@ -0,0 +1,302 @@
+'''
+Emulator for the CLASS spectra of the reio_many_tanh histories in
+tools.get_spectra, so that MCMC steps don't have to run CLASS.
+
+Spectra are compressed with PCA: log(TT), log(EE), log(BB) and the TE
+correlation coefficient TE/sqrt(TT*EE) are standardized for 2 <= ell <= lmax,
+and the principal component coefficients are interpolated over (zre, x_e, dz,
+z_t) with radial basis functions. Parameters whose bounds have lo == hi are
+held fixed and are not interpolated over.
+
+Training is active: starting from a quasi-random design, it repeatedly fits a
+committee of emulators that each leave out part of the training set, and runs
+CLASS where they disagree most, until the estimated error is small enough.
+
+    emu = SpectraEmulator({'zre': (4, 12), 'x_e': (0, 0.5)})
+    emu.train(tol=0.05)
+    emu.validate()
+    emu.save('emulator.npz')
+
+    emu = SpectraEmulator.load('emulator.npz')
+    lnprob_EE_ell(7, 0.1, Clhat, backend=emu)
+'''
+import time
+import numpy as np
+from scipy.interpolate import RBFInterpolator
+from scipy.stats import qmc
+
+from tools import get_spectra
+
+PARAMS = ['zre', 'x_e', 'dz', 'z_t']
+DEFAULTS = {'zre': 7., 'x_e': 0., 'dz': 0.5, 'z_t': 28.}
+SPECTRA = ['TT', 'EE', 'TE', 'BB']
+
+
+def to_features(TT, EE, TE, BB):
+    '''
+    Maps spectra for 2 <= ell <= lmax to the quantities that are emulated.
+    BB is the lensing B-mode, so it is positive as long as r = 0.
+    '''
+    rho = TE/np.sqrt(TT*EE)
+    return np.concatenate((np.log(TT), np.log(EE), rho, np.log(BB)), axis=-1)
+
+
+def from_features(y, nl):
+    lnTT, lnEE, rho, lnBB = [y[..., i*nl:(i+1)*nl] for i in range(4)]
+    TT, EE = np.exp(lnTT), np.exp(lnEE)
+    return TT, EE, rho*np.sqrt(TT*EE), np.exp(lnBB)
+
+
+def cosmic_variance_error(approx, exact):
+    '''
+    Maximum difference between two sets of (TT, EE, TE, BB), for ell >= 2,
+    in units of the cosmic variance of each spectrum. Works on single spectra
+    or on (n, nl) stacks, in which case there is one error per row.
+    '''
+    TT, EE, TE, BB = exact
+    ell = np.arange(2, TT.shape[-1]+2)
+    sigma = {'TT': np.sqrt(2/(2*ell+1))*TT,
+             'EE': np.sqrt(2/(2*ell+1))*EE,
+             'TE': np.sqrt((TT*EE + TE**2)/(2*ell+1)),
+             'BB': np.sqrt(2/(2*ell+1))*BB}
+    return {s: np.max(np.abs(a - e)/sigma[s], axis=-1)
+            for s, a, e in zip(SPECTRA, approx, exact)}
+
+
+class SpectraEmulator(object):
+    '''
+    bounds is a dict with a (lo, hi) range for any of 'zre', 'x_e', 'dz' and
+    'z_t'; anything not given is fixed at its get_spectra default.
+    '''
+    def __init__(self, bounds, lmax=100, ncomp=None, var_tol=1e-8,
+            kernel='thin_plate_spline'):
+        self.bounds = {p: tuple(map(float, bounds.get(p, (DEFAULTS[p],)*2)))
+                for p in PARAMS}
+        self.free = [p for p in PARAMS if self.bounds[p][0] < self.bounds[p][1]]
+        self.lmax = lmax
+        self.ncomp = ncomp
+        self.var_tol = var_tol
+        self.kernel = kernel
+        self.X = np.zeros((0, len(PARAMS)))
+        self.Y = np.zeros((0, 4*(lmax-1)))
+        self.history = []
+
+    # Parameter handling
+    def _unit(self, X):
+        # Free parameters mapped to the unit cube
+        X = np.atleast_2d(X)
+        lo = np.array([self.bounds[p][0] for p in self.free])
+        hi = np.array([self.bounds[p][1] for p in self.free])
+        inds = [PARAMS.index(p) for p in self.free]
+        return (X[:, inds] - lo)/(hi - lo)
+
+    def _from_unit(self, U):
+        X = np.array([[np.mean(self.bounds[p]) for p in PARAMS]]*len(U))
+        for i, p in enumerate(self.free):
+            lo, hi = self.bounds[p]
+            X[:, PARAMS.index(p)] = lo + U[:, i]*(hi - lo)
+        return X
+
+    def _check(self, X):
+        for i, p in enumerate(PARAMS):
+            lo, hi = self.bounds[p]
+            if np.any(X[:, i] < lo - 1e-10*abs(lo)) or np.any(
+                    X[:, i] > hi + 1e-10*abs(hi)):
+                raise ValueError('{0} is outside the emulated range '
+                        '[{1}, {2}]'.format(p, lo, hi))
+
+    # Training data
+    def exact(self, X):
+        '''
+        CLASS spectra for each row of X, as an (n, 4*(lmax-1)) feature array.
+        '''
+        Y = []
+        for zre, x_e, dz, z_t in np.atleast_2d(X):
+            ell, EE, TE, TT = get_spectra(zre, x_e, dz=dz, z_t=z_t,
+                    lmax=self.lmax, spectra=True, all_spectra=True)
+            ell, BB = get_spectra(zre, x_e, dz=dz, z_t=z_t, lmax=self.lmax,
+                    only_BB=True)
+            Y.append(to_features(TT[2:], EE[2:], TE[2:], BB[2:]))
+        return np.array(Y)
+
+    def add(self, X, Y=None):
+        X = np.atleast_2d(X)
+        if Y is None:
+            Y = self.exact(X)
+        self.X = np.concatenate((self.X, X))
+        self.Y = np.concatenate((self.Y, Y))
+        self.fit()
+
+    # Fitting
+    def _fit(self, X, Y):
+        mean, std = Y.mean(axis=0), Y.std(axis=0)
+        std[std == 0] = 1
+        Z = (Y - mean)/std
+        _, s, Vt = np.linalg.svd(Z, full_matrices=False)
+        if self.ncomp is None:
+            frac = 1 - np.cumsum(s**2)/np.sum(s**2)
+            ncomp = int(np.argmax(frac < self.var_tol)) + 1
+        else:
+            ncomp = self.ncomp
+        ncomp = min(ncomp, len(s))
+        basis = Vt[:ncomp]
+        coeffs = Z @ basis.T
+        interp = RBFInterpolator(self._unit(X), coeffs, kernel=self.kernel,
+                degree=1)
+        return mean, std, basis, interp
+
+    def fit(self):
+        self._model = self._fit(self.X, self.Y)
+
+    def _predict(self, X, model=None):
+        mean, std, basis, interp = self._model if model is None else model
+        return mean + std*(interp(self._unit(X)) @ basis)
+
+    def predict(self, X):
+        '''
+        Emulated (TT, EE, TE, BB) for 2 <= ell <= lmax, each (n, lmax-1).
+        '''
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        self._check(X)
+        return from_features(self._predict(X), self.lmax-1)
+
+    def committee(self, nfold=4, seed=0):
+        '''
+        Emulators that each leave out one of nfold random subsets of the
+        training points.
+        '''
+        folds = np.random.RandomState(seed).permutation(len(self.X)) % nfold
+        return [self._fit(self.X[folds != k], self.Y[folds != k])
+                for k in range(nfold)]
+
+    def error_estimate(self, X, models=None):
+        '''
+        Estimated emulator error at each row of X: the largest disagreement
+        between the committee and the full emulator, in units of cosmic
+        variance.
+        '''
+        if models is None:
+            models = self.committee()
+        nl = self.lmax - 1
+        full = from_features(self._predict(X), nl)
+        err = np.zeros(len(X))
+        for model in models:
+            approx = from_features(self._predict(X, model), nl)
+            e = cosmic_variance_error(approx, full)
+            err = np.max([err] + list(e.values()), axis=0)
+        return err
+
+    def train(self, n_init=None, batch=4, tol=0.05, max_runs=200,
+            n_candidates=2000, seed=0, verbose=True):
+        '''
+        Adds CLASS runs until the estimated error is below tol (in units of
+        cosmic variance) everywhere, or max_runs training points are used.
+        Each iteration runs CLASS at the batch candidates with the largest
+        estimated error, skipping candidates too close to one already picked.
+        '''
+        d = len(self.free)
+        sampler = qmc.Sobol(d, seed=seed)
+        if len(self.X) == 0:
+            if n_init is None:
+                n_init = 2**int(np.ceil(np.log2(5*d+1)))
+            U = sampler.random(n_init)
+            # Include the corners so that we never extrapolate
+            corners = np.array(np.meshgrid(*[[0, 1]]*d)).reshape(d, -1).T
+            self.add(self._from_unit(np.concatenate((corners, U))))
+        t0 = time.time()
+        while len(self.X) < max_runs:
+            U = sampler.random(n_candidates)
+            X = self._from_unit(U)
+            err = self.error_estimate(X)
+            self.history.append((len(self.X), float(err.max())))
+            if verbose:
+                print('{0} training points, estimated max error {1:.3f} sigma, '
+                        '{2:.1f} s'.format(len(self.X), err.max(),
+                            time.time()-t0))
+            if err.max() < tol:
+                break
+            new = []
+            for i in np.argsort(err)[::-1]:
+                if err[i] < tol or len(new) == batch:
+                    break
+                if all(np.linalg.norm(U[i] - U[j]) > 0.5/batch**(1/d)
+                        for j in new):
+                    new.append(i)
+            self.add(X[new])
+        return self.history
+
+    def validate(self, n=20, seed=1, verbose=True):
+        '''
+        Compares the emulator to CLASS at n random points that were not used
+        for training. Returns the largest fractional and cosmic-variance
+        errors for each spectrum.
+        '''
+        U = np.random.RandomState(seed).uniform(size=(n, len(self.free)))
+        X = self._from_unit(U)
+        exact = from_features(self.exact(X), self.lmax-1)
+        approx = self.predict(X)
+        frac = {}
+        for s, a, e in zip(SPECTRA, approx, exact):
+            norm = np.sqrt(exact[0]*exact[1]) if s == 'TE' else np.abs(e)
+            frac[s] = float(np.max(np.abs(a - e)/norm))
+        cv = {s: float(e.max()) for s, e in
+                cosmic_variance_error(approx, exact).items()}
+        if verbose:
+            print('{0} held-out models, {1} training points'.format(n,
+                len(self.X)))
+            for s in SPECTRA:
+                print('{0}: max fractional error {1:.2e}, max error {2:.3f} '
+                        'sigma_cv'.format(s, frac[s], cv[s]))
+        return {'fractional': frac, 'cosmic_variance': cv}
+
+    # Drop-in replacement for tools.get_spectra
+    def get_spectra(self, zreio, x_e, dz=0.5, z_t=28, history=False,
+            spectra=False, both=False, all_spectra=False, lmax=100,
+            therm=False, only_BB=False, r=0, **kwargs):
+        '''
+        Same interface as tools.get_spectra for the spectra, with ell = 0, 1
+        set to zero. There is no thermodynamics, and r must be 0.
+        '''
+        if history or both or therm:
+            raise ValueError('The emulator only returns spectra')
+        if r != 0:
+            raise ValueError('The emulator was trained for r = 0')
+        if lmax > self.lmax:
+            raise ValueError('lmax = {0} is larger than the emulator lmax = '
+                    '{1}'.format(lmax, self.lmax))
+        TT, EE, TE, BB = [np.concatenate(([0, 0], c[0]))[:lmax+1]
+                for c in self.predict([[zreio, x_e, dz, z_t]])]
+        ell = np.arange(lmax+1)
+        if only_BB:
+            return ell, BB
+        if all_spectra:
+            return ell, EE, TE, TT
+        return ell, EE, TE
+
+    # I/O
+    def save(self, fname):
+        np.savez(fname, X=self.X, Y=self.Y, lmax=self.lmax,
+                ncomp=-1 if self.ncomp is None else self.ncomp,
+                var_tol=self.var_tol, kernel=self.kernel,
+                bounds=np.array([self.bounds[p] for p in PARAMS]),
+                history=np.array(self.history).reshape(-1, 2))
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as f:
+            bounds = {p: tuple(b) for p, b in zip(PARAMS, f['bounds'])}
+            ncomp = int(f['ncomp'])
+            emu = cls(bounds, lmax=int(f['lmax']),
+                    ncomp=None if ncomp < 0 else ncomp,
+                    var_tol=float(f['var_tol']), kernel=str(f['kernel']))
+            emu.history = [tuple(h) for h in f['history']]
+            emu.X, emu.Y = f['X'], f['Y']
+        emu.fit()
+        return emu
+
+
+if __name__ == '__main__':
+    emu = SpectraEmulator({'zre': (4, 12), 'x_e': (0, 0.5)})
+    emu.train(tol=0.05)
+    emu.validate()
+    emu.save('emulator.npz')
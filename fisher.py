@@ -0,0 +1,240 @@
+'''
+Fisher matrices of Gaussian CMB power spectra, for every multipole at once.
+
+For a set of fields (T and E, or just E) with covariance C_ell and parameter
+derivatives dC_ell/dp_i, the Fisher matrix of multipole ell is
+
+    F_ij(ell) = (2ell+1)/2 tr(C^-1 dC/dp_i C^-1 dC/dp_j).
+
+fisher_ell does this with batched linear algebra on (n_ell, n_field, n_field)
+stacks, and any leading axes (fiducial models, noise levels, ...) are
+broadcast, e.g.
+
+    C = covariance(TT, EE, TE, N_lT=N_lT[:, None], N_lE=N_lE[:, None])
+    dC = covariance(dTT, dEE, dTE)
+    F = fisher_ell(ell, C, dC)      # (n_noise, n_ell, n_par, n_par)
+
+has one Fisher matrix per noise level and multipole; white_noise makes such
+noise stacks. FisherResult keeps their cumulative sums over ell, so that the
+Fisher matrix of any multipole range is a lookup. The derivatives of a
+spectrum can be switched off with a mask, e.g. mask={'TT': 0, 'EE': 0} for a
+TE-only derivative.
+'''
+import numpy as np
+
+SPECTRA = ['TT', 'EE', 'TE']
+
+
+def white_noise(w_p, ell, fwhm=0):
+    '''
+    N_ell in uK^2 sr of white noise of depth w_p in uK-arcmin, deconvolved
+    by a Gaussian beam with the given fwhm in arcmin. w_p and fwhm can be
+    arrays, the result has shape np.broadcast(w_p, fwhm).shape + (len(ell),).
+    '''
+    w_p, fwhm = np.broadcast_arrays(np.asarray(w_p, dtype=float),
+            np.asarray(fwhm, dtype=float))
+    ell = np.asarray(ell)
+    sigma = fwhm[..., None]*np.pi/180/60/np.sqrt(8*np.log(2))
+    return (w_p[..., None]*np.pi/180/60)**2*np.exp(ell*(ell+1)*sigma**2)
+
+
+def covariance(TT, EE, TE, N_lT=0, N_lE=0, TE_cov=True):
+    '''
+    Stack of the T, E covariance matrices [[TT + N_lT, TE], [TE, EE + N_lE]]
+    with shape np.broadcast(...).shape + (2, 2). With TE_cov=False the
+    off-diagonal is zero, as if T and E were independent.
+    '''
+    TT, EE, TE = np.broadcast_arrays(TT + N_lT, EE + N_lE, TE)
+    if not TE_cov:
+        TE = 0*TE
+    return np.stack([np.stack([TT, TE], axis=-1),
+                     np.stack([TE, EE], axis=-1)], axis=-2)
+
+
+def derivatives(dTT, dEE, dTE, mask=None, TE_cov=True):
+    '''
+    Stack of the derivative matrices, (n_par, n_ell, 2, 2) for (n_par, n_ell)
+    inputs. mask is a dict with a factor for some of 'TT', 'EE' and 'TE'
+    (1 for the ones that aren't given), e.g. {'EE': 0} to drop the EE
+    derivative.
+    '''
+    mask = {} if mask is None else mask
+    for s in mask:
+        if s not in SPECTRA:
+            raise ValueError('mask keys have to be in {0}, got {1}'.format(
+                SPECTRA, s))
+    return covariance(mask.get('TT', 1)*np.asarray(dTT),
+            mask.get('EE', 1)*np.asarray(dEE),
+            mask.get('TE', 1)*np.asarray(dTE), TE_cov=TE_cov)
+
+
+def fisher_ell(ell, C, dC):
+    '''
+    Fisher matrix of each multipole, shape (..., n_ell, n_par, n_par), from
+    the covariance C, shape (..., n_ell, n, n), and its derivatives dC, shape
+    (..., n_par, n_ell, n, n). n = 1 (a single spectrum) works as well.
+    '''
+    ell = np.asarray(ell)
+    Cinv = np.linalg.inv(C)
+    # C^-1 dC_i for every parameter
+    A = np.matmul(Cinv[..., None, :, :, :], dC)
+    F = np.einsum('...ilab,...jlba->...lij', A, A)
+    return (2*ell[:, None, None] + 1)/2*F
+
+
+def fisher_EE(ell, EE, dEE, N_lE=0):
+    '''
+    fisher_ell for EE alone; dEE has shape (..., n_par, n_ell).
+    '''
+    C = (np.asarray(EE) + N_lE)[..., None, None]
+    dC = np.asarray(dEE)[..., None, None]
+    return fisher_ell(ell, C, dC)
+
+
+def fisher_TE(ell, TT, EE, TE, dTT, dEE, dTE, N_lT=0, N_lE=0, mask=None,
+        TE_cov=True):
+    '''
+    fisher_ell for T and E together, from the spectra (n_ell,) and their
+    derivatives (n_par, n_ell). mask and TE_cov are as in derivatives() and
+    covariance(); TE_cov=False also drops the TE derivative.
+    '''
+    C = covariance(TT, EE, TE, N_lT=N_lT, N_lE=N_lE, TE_cov=TE_cov)
+    dC = derivatives(dTT, dEE, dTE, mask=mask, TE_cov=TE_cov)
+    return fisher_ell(ell, C, dC)
+
+
+def reparameterize(F, dq_dp):
+    '''
+    Fisher matrices, shape (..., n, n), of new parameters q(p) from those of
+    p, with dq_dp[i, j] = dq_i/dp_j at the fiducial model.
+    '''
+    dp_dq = np.linalg.inv(dq_dp)
+    return np.einsum('ai,...ab,bj->...ij', dp_dq, F, dp_dq)
+
+
+def marginal_sigma(F):
+    '''
+    Marginalized uncertainties sqrt(diag(F^-1)) for a stack of Fisher
+    matrices, shape (..., n_par, n_par) -> (..., n_par).
+    '''
+    return np.sqrt(np.diagonal(np.linalg.inv(F), axis1=-2, axis2=-1))
+
+
+class FisherResult(object):
+    '''
+    Fisher matrices F_ell, shape (..., n_ell, n_par, n_par), of the
+    consecutive multipoles ell, stored as cumulative sums over ell so that
+    the Fisher matrix of any range lmin <= ell <= lmax is the difference of
+    two of them. params optionally names the parameters.
+    '''
+    def __init__(self, ell, F_ell, params=None):
+        ell = np.asarray(ell)
+        if np.any(np.diff(ell) != 1):
+            raise ValueError('ell has to be consecutive multipoles')
+        self.ell = ell
+        self.F_ell = np.asarray(F_ell)
+        self.params = params
+        cum = np.cumsum(self.F_ell, axis=-3)
+        # cumulative[..., i] is the sum over ell < ell[0] + i
+        self.cumulative_F = np.concatenate([np.zeros_like(cum[..., :1, :, :]),
+            cum], axis=-3)
+
+    def _index(self, l):
+        l = np.asarray(l)
+        if np.any((l < self.ell[0] - 1) | (l > self.ell[-1])):
+            raise ValueError('ell has to be in [{0}, {1}]'.format(self.ell[0],
+                self.ell[-1]))
+        return l - self.ell[0] + 1
+
+    def F(self, lmin=None, lmax=None):
+        '''
+        Fisher matrix of lmin <= ell <= lmax, by default all of ell. lmin and
+        lmax can be arrays, which broadcast against each other, and the
+        result has shape (...,) + np.broadcast(lmin, lmax).shape +
+        (n_par, n_par).
+        '''
+        lmin = self.ell[0] if lmin is None else lmin
+        lmax = self.ell[-1] if lmax is None else lmax
+        lmin, lmax = np.broadcast_arrays(lmin, lmax)
+        if np.any(lmin > lmax + 1):
+            raise ValueError('lmin has to be at most lmax + 1')
+        return (self.cumulative_F[..., self._index(lmax), :, :] -
+                self.cumulative_F[..., self._index(lmin - 1), :, :])
+
+    def sigma(self, lmin=None, lmax=None):
+        '''
+        Marginalized uncertainties from the multipoles lmin <= ell <= lmax,
+        shape (...,) + np.broadcast(lmin, lmax).shape + (n_par,).
+        '''
+        return marginal_sigma(self.F(lmin, lmax))
+
+    def cumulative(self, lmin=None):
+        '''
+        Fisher matrices of lmin <= ell <= lmax for every lmax >= lmin, and
+        those lmax.
+        '''
+        lmin = self.ell[0] if lmin is None else lmin
+        lmax = self.ell[self.ell >= lmin]
+        return self.F(lmin, lmax), lmax
+
+    def __repr__(self):
+        return 'FisherResult({0} <= ell <= {1}, params={2}, shape={3})'.format(
+                self.ell[0], self.ell[-1], self.params, self.F_ell.shape)
+
+
+def test_fisher(n_ell=30, n_par=3, seed=0):
+    '''
+    Compares fisher_TE and fisher_EE to a loop over ell with explicit 2x2
+    matrices.
+    '''
+    np.random.seed(seed)
+    ell = np.arange(2, n_ell+2)
+    TT, EE = np.random.uniform(1, 2, (2, n_ell))
+    TE = 0.5*np.sqrt(TT*EE)*np.random.uniform(-1, 1, n_ell)
+    dTT, dEE, dTE = np.random.randn(3, n_par, n_ell)
+    mask = {'TT': 0}
+    F = fisher_TE(ell, TT, EE, TE, dTT, dEE, dTE, N_lE=0.1, mask=mask)
+    F_EE = fisher_EE(ell, EE, dEE, N_lE=0.1)
+    err, err_EE = 0, 0
+    for k, l in enumerate(ell):
+        Clinv = np.linalg.inv([[TT[k], TE[k]], [TE[k], EE[k] + 0.1]])
+        dCl = [np.array([[0, dTE[i, k]], [dTE[i, k], dEE[i, k]]]) for i in
+                range(n_par)]
+        for i in range(n_par):
+            for j in range(n_par):
+                Fij = np.trace(Clinv.dot(dCl[i].dot(Clinv.dot(dCl[j]))))*(
+                        2*l+1)/2
+                err = max(err, abs(F[k, i, j] - Fij)/abs(Fij))
+                Fij = dEE[i, k]*dEE[j, k]/(EE[k] + 0.1)**2*(2*l+1)/2
+                err_EE = max(err_EE, abs(F_EE[k, i, j] - Fij)/abs(Fij))
+    print('largest fractional difference: TE {0:.1e}, EE {1:.1e}'.format(err,
+        err_EE))
+
+    # a stack of noise levels gives the same as one level at a time
+    N_l = white_noise([0, 10, 100], ell, fwhm=[[0], [60]])
+    F = fisher_TE(ell, TT, EE, TE, dTT, dEE, dTE, N_lE=N_l)
+    err = 0
+    for i in range(2):
+        for j in range(3):
+            Fij = fisher_TE(ell, TT, EE, TE, dTT, dEE, dTE, N_lE=N_l[i, j])
+            err = max(err, np.max(abs(F[i, j] - Fij)/abs(Fij)))
+    print('noise stack of shape {0}: {1:.1e}'.format(N_l.shape[:-1], err))
+
+    # ell ranges of FisherResult against direct sums
+    result = FisherResult(ell, F)
+    lmin, lmax = np.sort(np.random.randint(ell[0], ell[-1]+1, (2, 100)), axis=0)
+    F_range = result.F(lmin, lmax)
+    err = 0
+    for k in range(len(lmin)):
+        Fk = F[..., lmin[k]-ell[0]:lmax[k]-ell[0]+1, :, :].sum(axis=-3)
+        err = max(err, np.max(abs(F_range[..., k, :, :] - Fk)/abs(Fk).max()))
+    print('FisherResult ell ranges: {0:.1e}'.format(err))
+
+    # reparameterize against the derivatives with respect to q = A p
+    A = np.random.randn(n_par, n_par)
+    F_q = reparameterize(F, A)
+    dp_dq = np.linalg.inv(A)
+    F = fisher_TE(ell, TT, EE, TE, *[np.dot(dp_dq.T, d) for d in (dTT, dEE,
+        dTE)], N_lE=N_l)
+    print('reparameterize: {0:.1e}'.format(np.max(abs(F_q - F)/abs(F).max())))
+    return
@@ -8,7 +8,9 @@ import scipy.optimize as op
 import emcee
 from time import time
 
-from tools import get_spectra, get_tau, get_twotau, lnprob_EE_ell
+from tools import (get_spectra, get_tau, get_twotau, lnprob_EE_ell,
+        compute_model, PrimordialSpectra)
+from emulator import SpectraEmulator
 
 import sys
 from schwimmbad import MPIPool
@@ -26,11 +28,92 @@ params['many_tanh_num'] = 3
 params['many_tanh_width'] = 0.5
 cosmo = Class()
 
-def lnprob(args, Clhat):
+# If this file exists (see emulator.py), the spectra are emulated instead of
+# computed with CLASS at every step. It has to cover the prior below.
+emulator_file = 'emulator.npz'
+
+# Set to e.g. {'zreio': 1e-3, 'x_e': 1e-4} to reuse any CLASS model within
+# that distance of one this process has already computed, instead of running
+# CLASS again.
+approx_tol = None
+compute_model.tolerance = approx_tol
+
+def lnprob(args, Clhat, backend=None):
     zre, x_e = args
     if (zre < 4) | (x_e < 0) | (x_e > 0.5):
         return -np.inf
-    return sum(lnprob_EE_ell(zre, x_e, Clhat)[2:])
+    if backend is not None:
+        for p, value in [('zre', zre), ('x_e', x_e)]:
+            lo, hi = backend.bounds[p]
+            if (value < lo) | (value > hi):
+                return -np.inf
+    return sum(lnprob_EE_ell(zre, x_e, Clhat, backend=backend)[2:])
+
+# Parameters for sample_fast_slow. The slow ones change the reionization
+# history and need CLASS; the fast ones only change the primordial spectrum,
+# which PrimordialSpectra does in numpy.
+SLOW_PARAMS = ['zre', 'x_e']
+FAST_PARAMS = ['A_s', 'n_s']
+
+def slow_state(slow, lmax=lmax):
+    # Everything the fast parameters need, or None outside the prior
+    zre, x_e = slow
+    if (zre < 4) | (x_e < 0) | (x_e > 0.5):
+        return None
+    return PrimordialSpectra('many_tanh', lmax=lmax, zreio=zre, x_e=x_e)
+
+def lnprob_fast(state, fast, Clhat, N_l=0):
+    A_s, n_s = fast
+    # PrimordialSpectra expands in n_s around the model's 0.9649
+    if (A_s <= 0) | (n_s < 0.9) | (n_s > 1.03):
+        return -np.inf
+    ell, spectra = state.get_spectra(A_s=A_s, n_s=n_s)
+    Cl = spectra['EE'][:len(Clhat)] + N_l
+    chi2_ell = (2*ell[2:]+1)*(Clhat[2:]/Cl[2:] + np.log(Cl[2:]) - np.log(Clhat[2:])-1)
+    return -sum(chi2_ell)/2
+
+def sample_fast_slow(prepare, lnprob, slow0, fast0, slow_step, fast_step,
+        nsteps, nfast=10, args=(), seed=None, verbose=True):
+    '''
+    Metropolis-Hastings with the parameters split into a slow and a fast
+    block. prepare(slow) does the expensive part (CLASS) and returns a state,
+    or None outside the prior, and lnprob(state, fast, *args) the cheap rest.
+
+    Each step is one Gaussian move of the slow parameters with the fast ones
+    fixed, followed by nfast moves of the fast parameters on the same state,
+    so that adding fast parameters costs almost nothing. Both kinds of moves
+    leave the posterior invariant. Returns the chain, shape
+    (nsteps, len(slow0) + len(fast0)), and its log posterior.
+    '''
+    rng = np.random.RandomState(seed)
+    slow, fast = np.array(slow0, dtype=float), np.array(fast0, dtype=float)
+    state = prepare(slow)
+    lnp = lnprob(state, fast, *args)
+    chain = np.zeros((nsteps, len(slow) + len(fast)))
+    lnps = np.zeros(nsteps)
+    accepted = np.zeros(2)
+    t0 = time()
+    for i in range(nsteps):
+        new = slow + slow_step*rng.randn(len(slow))
+        new_state = prepare(new)
+        if new_state is not None:
+            new_lnp = lnprob(new_state, fast, *args)
+            if np.log(rng.rand()) < new_lnp - lnp:
+                slow, state, lnp = new, new_state, new_lnp
+                accepted[0] += 1
+        for j in range(nfast):
+            new = fast + fast_step*rng.randn(len(fast))
+            new_lnp = lnprob(state, new, *args)
+            if np.log(rng.rand()) < new_lnp - lnp:
+                fast, lnp = new, new_lnp
+                accepted[1] += 1
+        chain[i] = np.concatenate([slow, fast])
+        lnps[i] = lnp
+        if verbose and ((i+1) % 100 == 0):
+            print('{0}/{1}: acceptance slow {2:.2f}, fast {3:.2f}, '
+                    '{4:.1f} s'.format(i+1, nsteps, accepted[0]/(i+1),
+                        accepted[1]/(i+1)/nfast, time()-t0))
+    return chain, lnps
 
 #def lnprob_EE_ell(zre, x_e, Clhat):
 #    ell, Cl, TE = get_spectra(zre, x_e, lmax=len(Clhat)-1, spectra=True)
@@ -40,6 +123,20 @@ def lnprob(args, Clhat):
 
 if __name__ == '__main__':
 
+    if '--fast-slow' in sys.argv:
+        # Samples A_s and n_s along with the history, see sample_fast_slow
+        seed = 2
+        ell, ee, te = get_spectra(6, 0.00, spectra=True, lmax=lmax)
+        np.random.seed(seed)
+        eehat = hp.alm2cl(hp.synalm(ee, lmax=lmax))
+        chain, lnps = sample_fast_slow(slow_state, lnprob_fast, [7, 0.05],
+                [2.1e-9, 0.965], slow_step=np.array([0.2, 0.01]),
+                fast_step=np.array([0.05e-9, 0.01]), nsteps=5000,
+                args=(eehat,), seed=seed)
+        np.savez('chain_fast_slow_{0}'.format(seed), chain=chain,
+                lnprob=lnps, names=SLOW_PARAMS + FAST_PARAMS)
+        sys.exit()
+
     pool = MPIPool()
     if not pool.is_master():
         pool.wait()
@@ -62,9 +159,15 @@ if __name__ == '__main__':
     
     
     ndim, nwalkers = 2, 24
+
+    try:
+        backend = SpectraEmulator.load(emulator_file)
+        print('Using the emulator in {0}'.format(emulator_file))
+    except IOError:
+        backend = None
     
     
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args=([eehat]),
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args=([eehat, backend]),
             pool=pool)
     
     # roughly 20 cpu-seconds/step
@@ -74,7 +177,7 @@ if __name__ == '__main__':
         lnprob = np.loadtxt('lnprob_{0}.dat'.format(seed))
     except IOError:
         nll = lambda *args: -lnprob(*args)
-        result = op.minimize(nll, [7, 0.2], args=(eehat))
+        result = op.minimize(nll, [7, 0.2], args=(eehat, backend))
         pos = [result['x'] + 1e-4*np.random.randn(ndim) for i in range(nwalkers)]
 
     nsteps = 1000
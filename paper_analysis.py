@@ -21,10 +21,11 @@ import functools
 from tools import (twinplot, get_tau, get_tau_z, get_twotau, get_spectra,
         lnprob_EE_ell, lnprob_wish_ell, lnprob_TE_ell,
         lnprob_EE_ell_tau, lnprob_wish_ell_tau, lnprob_TE_ell_tau,
-        get_spectra_tau,
+        get_spectra_tau, get_spectra_many,
         get_F_ell, get_F_ell_forcezsplit, get_F_ell_2, get_F_ell_3,
         get_F_ell_4, get_F_ell_5, get_F_ell_tau, get_spectra_simple,
-        get_F_ell_3_tau)
+        get_F_ell_3_tau, get_F_noise, get_F_result)
+from fisher import white_noise
 
 lmax = 30
 
@@ -258,7 +259,7 @@ def cartoons(tau=0.06):
 
     return
 
-def fig1_transp(num=50):
+def fig1_transp(num=50, workers=None):
     '''
     Plots the reionization histories, EE power spectra, and TE power spectra as
     a function of the reionization redshift, the high-redshift component, and
@@ -272,6 +273,11 @@ def fig1_transp(num=50):
     xes = np.linspace(0, 0.2, num)
     z0 = 6
     xe0 = 0
+    # Compute the first two panels' models in parallel up front
+    get_spectra_many([(z, xe0) for z in zs] + [(z0, xe) for xe in xes],
+            workers=workers)
+    get_spectra_many([(z, xe0) for z in zs] + [(z0, xe) for xe in xes],
+            workers=workers, thermo_only=True)
     
     fig, axes = plt.subplots(nrows=4, ncols=3, figsize=(8,8), 
                              gridspec_kw={"height_ratios":[0.05, 1,1,1], 
@@ -414,24 +420,27 @@ def fig1_transp(num=50):
 
     return
 
-def fig3(zre=7, xe=0.05, lmin=2, lmax=100, ntests=2):
+def fig3_result(zre=7, xe=0.05, wps=[0, 10, 60, 100], lmin=2, lmax=100,
+        tau_vars=False):
+    '''
+    Per-multipole Fisher matrices of fig3 (or of fig3_taus, with tau_vars) for
+    all the noise levels wps, from which any multipole range is a lookup.
+    '''
+    return get_F_result(zre, xe, N_lE=white_noise(wps, np.arange(lmax+1)),
+            lmin=lmin, lmax=lmax, tau_vars=tau_vars, dzre=5e-5, dxre=1e-5)
+
+def fig3(zre=7, xe=0.05, lmin=2, lmax=100, ntests=2, result=None):
     '''
     Plots Fisher contours as a function of xe and zre, shows contours
     for noise levels of 0, 10, 60 and 100 uK-arcmin. 
     Allows the multipole
-    range under consideration to be altered.
+    range under consideration to be altered. result can be fig3_result(),
+    shared between the multipole ranges.
     '''
-    F = []
     wps = np.array([0, 10, 60, 100])
-    plt.figure()
-    ell = np.arange(lmin, lmax+1)
-    for wp in wps:
-        F_ell, F_ell1d, dTTdx, dEEdx, dTEdx, dTTdz, dEEdz, dTEdz = get_F_ell(zre, xe,\
-            N_lT=(0*np.pi/180/60)**2,\
-            N_lE=(wp*np.pi/180/60)**2, lmin=lmin, lmax=lmax,
-            test2=True, dzre=5e-5, dxre=1e-5)
-        F_ell = np.array(F_ell)
-    plt.close('all')
+    if result is None:
+        result = fig3_result(zre, xe, wps=wps, lmin=lmin, lmax=lmax)
+    F = result.F(lmin, lmax)
 
 
     mean = np.array([zre, xe])
@@ -480,18 +489,10 @@ def fig3_ell_var(zre=7, xe=0.05, noise=0):
     Plots Fisher contours as a function of xe and zre, shows contours
     using separate multipole ranges.
     '''
-    F = []
     pairs = [(2,99), (2, 9), (10, 19), (20, 29), (30, 99)]
     colors = [r'C{0}'.format(i) for i in range(len(pairs))]
-    for p in pairs:
-        lmin, lmax = p
-        ell = np.arange(lmin, lmax+1)
-        F_ell, F_ell1d, dTTdx, dEEdx, dTEdx, dTTdz, dEEdz, dTEdz = get_F_ell(zre, xe,\
-            N_lT=(0*np.pi/180/60)**2,\
-            N_lE=(noise*np.pi/180/60)**2, lmin=lmin, lmax=lmax,
-            test2=True, dzre=5e-5, dxre=1e-5)
-        F_ell = np.array(F_ell)
-        F.append(np.sum(F_ell,axis=0))
+    result = fig3_result(zre, xe, wps=noise, lmax=99)
+    F = result.F(*np.transpose(pairs))
 
     mean = np.array([zre, xe])
     gausses = []
@@ -561,14 +562,14 @@ def fig3_ell_var(zre=7, xe=0.05, noise=0):
     plt.close('all')
     return
 
-def fig3_taus(zre=7, xe=0.05, lmin=2, lmax=100, ntests=2):
+def fig3_taus(zre=7, xe=0.05, lmin=2, lmax=100, ntests=2, result=None):
     '''
     Plots Fisher contours as a function of tau_lo and tau_hi, shows contours
     for noise levels of 0, 10, 60 and 100 uK-arcmin. 
     Allows the multipole
-    range under consideration to be altered.
+    range under consideration to be altered. result can be
+    fig3_result(tau_vars=True), shared between the multipole ranges.
     '''
-    F = []
     wps = np.array([10, 20, 50, 100, 200, 500, 1000])
     #wps = np.array([1e3, 5e3, 1e4, 5e4])
     #wps = np.array([0, np.inf])
@@ -584,13 +585,10 @@ def fig3_taus(zre=7, xe=0.05, lmin=2, lmax=100, ntests=2):
     fig, axes = plt.subplots(3,1)
     fig2, axes2 = plt.subplots(3,1)
     fig3, axes3 = plt.subplots(3,1)
-    for wp in wps:
-        F_ell  = get_F_ell(zre, xe,\
-            N_lT=(0*np.pi/180/60)**2,\
-            N_lE=(wp*np.pi/180/60)**2, lmin=lmin, lmax=lmax,
-            tau_vars=True)
-        F_ell = np.array(F_ell)
-        F.append(np.sum(F_ell,axis=0))
+    if result is None:
+        result = fig3_result(zre, xe, wps=wps, lmin=lmin, lmax=lmax,
+                tau_vars=True)
+    F = result.F(lmin, lmax)
 
 
     mean = np.array([0.06, 0.01])
@@ -654,54 +652,25 @@ def noise_vs_uncertainty(zre=7, xe=0.05, lmin=2, lmax=100, ntests=2):
     Calculates and plost the Fisher uncertainty on optical depth parameters as a
     function of white noise.
     '''
-    F = []
     wps = np.logspace(np.log10(0.65), np.log10(230), 50)
     plt.figure()
-    F_tautot = []
-    for wp in wps:
-        F_ell  = get_F_ell(zre, xe,\
-            N_lT=(0*np.pi/180/60)**2,\
-            N_lE=(wp*np.pi/180/60)**2, lmin=lmin, lmax=lmax,
+    # one pass for all the noise levels
+    N_lE = white_noise(wps, np.arange(lmax+1))
+    F, sigma = get_F_noise(zre, xe, N_lE=N_lE, lmin=lmin, lmax=lmax,
             tau_vars=True)
-        F_ell = np.array(F_ell)
-        F_tautot_ell = F_ell[:,0,0] + F_ell[:,1,1] + 2*F_ell[:,0,1]
-        F_tautot.append(np.sum(F_tautot_ell))
-        F.append(np.sum(F_ell,axis=0))
-    
-    sigma_tauhi = []
-    sigma_taulo = []
-    sigma_tautot = []
-    rhos = []
-
     for i in range(len(F)):
         print(F[i], i, wps[i])
-        cov = np.linalg.inv(F[i])
-        sigma_taulo.append(cov[0,0]**0.5)
-        sigma_tauhi.append(cov[1,1]**0.5)
-        rhos.append(cov[0,1])
-        sigma_tautot.append(1/F_tautot[i]**0.5)
-
-    sigma_taulo = np.array(sigma_taulo)
-    sigma_tauhi = np.array(sigma_tauhi)
-    rhos = np.array(rhos)
+    sigma_taulo, sigma_tauhi = sigma.T
+    rhos = np.linalg.inv(F)[:,0,1]
 
     sigma_tautot = np.sqrt(sigma_taulo**2+sigma_tauhi**2)
 
     plt.plot(wps, sigma_taulo, 'C0-', label=r'$\sigma_{\tau_\mathrm{lo}}$')
     plt.plot(wps, sigma_tauhi, 'C1-', label=r'$\sigma_{\tau_\mathrm{hi}}$')
     plt.plot(wps, sigma_tautot, 'C2-', label=r'$\sigma_{\tau_\mathrm{tot}}$')
-    F = []
-    sigma_tautot = []
-    for wp in wps:
-        F_ell  = get_F_ell(zre+1, xe*0,\
-            N_lT=(0*np.pi/180/60)**2,\
-            N_lE=(wp*np.pi/180/60)**2, lmin=lmin, lmax=lmax,
+    F, _ = get_F_noise(zre+1, xe*0, N_lE=N_lE, lmin=lmin, lmax=lmax,
             tau_vars=True)
-        F_ell = np.array(F_ell)
-        F.append(np.sum(F_ell,axis=0))
-    for i in range(len(F)):
-        cov = np.linalg.inv(F[i])
-        sigma_tautot.append(1/F[i][0,0]**0.5)
+    sigma_tautot = 1/F[:,0,0]**0.5
     plt.plot(wps, sigma_tautot, 'C3', label=r'$\sigma_{\tau}$ (tanh-like)',
             zorder=-1)
 
@@ -729,9 +698,11 @@ def noise_vs_uncertainty(zre=7, xe=0.05, lmin=2, lmax=100, ntests=2):
 
     return
 
-def fig6(num=50, lmax=40, wp=0):
+def fig6(num=50, lmax=40, wp=0, backend=None):
     '''
     Make plots of the chi2 per multipole when you change both zre and xe.
+    backend can be a spectra_grid.SpectraGrid (or emulator) covering the
+    models, so that they don't all have to be computed with CLASS.
 
     First plot is zre centered at 8, varying between 7 and 9. Remember that
     \chi^2 = 0 by definition when \hat C_\ell = C_\ell, so that'll always be the
@@ -765,7 +736,7 @@ def fig6(num=50, lmax=40, wp=0):
     for i in range(num):
         lnPE = []
         lnPW = []
-        lnPW = lnprob_wish_ell(zs[i], xe0, Clhat, N_lE=N_ell)
+        lnPW = lnprob_wish_ell(zs[i], xe0, Clhat, N_lE=N_ell, backend=backend)
         ax.plot(ell[2:], -2*lnPW[2:], color=cm1(i/num), lw=lw)
     ax.set_xlabel(r'$\ell$')
     ax.set_ylabel(r'$\chi^2_\mathrm{eff,\ell}$')
@@ -795,7 +766,7 @@ def fig6(num=50, lmax=40, wp=0):
     for i in range(num):
         lnPE = []
         lnPW = []
-        lnPW = lnprob_wish_ell(z0, xes[i], Clhat, N_lE=N_ell)
+        lnPW = lnprob_wish_ell(z0, xes[i], Clhat, N_lE=N_ell, backend=backend)
         ax.plot(ell[2:], -2*lnPW[2:], color=cm2(i/num), lw=lw)
     ax.set_xlabel(r'$\ell$')
     ax.set_ylabel(r'$\chi^2_\mathrm{eff,\ell}$')
@@ -951,24 +922,12 @@ if __name__ == '__main__':
     n_theta = 251
     fig5(n_theta, n_realizations)
 
-    print('2,9')
-    fig3(zre=zre, lmin=2, lmax=9, ntests=0)
-    print('10,19')
-    fig3(zre=zre, lmin=10, lmax=19, ntests=0)
-    print('20,29')
-    fig3(zre=zre, lmin=20, lmax=29, ntests=0)
-    print('30,99')
-    fig3(zre=zre, lmin=30, lmax=99, ntests=0)
-    print('2,99')
-    fig3(zre=zre, lmin=2, lmax=99, ntests=0)
-
-    print('2,9')
-    fig3_taus(zre=zre, lmin=2, lmax=9, ntests=0)
-    print('10,19')
-    fig3_taus(zre=zre, lmin=10, lmax=19, ntests=0)
-    print('20,29')
-    fig3_taus(zre=zre, lmin=20, lmax=29, ntests=0)
-    print('30,99')
-    fig3_taus(zre=zre, lmin=30, lmax=99, ntests=0)
-    print('2,99')
-    fig3_taus(zre=zre, lmin=2, lmax=99, ntests=0)
+    # fig3 and fig3_taus look up every ell range in the same Fisher matrices
+    result = fig3_result(zre=zre, lmax=99)
+    result_taus = fig3_result(zre=zre, lmax=99, tau_vars=True)
+    for lmin, lmax in [(2, 9), (10, 19), (20, 29), (30, 99), (2, 99)]:
+        print('{0},{1}'.format(lmin, lmax))
+        fig3(zre=zre, lmin=lmin, lmax=lmax, ntests=0, result=result)
+    for lmin, lmax in [(2, 9), (10, 19), (20, 29), (30, 99), (2, 99)]:
+        print('{0},{1}'.format(lmin, lmax))
+        fig3_taus(zre=zre, lmin=lmin, lmax=lmax, ntests=0, result=result_taus)
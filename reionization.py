@@ -0,0 +1,320 @@
+'''
+Pure NumPy version of the reionization histories and optical depths that we
+otherwise get from a CLASS thermodynamics table.
+
+The ionization fraction follows CLASS's reio_many_tanh and reio_camb
+parametrizations exactly (thermodynamics.c, thermodynamics_reionization_function),
+and dtau/dz comes from a flat LCDM background with the same constants as
+CLASS. Everything is vectorized over a batch of models, so tau, tau_lo,
+tau_hi and the visibility for thousands of chain samples take a fraction of a
+second instead of one CLASS run each.
+
+The only thing that is not computed here is the residual ionization left over
+from recombination, which sets x_e before reionization starts. By default it
+is a fit to CLASS for the Planck 2018 cosmology used in tools.get_spectra,
+good to 0.2% for 25 < z < 160; recombination_table() gets it from any CLASS
+thermodynamics table instead.
+'''
+import numpy as np
+from scipy.integrate import cumulative_trapezoid
+
+# Same constants as CLASS (background.h, thermodynamics.h)
+_sigma_T = 6.6524616e-29    # Thomson cross-section in m^2
+_m_H = 1.673575e-27         # Hydrogen mass in kg
+_not4 = 3.9715              # Helium to Hydrogen mass ratio
+_G = 6.67428e-11            # m^3/kg/s^2
+_c = 2.99792458e8           # m/s
+_Mpc_over_m = 3.085677581282e22
+_k_B = 1.3806504e-23
+_h_P = 6.62606896e-34
+
+# The Planck baseline cosmology in tools.get_spectra, with the values CLASS
+# derives for it (BBN helium fraction, N_ur = 3.044).
+FIDUCIAL = {
+    'omega_b': 0.02237,
+    'omega_cdm': 0.1200,
+    'H0': 67.36,
+    'T_cmb': 2.7255,
+    'N_ur': 3.044,
+    'YHe': 0.2452741547313311}
+
+# CLASS precision parameter, see precisions.h
+reionization_start_factor = 8.
+
+# log(x_e) as a cubic in log(1+z), fit to the recombination residual from
+# CLASS for FIDUCIAL over 25 < z < 160.
+_xe_rec_fit = np.array([0.01534914, -0.14218859, 0.57234334, -9.32546412])
+
+
+def hubble(z, cosmo=FIDUCIAL):
+    '''
+    H(z) in km/s/Mpc for flat LCDM with photons and massless neutrinos.
+    '''
+    h = cosmo['H0']/100
+    sigma_B = 2*np.pi**5*_k_B**4/(15*_h_P**3*_c**2)
+    rho_crit = 3*(1e5*h/_Mpc_over_m)**2/(8*np.pi*_G)
+    Omega_g = 4*sigma_B/_c**3*cosmo['T_cmb']**4/rho_crit
+    Omega_r = Omega_g*(1 + cosmo['N_ur']*7/8*(4/11)**(4/3))
+    Omega_m = (cosmo['omega_b'] + cosmo['omega_cdm'])/h**2
+    Omega_L = 1 - Omega_m - Omega_r
+    return cosmo['H0']*np.sqrt(Omega_r*(1+z)**4 + Omega_m*(1+z)**3 + Omega_L)
+
+
+def helium_fraction(cosmo=FIDUCIAL):
+    '''
+    n_He/n_H, which sets x_e after the first (f) and second (2f) helium
+    reionization.
+    '''
+    return cosmo['YHe']/(_not4*(1-cosmo['YHe']))
+
+
+def dkappa_dz(z, cosmo=FIDUCIAL):
+    '''
+    dtau/dz for x_e = 1, i.e. sigma_T n_H(z) c / ((1+z) H(z)).
+    '''
+    h = cosmo['H0']/100
+    rho_b = 3*(1e5*h/_Mpc_over_m)**2/(8*np.pi*_G)*cosmo['omega_b']/h**2
+    n_H0 = (1-cosmo['YHe'])*rho_b/_m_H
+    return _sigma_T*n_H0*(1+z)**2*_c/(1e3*hubble(z, cosmo))*_Mpc_over_m
+
+
+def dkappa_deta(z, cosmo=FIDUCIAL):
+    '''
+    CLASS's kappa' = a n_H sigma_T in Mpc^-1, again for x_e = 1.
+    '''
+    h = cosmo['H0']/100
+    rho_b = 3*(1e5*h/_Mpc_over_m)**2/(8*np.pi*_G)*cosmo['omega_b']/h**2
+    n_H0 = (1-cosmo['YHe'])*rho_b/_m_H
+    return _sigma_T*n_H0*(1+z)**2*_Mpc_over_m
+
+
+def xe_recombination(z):
+    '''
+    Residual ionization from recombination, fit to CLASS for FIDUCIAL.
+    '''
+    return np.exp(np.polyval(_xe_rec_fit, np.log(1+z)))
+
+
+def recombination_table(thermo, zmin=None):
+    '''
+    Returns a function x_e(z) that interpolates the recombination history in a
+    CLASS thermodynamics table, for use as xe_rec. Points below zmin are
+    dropped; only the part of the table above the start of reionization
+    should be used, so pick a model whose reionization starts below the z
+    range you need.
+    '''
+    z, x_e = np.asarray(thermo['z']), np.asarray(thermo['x_e'])
+    if zmin is not None:
+        inds = (z >= zmin)
+        z, x_e = z[inds], x_e[inds]
+    lnz, lnx = np.log(1+z), np.log(x_e)
+    return lambda zz: np.exp(np.interp(np.log(1+zz), lnz, lnx))
+
+
+def _column(x):
+    return np.atleast_1d(np.asarray(x, dtype=float))[:, None]
+
+
+def xe_many_tanh(z, zre, x_e, dz=0.5, z_t=28, zstartmax=50, cosmo=FIDUCIAL,
+        xe_rec=xe_recombination):
+    '''
+    x_e(z) for the three-step reio_many_tanh history in tools.get_spectra:
+    jumps at z = 3.5 (second helium), zre (hydrogen and first helium) and z_t
+    (up to x_e), all of width dz.
+
+    zre, x_e, dz and z_t can be scalars or arrays of the same length n; the
+    output has shape (n, len(z)).
+    '''
+    z = np.asarray(z, dtype=float)[None, :]
+    zre, x_e, dz, z_t = np.broadcast_arrays(_column(zre), _column(x_e),
+            _column(dz), _column(z_t))
+    n = zre.shape[0]
+    fHe = helium_fraction(cosmo)
+    # Same clamp as tools.get_spectra
+    x_t = np.maximum(x_e, 2e-4)
+
+    centers = [np.full((n, 1), 3.5), zre, z_t]
+    xes = [np.full((n, 1), 1+2*fHe), np.full((n, 1), 1+fHe), x_t]
+    z_start = z_t + reionization_start_factor*dz
+    if np.any(z_start > zstartmax):
+        raise ValueError('starting redshift for reionization > '
+                'reionization_z_start_max = {0}'.format(zstartmax))
+    z_first = np.maximum(3.5 - reionization_start_factor*dz, 0)
+    xe_before = xe_rec(z_start)
+
+    xe = np.broadcast_to(xe_before, (n, z.shape[1])).copy()
+    xes.append(xe_before)
+    for k in range(3):
+        xe += (xes[k] - xes[k+1])*(1 - np.tanh((z - centers[k])/dz))/2
+    xe = np.where(z > z_start, xe_rec(z), xe)
+    xe = np.where(z <= z_first, xes[0], xe)
+    return xe
+
+
+def xe_camb(z, z_reio, dz=0.5, zstartmax=50, cosmo=FIDUCIAL,
+        xe_rec=xe_recombination, exponent=1.5, helium_z=3.5, helium_dz=0.5):
+    '''
+    x_e(z) for CLASS's reio_camb history (tools.get_spectra_simple, and the
+    default history behind tau_reio), tanh in (1+z)^1.5 with width dz.
+
+    z_reio and dz can be scalars or arrays of length n; the output has shape
+    (n, len(z)).
+    '''
+    z = np.asarray(z, dtype=float)[None, :]
+    z_reio, dz = np.broadcast_arrays(_column(z_reio), _column(dz))
+    fHe = helium_fraction(cosmo)
+    z_start = np.maximum(z_reio + reionization_start_factor*dz,
+            helium_z + reionization_start_factor*helium_dz)
+    if np.any(z_start > zstartmax):
+        raise ValueError('starting redshift for reionization > '
+                'reionization_z_start_max = {0}'.format(zstartmax))
+    xe_before = xe_rec(z_start)
+
+    arg = ((1+z_reio)**exponent - (1+z)**exponent)/(exponent*
+            (1+z_reio)**(exponent-1))/dz
+    xe = (1+fHe - xe_before)*(np.tanh(arg)+1)/2 + xe_before
+    xe += fHe*(np.tanh((helium_z - z)/helium_dz)+1)/2
+    return np.where(z > z_start, xe_rec(z), xe)
+
+
+def default_z(zmax=100, zstartmax=50, dz=0.005):
+    '''
+    Redshift grid that resolves tanh steps of width >~ 0.05 below zstartmax,
+    and is coarser above it, where x_e only follows recombination.
+    '''
+    lo = np.arange(0, zstartmax+dz/2, dz)
+    hi = np.linspace(zstartmax, max(zmax, zstartmax), 201)[1:]
+    return np.concatenate((lo, hi))
+
+
+def tau_z(z, xe, cosmo=FIDUCIAL, xmin=0):
+    '''
+    Cumulative optical depth tau(<z), shape (n, len(z)). Points with
+    x_e <= xmin are left out of the integral, like in tools.get_tau.
+    '''
+    integrand = np.where(xe > xmin, xe, 0)*dkappa_dz(z, cosmo)
+    return cumulative_trapezoid(integrand, x=z, axis=-1, initial=0)
+
+
+def visibility(z, xe, cosmo=FIDUCIAL):
+    '''
+    Visibility function g = kappa' exp(-kappa) in Mpc^-1, the same as the
+    'g [Mpc^-1]' column of a CLASS thermodynamics table.
+    '''
+    kappa = tau_z(z, xe, cosmo)
+    return xe*dkappa_deta(z, cosmo)*np.exp(-kappa)
+
+
+def _at(z, f, z0):
+    # Row-by-row linear interpolation of f (n, len(z)) at z0 (n,)
+    i = np.clip(np.searchsorted(z, z0) - 1, 0, len(z)-2)
+    rows = np.arange(len(z0))
+    w = (z0 - z[i])/(z[i+1] - z[i])
+    return f[rows, i]*(1-w) + f[rows, i+1]*w
+
+
+def optical_depths(z, xe, cosmo=FIDUCIAL, zmax=100, xmin=2e-4, zsplit=False):
+    '''
+    Returns zsplit, tau_lo, tau_hi and tau for a batch of histories xe on the
+    redshift grid z, with the same definitions as tools.get_twotau and
+    tools.get_tau: zsplit = 1 + the lowest z where x_e drops below 0.5,
+    tau_lo is the optical depth below zsplit and tau_hi between zsplit and
+    zmax, leaving out x_e <= xmin.
+
+    Unlike the CLASS versions, the crossing and the integration limits are
+    interpolated instead of snapped to the nearest grid point, so these are
+    smooth functions of the parameters and can be differentiated numerically.
+    '''
+    z = np.asarray(z, dtype=float)
+    xe = np.atleast_2d(xe)
+    n = xe.shape[0]
+    tau = tau_z(z, xe, cosmo, xmin=xmin)
+    if zsplit is False:
+        below = (xe < 0.5)
+        i = np.argmax(below, axis=1)
+        i = np.maximum(i, 1)
+        rows = np.arange(n)
+        x0, x1 = xe[rows, i-1], xe[rows, i]
+        w = (x0 - 0.5)/(x0 - x1)
+        zre = z[i-1] + w*(z[i] - z[i-1])
+        zsplit = 1 + zre
+    else:
+        zsplit = np.full(n, float(zsplit))
+    tau_lo = _at(z, tau, zsplit)
+    tau_tot = _at(z, tau, np.full(n, float(zmax)))
+    return zsplit, tau_lo, tau_tot - tau_lo, tau_tot
+
+
+def many_tanh_taus(zre, x_e, dz=0.5, z_t=28, zstartmax=50, zmax=100,
+        xmin=2e-4, zsplit=False, cosmo=FIDUCIAL, xe_rec=xe_recombination):
+    '''
+    zsplit, tau_lo, tau_hi and tau for a batch of reio_many_tanh models, the
+    vectorized equivalent of get_twotau(get_spectra(zre, x_e, therm=True)).
+    '''
+    z = default_z(zmax=zmax, zstartmax=zstartmax)
+    xe = xe_many_tanh(z, zre, x_e, dz=dz, z_t=z_t, zstartmax=zstartmax,
+            cosmo=cosmo, xe_rec=xe_rec)
+    return optical_depths(z, xe, cosmo=cosmo, zmax=zmax, xmin=xmin,
+            zsplit=zsplit)
+
+
+def camb_taus(z_reio, dz=0.5, zstartmax=50, zmax=100, xmin=2e-4,
+        zsplit=False, cosmo=FIDUCIAL, xe_rec=xe_recombination):
+    '''
+    zsplit, tau_lo, tau_hi and tau for a batch of reio_camb models.
+    '''
+    z = default_z(zmax=zmax, zstartmax=zstartmax)
+    xe = xe_camb(z, z_reio, dz=dz, zstartmax=zstartmax, cosmo=cosmo,
+            xe_rec=xe_rec)
+    return optical_depths(z, xe, cosmo=cosmo, zmax=zmax, xmin=xmin,
+            zsplit=zsplit)
+
+
+def test_against_class(zres=[6, 7, 8.5], xes=[0, 0.05, 0.2], rtol=2e-3):
+    '''
+    Regression test against the CLASS thermodynamics for a few many_tanh
+    models, and reio_camb models (tools.get_spectra_simple) with z_reio in
+    zres: x_e(z), the visibility below z = 50, and tau, tau_lo and tau_hi.
+    '''
+    from tools import get_spectra, get_spectra_simple, get_tau, get_twotau
+
+    def check(label, thermo, xe_z, tau_lo, tau_hi, tau):
+        z = thermo['z']
+        inds = (z < 50)
+        xe = xe_z(z[inds])
+        g = visibility(z[inds], xe)[0]
+        xe = xe[0]
+        dxe = np.max(np.abs(xe - thermo['x_e'][inds]))
+        dg = np.max(np.abs(g - thermo['g [Mpc^-1]'][inds]))/np.max(g)
+        zs, lo, hi = get_twotau(thermo)
+        tau_class = get_tau(thermo)
+        print('{0}: max |dx_e|={1:.1e}, max |dg|/g_max={2:.1e}, '
+                'dtau/tau={3:.1e}, dtau_lo/tau={4:.1e}, dtau_hi/tau={5:.1e}'.format(
+                    label, dxe, dg, tau/tau_class-1, (tau_lo-lo)/tau_class,
+                    (tau_hi-hi)/tau_class))
+        assert dxe < 1e-3
+        assert dg < 1e-2
+        assert abs(tau/tau_class-1) < rtol
+        assert abs(tau_lo-lo) < rtol*tau_class
+        assert abs(tau_hi-hi) < rtol*tau_class
+
+    z_reios = np.array(zres, dtype=float)
+    zres, xes = np.meshgrid(zres, xes)
+    zres, xes = zres.flatten(), xes.flatten()
+    zsplit, tau_lo, tau_hi, tau = many_tanh_taus(zres, xes)
+    for i in range(len(zres)):
+        check('many_tanh zre={0} x_e={1}'.format(zres[i], xes[i]),
+                get_spectra(zres[i], xes[i], therm=True),
+                lambda z: xe_many_tanh(z, zres[i], xes[i]), tau_lo[i],
+                tau_hi[i], tau[i])
+    zsplit, tau_lo, tau_hi, tau = camb_taus(z_reios)
+    for i in range(len(z_reios)):
+        # x_e is not used by reio_camb
+        check('camb z_reio={0}'.format(z_reios[i]),
+                get_spectra_simple(z_reios[i], 0, therm=True),
+                lambda z: xe_camb(z, z_reios[i]), tau_lo[i], tau_hi[i],
+                tau[i])
+    return
+
+if __name__ == '__main__':
+    test_against_class()
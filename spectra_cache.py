@@ -0,0 +1,459 @@
+'''
+Persistent on-disk cache for CLASS outputs.
+
+Every CLASS run is keyed by a hash of the full parameter dict that was handed
+to CLASS, plus anything else that changes the output (e.g. the A_s rescaling)
+and the classy version. The lensed spectra and the thermodynamics table are
+stored as one .npz file per key, so any process (notebook kernels, MPI ranks,
+reruns of paper_analysis.py) can reuse a model that has been computed before.
+
+The cache lives in $LOW_ELL_CACHE_DIR, or ~/.cache/low-ell-reionization if that
+is not set. Setting LOW_ELL_CACHE_DISABLE=1 turns it off.
+
+Run `python spectra_cache.py -h` to inspect, warm or prune the cache.
+'''
+import os
+import sys
+import json
+import time
+import hashlib
+import inspect
+import argparse
+import threading
+import functools
+import contextlib
+from collections import OrderedDict, namedtuple
+import numpy as np
+
+
+CACHE_DIR = os.environ.get('LOW_ELL_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'low-ell-reionization'))
+ENABLED = os.environ.get('LOW_ELL_CACHE_DISABLE', '0') != '1'
+# Floats are rounded to this many significant digits before they are used as
+# keys (and before they are handed to CLASS), so that e.g. 7.000000000001 and
+# 7.0 share an entry.
+KEY_DIGITS = int(os.environ.get('LOW_ELL_CACHE_DIGITS', '10'))
+# Upper limit for the in-memory caches of each process. A ClassResult is
+# about 3.5 MB, almost all of it the thermodynamics table.
+MEMORY_LIMIT_MB = float(os.environ.get('LOW_ELL_MEMORY_MB', '1000'))
+
+
+def classy_version():
+    try:
+        import classy
+    except ImportError:
+        return 'none'
+    return str(getattr(classy, '__version__', 'unknown'))
+
+
+def quantize(value, digits=None):
+    '''
+    Rounds floats to digits (by default KEY_DIGITS) significant digits.
+    Anything else, including ints and bools, is returned unchanged.
+    '''
+    if isinstance(value, (float, np.floating)):
+        if digits is None:
+            digits = KEY_DIGITS
+        return float('{0:.{1}e}'.format(value, digits-1))
+    return value
+
+
+def _canonical(value):
+    # json can't serialize numpy scalars, and we want 7 and 7.0 to hash the
+    # same way since CLASS reads them identically.
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return quantize(float(value))
+    if isinstance(value, np.ndarray):
+        return [_canonical(v) for v in value.tolist()]
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if value is None:
+        return None
+    return str(value)
+
+
+def params_key(params, **extra):
+    '''
+    Hash of a CLASS params dict, anything else that affects the output (passed
+    as keyword arguments) and the classy version.
+    '''
+    blob = {'params': _canonical(params),
+            'extra': _canonical(extra),
+            'classy': classy_version()}
+    s = json.dumps(blob, sort_keys=True)
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+def _path(key):
+    return os.path.join(CACHE_DIR, key[:2], key + '.npz')
+
+
+def load(key):
+    '''
+    Returns a dict with 'cls', 'thermo', 'T_cmb' and 'params' for a cached
+    entry, or None if the key has not been computed yet.
+    '''
+    if not ENABLED:
+        return None
+    path = _path(key)
+    try:
+        with np.load(path, allow_pickle=False) as f:
+            cls, thermo = {}, {}
+            for name in f.files:
+                if name.startswith('cl:'):
+                    cls[name[3:]] = f[name]
+                elif name.startswith('th:'):
+                    thermo[name[3:]] = f[name]
+            T_cmb = float(f['T_cmb'])
+            params = json.loads(str(f['params']))
+    except (IOError, OSError, ValueError, KeyError):
+        # Missing, or partially written by a process that died.
+        return None
+    # Touch the file so that pruning drops the least recently used entries.
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return {'cls': cls, 'thermo': thermo, 'T_cmb': T_cmb, 'params': params}
+
+
+def save(key, params, cls, thermo, T_cmb):
+    if not ENABLED:
+        return
+    path = _path(key)
+    arrays = {}
+    if cls is not None:
+        for name, arr in cls.items():
+            arrays['cl:' + name] = np.asarray(arr)
+    if thermo is not None:
+        for name, arr in thermo.items():
+            arrays['th:' + name] = np.asarray(arr)
+    arrays['T_cmb'] = np.array(T_cmb)
+    arrays['params'] = np.array(json.dumps(_canonical(params), sort_keys=True))
+    # Write to a temporary file and move it into place, so that concurrent MPI
+    # ranks never see a half-written entry.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp, path)
+    except OSError:
+        # A read-only or full disk shouldn't stop a computation.
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize',
+    'nbytes', 'maxbytes'])
+
+
+def sizeof(value):
+    '''
+    Memory held by a cached value in bytes, as far as we can tell: its nbytes
+    if it has one (numpy arrays, ClassResult), or the sum over a tuple, list
+    or dict of them.
+    '''
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if isinstance(value, (tuple, list)):
+        return sum(sizeof(v) for v in value)
+    if isinstance(value, dict):
+        return sum(sizeof(v) for v in value.values())
+    return sys.getsizeof(value)
+
+
+class MemoryCache(object):
+    '''
+    In-memory least-recently-used cache in front of a function, like
+    functools.lru_cache. The differences are that the key is the full set of
+    arguments with the defaults filled in, so f(7, 0) and f(7, x_e=0) share an
+    entry, and that results computed somewhere else (e.g. in a process pool)
+    can be added with insert().
+
+    Least recently used entries are dropped when there are more than maxsize
+    of them, or when together they take up more than maxbytes (see sizeof).
+
+    canonical, if given, maps the dict of arguments to the arguments that
+    are actually used, both for the key and for calling func. By default
+    floats are quantized to KEY_DIGITS significant digits.
+
+    tolerance can be set to a dict of absolute tolerances for some of the
+    arguments, e.g. {'zreio': 1e-3, 'x_e': 1e-4}. A call that misses the
+    cache then returns the closest cached result whose arguments are all
+    within tolerance (and equal for the rest) instead of computing a new one.
+    This is meant for MCMC, where the likelihood doesn't change appreciably
+    within the tolerance; see also approximate().
+
+    reuse, if given, is called as reuse(cached_args, cached_value, args) for
+    the cached entries on a miss, and can return a value that serves args from
+    a cached result (e.g. one that has more outputs than were asked for), or
+    None. Values it returns are not stored again.
+    '''
+    def __init__(self, func, maxsize=128, maxbytes=None, canonical=None,
+            reuse=None):
+        self.func = func
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizes = {}
+        self.nbytes = 0
+        self.signature = inspect.signature(func)
+        if canonical is None:
+            canonical = lambda args: {k: quantize(v) for k, v in args.items()}
+        self.canonical = canonical
+        self.reuse = reuse
+        self.tolerance = None
+        self.data = OrderedDict()
+        self.hits = 0
+        self.approx_hits = 0
+        self.reused = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        functools.update_wrapper(self, func)
+
+    def arguments(self, *args, **kwargs):
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return self.canonical(dict(bound.arguments))
+
+    def key(self, *args, **kwargs):
+        return tuple(self.arguments(*args, **kwargs).items())
+
+    def _nearest(self, key):
+        # Closest cached key within tolerance, or None
+        best, dmin = None, np.inf
+        for k in self.data:
+            d = 0
+            for (name, a), (_, b) in zip(key, k):
+                if name in self.tolerance:
+                    d = max(d, abs(a - b)/self.tolerance[name])
+                elif a != b:
+                    d = np.inf
+                if d > 1:
+                    break
+            if d <= 1 and d < dmin:
+                best, dmin = k, d
+        return best
+
+    def __call__(self, *args, **kwargs):
+        arguments = self.arguments(*args, **kwargs)
+        key = tuple(arguments.items())
+        with self.lock:
+            if key in self.data:
+                self.hits += 1
+                self.data.move_to_end(key)
+                return self.data[key]
+            if self.tolerance:
+                near = self._nearest(key)
+                if near is not None:
+                    self.hits += 1
+                    self.approx_hits += 1
+                    self.data.move_to_end(near)
+                    return self.data[near]
+            if self.reuse is not None:
+                for k in reversed(self.data):
+                    value = self.reuse(dict(k), self.data[k], arguments)
+                    if value is not None:
+                        self.hits += 1
+                        self.reused += 1
+                        self.data.move_to_end(k)
+                        return value
+            self.misses += 1
+        value = self.func(**arguments)
+        self._store(key, value)
+        return value
+
+    def _store(self, key, value):
+        with self.lock:
+            if key in self.data:
+                self.nbytes -= self.sizes[key]
+            self.data[key] = value
+            self.sizes[key] = sizeof(value)
+            self.nbytes += self.sizes[key]
+            self.data.move_to_end(key)
+            # Never drop the entry that was just added
+            while len(self.data) > 1 and (
+                    (self.maxsize is not None and len(self.data) > self.maxsize)
+                    or (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+                old, _ = self.data.popitem(last=False)
+                self.nbytes -= self.sizes.pop(old)
+
+    def insert(self, value, *args, **kwargs):
+        '''
+        Stores value as the result of func(*args, **kwargs).
+        '''
+        self._store(self.key(*args, **kwargs), value)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.data),
+                self.nbytes, self.maxbytes)
+
+    def cache_clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.nbytes = 0
+            self.hits = self.approx_hits = self.reused = self.misses = 0
+
+
+def memory_cache(maxsize=128, maxbytes=None, canonical=None, reuse=None):
+    '''
+    Decorator version of MemoryCache.
+    '''
+    return lambda func: MemoryCache(func, maxsize=maxsize, maxbytes=maxbytes,
+            canonical=canonical, reuse=reuse)
+
+
+@contextlib.contextmanager
+def approximate(cache, **tolerance):
+    '''
+    Turns on approximate hits for a MemoryCache inside a with block, e.g.
+
+        with approximate(compute_model, zreio=1e-3, x_e=1e-4):
+            sampler.run_mcmc(...)
+    '''
+    old = cache.tolerance
+    cache.tolerance = tolerance
+    try:
+        yield cache
+    finally:
+        cache.tolerance = old
+
+
+def entries():
+    '''
+    Returns a list of (path, size in bytes, last access time) for every entry.
+    '''
+    out = []
+    if not os.path.isdir(CACHE_DIR):
+        return out
+    for sub in sorted(os.listdir(CACHE_DIR)):
+        d = os.path.join(CACHE_DIR, sub)
+        if not os.path.isdir(d):
+            continue
+        for name in os.listdir(d):
+            if not name.endswith('.npz'):
+                continue
+            path = os.path.join(d, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            out.append((path, st.st_size, st.st_mtime))
+    return out
+
+
+def info(verbose=False):
+    e = entries()
+    size = sum(s for _, s, _ in e)
+    print('cache directory: {0}'.format(CACHE_DIR))
+    print('classy version:  {0}'.format(classy_version()))
+    print('entries:         {0}'.format(len(e)))
+    print('total size:      {0:.1f} MB'.format(size/1e6))
+    if len(e) > 0:
+        times = [t for _, _, t in e]
+        print('oldest access:   {0}'.format(time.ctime(min(times))))
+        print('newest access:   {0}'.format(time.ctime(max(times))))
+    if verbose:
+        for path, s, t in sorted(e, key=lambda x: x[2]):
+            with np.load(path, allow_pickle=False) as f:
+                params = json.loads(str(f['params']))
+            reio = {k: v for k, v in params.items() if ('reio' in k) or
+                    ('tanh' in k) or (k in ['r', 'l_max_scalars'])}
+            print(os.path.basename(path)[:12], '{0:8.1f} kB'.format(s/1e3),
+                    time.ctime(t), reio)
+    return len(e), size
+
+
+def prune(max_age_days=None, max_size_mb=None, dry_run=False):
+    '''
+    Removes entries that have not been used for max_age_days, then the least
+    recently used entries until the cache is smaller than max_size_mb.
+    Returns the number of entries removed.
+    '''
+    e = sorted(entries(), key=lambda x: x[2])
+    remove = []
+    if max_age_days is not None:
+        cutoff = time.time() - max_age_days*86400
+        remove += [x for x in e if x[2] < cutoff]
+        e = [x for x in e if x[2] >= cutoff]
+    if max_size_mb is not None:
+        size = sum(s for _, s, _ in e)
+        while (len(e) > 0) and (size > max_size_mb*1e6):
+            x = e.pop(0)
+            size -= x[1]
+            remove.append(x)
+    for path, _, _ in remove:
+        if dry_run:
+            print('would remove', path)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return len(remove)
+
+
+def warm(zres, xes, dz=0.5, z_t=28, lmax=100, r=0, workers=None):
+    '''
+    Computes get_spectra over a (zre, x_e) grid, on workers processes, so that
+    later runs only have to load the results.
+    '''
+    from tools import get_spectra_many
+    t0 = time.time()
+    params = [(zre, x_e, dz, z_t) for zre in zres for x_e in xes]
+    get_spectra_many(params, workers=workers, lmax=lmax, r=r, verbose=True)
+    print('{0} models in {1:.1f} s'.format(len(params), time.time()-t0))
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect, warm or prune the '
+            'on-disk CLASS cache.')
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('info', help='summarize the cache')
+    p.add_argument('-v', '--verbose', action='store_true',
+            help='list every entry')
+
+    p = sub.add_parser('prune', help='remove old entries')
+    p.add_argument('--days', type=float, default=None,
+            help='remove entries not used for this many days')
+    p.add_argument('--max-mb', type=float, default=None,
+            help='then remove least recently used entries down to this size')
+    p.add_argument('--dry-run', action='store_true')
+
+    p = sub.add_parser('warm', help='compute a (zre, x_e) grid of models')
+    p.add_argument('--zre', type=float, nargs=3, default=[6, 10, 9],
+            metavar=('MIN', 'MAX', 'NUM'))
+    p.add_argument('--xe', type=float, nargs=3, default=[0, 0.2, 5],
+            metavar=('MIN', 'MAX', 'NUM'))
+    p.add_argument('--dz', type=float, default=0.5)
+    p.add_argument('--zt', type=float, default=28)
+    p.add_argument('--lmax', type=int, default=100)
+    p.add_argument('--r', type=float, default=0)
+    p.add_argument('--workers', type=int, default=None,
+            help='number of processes (default: all cores)')
+
+    args = parser.parse_args()
+    if args.command == 'info':
+        info(verbose=args.verbose)
+    elif args.command == 'prune':
+        n = prune(max_age_days=args.days, max_size_mb=args.max_mb,
+                dry_run=args.dry_run)
+        print('removed {0} entries'.format(n))
+    elif args.command == 'warm':
+        zres = np.linspace(args.zre[0], args.zre[1], int(args.zre[2]))
+        xes = np.linspace(args.xe[0], args.xe[1], int(args.xe[2]))
+        warm(zres, xes, dz=args.dz, z_t=args.zt, lmax=args.lmax, r=args.r,
+                workers=args.workers)
+    else:
+        parser.print_help()
+        sys.exit(1)
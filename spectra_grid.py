@@ -0,0 +1,258 @@
+'''
+A dense (zre, x_e) grid of get_spectra models stored as memory-mapped .npy
+files, with bicubic lookup in between the grid points.
+
+    python spectra_grid.py build grid_dir --zre 6 9 61 --xe 0 0.1 41
+
+computes TT, EE, TE, BB (in uK^2, ell = 0..lmax) and tau, tau_lo, tau_hi for
+every grid point with CLASS, and can be stopped and restarted at any time.
+Afterwards
+
+    grid = SpectraGrid('grid_dir')
+    ell, EE, TE, TT = grid.get_spectra(7.3, 0.02, spectra=True, all_spectra=True)
+    lnprob_wish_ell(7.3, 0.02, Clhat, backend=grid)
+
+only reads the 4x4 block of grid points around each requested model from
+disk, so any number of processes can share one grid.
+
+The interpolation is Keys' cubic convolution (a = -1/2) on the regular grid,
+which is exact for quadratics and has a continuous first derivative. At the
+edges of the grid the missing points are extrapolated with Keys' boundary
+condition, so there is no loss of accuracy at the boundary.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from numpy.lib.format import open_memmap
+
+SPECTRA = ['TT', 'EE', 'TE', 'BB']
+TAUS = ['tau', 'tau_lo', 'tau_hi']
+
+
+def _files(path):
+    return {'meta': os.path.join(path, 'meta.json'),
+            'spectra': os.path.join(path, 'spectra.npy'),
+            'taus': os.path.join(path, 'taus.npy'),
+            'done': os.path.join(path, 'done.npy')}
+
+
+def build(path, zres, xes, lmax=100, dz=0.5, z_t=28, verbose=True):
+    '''
+    Fills the grid zres x xes in the directory path. zres and xes have to be
+    evenly spaced with at least 4 points each. If the directory already holds
+    a grid with the same settings, only the missing points are computed.
+    '''
+    from tools import get_model
+    zres, xes = np.asarray(zres, dtype=float), np.asarray(xes, dtype=float)
+    for name, x in [('zres', zres), ('xes', xes)]:
+        if len(x) < 4:
+            raise ValueError('{0} needs at least 4 points'.format(name))
+        if not np.allclose(np.diff(x), x[1]-x[0]):
+            raise ValueError('{0} has to be evenly spaced'.format(name))
+    meta = {'zre': [zres[0], zres[-1], len(zres)],
+            'x_e': [xes[0], xes[-1], len(xes)],
+            'lmax': lmax, 'dz': dz, 'z_t': z_t}
+    f = _files(path)
+    shape = (len(zres), len(xes))
+    if os.path.exists(f['meta']):
+        with open(f['meta']) as fp:
+            old = json.load(fp)
+        if old != json.loads(json.dumps(meta)):
+            raise ValueError('{0} already holds a different grid: {1}'.format(
+                path, old))
+        spectra = open_memmap(f['spectra'], mode='r+')
+        taus = open_memmap(f['taus'], mode='r+')
+        done = open_memmap(f['done'], mode='r+')
+    else:
+        os.makedirs(path, exist_ok=True)
+        spectra = open_memmap(f['spectra'], mode='w+', dtype=np.float64,
+                shape=shape + (len(SPECTRA), lmax+1))
+        taus = open_memmap(f['taus'], mode='w+', dtype=np.float64,
+                shape=shape + (len(TAUS),))
+        done = open_memmap(f['done'], mode='w+', dtype=bool, shape=shape)
+        # Written last, so that a grid without meta.json is never opened
+        with open(f['meta'], 'w') as fp:
+            json.dump(meta, fp)
+
+    todo = np.argwhere(~done)
+    t0 = time.time()
+    for k, (i, j) in enumerate(todo):
+        result = get_model(zres[i], xes[j], dz=dz, z_t=z_t, lmax=lmax)
+        spectra[i, j] = [getattr(result, s) for s in SPECTRA]
+        taus[i, j] = [result.tau, result.tau_lo, result.tau_hi]
+        spectra.flush()
+        taus.flush()
+        done[i, j] = True
+        done.flush()
+        if verbose:
+            print('{0}/{1} zre={2:.4f} x_e={3:.4f} {4:.1f} s'.format(k+1,
+                len(todo), zres[i], xes[j], time.time()-t0))
+    return
+
+
+def _keys_weights(x, x0, dx, n):
+    '''
+    Indices and weights of the 4 grid points that Keys' cubic convolution uses
+    for each x, with the out-of-range points folded back into the grid using
+    f_{-1} = 3f_0 - 3f_1 + f_2 (and the same at the upper end).
+    '''
+    u = (x - x0)/dx
+    i = np.clip(np.floor(u).astype(int), 0, n-2)
+    t = u - i
+    w = np.stack([((-t + 2)*t - 1)*t/2,
+                  ((3*t - 5)*t*t + 2)/2,
+                  ((-3*t + 4)*t + 1)*t/2,
+                  (t - 1)*t*t/2], axis=-1)
+    idx = i[:, None] + np.arange(-1, 3)
+    lo = (i == 0)
+    if np.any(lo):
+        g = w[lo, 0]
+        w[lo] = np.stack([w[lo, 1] + 3*g, w[lo, 2] - 3*g, w[lo, 3] + g,
+            0*g], axis=-1)
+        idx[lo] = np.arange(4)
+    hi = (i == n-2)
+    if np.any(hi):
+        g = w[hi, 3]
+        w[hi] = np.stack([0*g, w[hi, 0] + g, w[hi, 1] - 3*g,
+            w[hi, 2] + 3*g], axis=-1)
+        idx[hi] = np.arange(n-4, n)
+    return idx, w
+
+
+class SpectraGrid(object):
+    '''
+    Read-only view of a grid made by build(). Nothing is loaded into memory
+    until it is interpolated.
+    '''
+    def __init__(self, path):
+        self.path = path
+        f = _files(path)
+        with open(f['meta']) as fp:
+            self.meta = json.load(fp)
+        self.lmax = self.meta['lmax']
+        self.zres = np.linspace(*self.meta['zre'])
+        self.xes = np.linspace(*self.meta['x_e'])
+        self.spectra = np.load(f['spectra'], mmap_mode='r')
+        self.taus = np.load(f['taus'], mmap_mode='r')
+        done = np.load(f['done'], mmap_mode='r')
+        if not np.all(done):
+            raise ValueError('{0} is missing {1} of {2} models, run build() '
+                    'again to finish it'.format(path, np.sum(~done), done.size))
+
+    def __getstate__(self):
+        # memmaps are reopened rather than pickled, e.g. for MPI workers
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def interp(self, arr, zre, x_e):
+        '''
+        Bicubic interpolation of arr (one of self.spectra or self.taus) at
+        each (zre, x_e) pair, shape (n,) + arr.shape[2:].
+        '''
+        zre = np.atleast_1d(np.asarray(zre, dtype=float))
+        x_e = np.atleast_1d(np.asarray(x_e, dtype=float))
+        zre, x_e = np.broadcast_arrays(zre, x_e)
+        for name, x, g in [('zre', zre, self.zres), ('x_e', x_e, self.xes)]:
+            if np.any(x < g[0]) or np.any(x > g[-1]):
+                raise ValueError('{0} is outside the grid range [{1}, '
+                        '{2}]'.format(name, g[0], g[-1]))
+        iz, wz = _keys_weights(zre, self.zres[0], self.zres[1]-self.zres[0],
+                len(self.zres))
+        ix, wx = _keys_weights(x_e, self.xes[0], self.xes[1]-self.xes[0],
+                len(self.xes))
+        # (n, 4, 4, ...) block of grid points around each model
+        block = arr[iz[:, :, None], ix[:, None, :]]
+        return np.einsum('ni,nj,nij...->n...', wz, wx, block)
+
+    def get_taus(self, zre, x_e):
+        '''
+        Returns tau, tau_lo and tau_hi, each with one entry per model.
+        '''
+        return tuple(self.interp(self.taus, zre, x_e).T)
+
+    def get_spectra(self, zreio, x_e, dz=0.5, z_t=28, history=False,
+            spectra=False, both=False, all_spectra=False, lmax=100,
+            therm=False, only_BB=False, r=0, **kwargs):
+        '''
+        Same interface as tools.get_spectra for the spectra of a single model.
+        '''
+        if history or both or therm:
+            raise ValueError('The grid only stores spectra')
+        if (dz != self.meta['dz']) or (z_t != self.meta['z_t']) or (r != 0):
+            raise ValueError('The grid was computed for dz={0}, z_t={1}, '
+                    'r=0'.format(self.meta['dz'], self.meta['z_t']))
+        if lmax > self.lmax:
+            raise ValueError('lmax = {0} is larger than the grid lmax = '
+                    '{1}'.format(lmax, self.lmax))
+        TT, EE, TE, BB = self.interp(self.spectra, zreio, x_e)[0, :, :lmax+1]
+        ell = np.arange(lmax+1)
+        if only_BB:
+            return ell, BB
+        if all_spectra:
+            return ell, EE, TE, TT
+        return ell, EE, TE
+
+
+def test_grid(path, n=5, seed=0):
+    '''
+    Compares the interpolated spectra and optical depths to CLASS at n random
+    points inside the grid.
+    '''
+    from tools import get_model
+    grid = SpectraGrid(path)
+    np.random.seed(seed)
+    zres = np.random.uniform(grid.zres[0], grid.zres[-1], n)
+    xes = np.random.uniform(grid.xes[0], grid.xes[-1], n)
+    taus = grid.interp(grid.taus, zres, xes)
+    spectra = grid.interp(grid.spectra, zres, xes)
+    for k in range(n):
+        exact = get_model(zres[k], xes[k], dz=grid.meta['dz'],
+                z_t=grid.meta['z_t'], lmax=grid.lmax)
+        l = slice(2, grid.lmax+1)
+        err = []
+        for i, s in enumerate(SPECTRA):
+            e = getattr(exact, s)[l]
+            norm = np.sqrt(exact.TT[l]*exact.EE[l]) if s == 'TE' else e
+            err.append(np.max(np.abs(spectra[k, i, l] - e)/norm))
+        dtau = taus[k] - [exact.tau, exact.tau_lo, exact.tau_hi]
+        print('zre={0:.3f} x_e={1:.4f}: max fractional error '.format(zres[k],
+            xes[k]) + ', '.join('{0} {1:.1e}'.format(s, e) for s, e in
+                zip(SPECTRA, err)) + '; dtau, dtau_lo, dtau_hi = ' +
+            ', '.join('{0:.1e}'.format(d) for d in dtau))
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or check a '
+            'memory-mapped (zre, x_e) grid of spectra.')
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('build', help='compute (or finish) a grid')
+    p.add_argument('path')
+    p.add_argument('--zre', type=float, nargs=3, default=[6, 9, 61],
+            metavar=('MIN', 'MAX', 'NUM'))
+    p.add_argument('--xe', type=float, nargs=3, default=[0, 0.1, 41],
+            metavar=('MIN', 'MAX', 'NUM'))
+    p.add_argument('--lmax', type=int, default=100)
+    p.add_argument('--dz', type=float, default=0.5)
+    p.add_argument('--zt', type=float, default=28)
+
+    p = sub.add_parser('test', help='compare a grid to CLASS')
+    p.add_argument('path')
+    p.add_argument('-n', type=int, default=5)
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        zres = np.linspace(args.zre[0], args.zre[1], int(args.zre[2]))
+        xes = np.linspace(args.xe[0], args.xe[1], int(args.xe[2]))
+        build(args.path, zres, xes, lmax=args.lmax, dz=args.dz, z_t=args.zt)
+    elif args.command == 'test':
+        test_grid(args.path, n=args.n)
+    else:
+        parser.print_help()
+        sys.exit(1)
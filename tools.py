@@ -2,17 +2,26 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import healpy as hp
+import os
 import subprocess
+import inspect
+import threading
+import contextlib
 
 from classy import Class
 from scipy.stats import gmean
 from scipy.integrate import trapz, cumtrapz
 from scipy.integrate import quad
+from scipy.interpolate import CubicSpline
 from scipy.special import gammaln, gamma
 
 from scipy.special import kv, kvp
 
-from functools import lru_cache
+import spectra_cache
+import fisher
+
+from types import MappingProxyType
+from functools import lru_cache, cached_property
 # lru_cache can be used as a decorator for functions that need to be called
 # repeatedly with the same expected results, and makes sense for a
 # computationally expensive call.
@@ -126,192 +135,592 @@ def get_twotau(thermo, zmax=100, xmin=2e-4, zsplit=False):
     tau_hi = trapz(integrand[(x_e>xmin) & (z>zsplit) & (z<zmax)], x=eta[(x_e>xmin) & (z>zsplit) & (z<zmax)])
     return zsplit, tau_lo, tau_hi
 
-#@profile
-#@memoize
-@lru_cache(maxsize=2**10)
-def get_spectra(zreio, x_e, dz=0.5, z_t=28, history=False, spectra=False, both=False, 
-                all_spectra=False, lmax=100, therm=False, zstartmax=50,
-                verbose=False, rescale=True, only_BB=False, r=0):
-    if verbose: print(get_spectra.cache_info())
-    cosmo = Class()
+# Parameters that only matter for the spectra. They are dropped for
+# thermodynamics-only runs, so that those are cached independently of lmax, r,
+# A_s and the transfer function precision.
+SPECTRA_PARAMS = ['output', 'modes', 'lensing', 'l_max_scalars', 'delta_l_max',
+        'A_s', 'n_s', 'r', 'hyper_flat_approximation_nu',
+        'transfer_neglect_delta_k_S_t0', 'transfer_neglect_delta_k_S_t1',
+        'transfer_neglect_delta_k_S_t2', 'transfer_neglect_delta_k_S_e',
+        'l_logstep', 'l_linstep', 'k_max_tau0_over_l_max', 'n_t', 'alpha_t']
+
+# The spectra compute_model can be asked for, see its outputs argument
+SPECTRA = ('TT', 'EE', 'TE', 'BB')
+# Tilt (and running) of the tensor spectrum. CLASS's default is the
+# single-field consistency relation n_t = -r/8, which makes BB nonlinear in r
+# (by a factor of 2 at ell = 2 between r = 0.05 and r = 1); with a fixed tilt
+# it is exactly linear, see get_BB.
+TENSOR_TILT = {'n_t': 0., 'alpha_t': 0.}
+
+# If set, every rescale='analytic' run is also computed with the exact two-pass
+# rescaling and the residual is printed, see rescale_residual().
+VALIDATE_ANALYTIC_RESCALE = False
+# Same for lensing='template', which is compared to the fully lensed spectra
+VALIDATE_LENSING_TEMPLATE = False
+
+# Parameters that set the reionization history, see lensing_template
+REIO_PARAMS = ('reio_', 'many_tanh_', 'z_reio', 'reionization_', 'tau_reio',
+        'tol_thermo_integration')
+# k_max for lensing='template' runs, which otherwise lose power in TT when
+# lmax is small. CLASS's default is 1.45.
+TEMPLATE_K_MAX_TAU0_OVER_L_MAX = 10.
+_lensing_templates = {}
+
+class PooledClass(Class):
+    '''
+    Class that counts how many models it has computed. classy also calls
+    compute() itself from e.g. get_thermodynamics(), so only the first call
+    after new parameters or a cleanup is counted.
+    '''
+    ncompute = 0
+    _stale = True
 
-    # The Planck baseline results are TT,TE,EE+lowE+lensing
-    tau0 = 0.0544
-    ln1010A_s = 3.044
-    A_s0 = np.exp(ln1010A_s-10*np.log(10))
-    params = {
-        'modes': 's, t',
-        'output': 'tCl pCl lCl',
-        'l_max_scalars': lmax,
-        'lensing': 'yes',
-        'A_s': A_s0,
-        'n_s': 0.9649,
-        'omega_b': 0.02237,
-        'omega_cdm': 0.1200,
-        'H0': 67.36,
-        'r': r,
-        'reio_parametrization' : 'reio_many_tanh',
-        'many_tanh_num': 3}
+    def set(self, *args, **kwargs):
+        self._stale = True
+        return Class.set(self, *args, **kwargs)
 
-    params['many_tanh_z'] = '3.5,' + str(zreio) +',' + str(z_t)
-    params['many_tanh_xe'] = '-2,-1,'+str(max(x_e, 2e-4))
-    params['many_tanh_width'] = dz
-    params['reionization_z_start_max'] = zstartmax
+    def struct_cleanup(self):
+        self._stale = True
+        return Class.struct_cleanup(self)
 
+    def compute(self, *args, **kwargs):
+        if self._stale:
+            self.ncompute += 1
+            self._stale = False
+        return Class.compute(self, *args, **kwargs)
 
-    
-    params['hyper_flat_approximation_nu'] = 7000. # The higher this is, the more exact
-    params['transfer_neglect_delta_k_S_t0'] = 0.17 # The higher these are, the more exact
-    params['transfer_neglect_delta_k_S_t1'] = 0.05
-    params['transfer_neglect_delta_k_S_t2'] = 0.17
-    params['transfer_neglect_delta_k_S_e'] = 0.13
-    params['delta_l_max'] = 1000 # difference between l_max in unlensed and lensed spectra
-
-
-    # You HAVE TO run struct_cleanup() after every compute step. It adds 20 MB
-    # per compute call otherwise.
-    cosmo.set(params)
-    cosmo.compute()
-    thermo = cosmo.get_thermodynamics()
-    if rescale:
-        tau = get_tau(thermo)
-        params['A_s'] = A_s0*np.exp(-2*tau0)/np.exp(-2*tau)
-        cosmo.struct_cleanup()
+class ClassPool(object):
+    '''
+    Long-lived CLASS instances for this process, handed out one at a time by
+    session() and reset (struct_cleanup and empty) when they come back, so
+    that a process only allocates as many as it uses at once.
+
+    Instances are never shared between processes: after a fork (a
+    multiprocessing worker) the child starts with an empty pool of its own,
+    and MPI ranks are separate processes anyway.
+    '''
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.instances = []
+        self.free = []
+
+    def _acquire(self):
+        with self.lock:
+            if os.getpid() != self.pid:
+                # Inherited from the parent process; leave its instances be.
+                self._reset()
+            if self.free:
+                return self.free.pop()
+            cosmo = PooledClass()
+            self.instances.append(cosmo)
+            return cosmo
+
+    def _release(self, cosmo):
+        with self.lock:
+            if os.getpid() == self.pid:
+                self.free.append(cosmo)
+
+    @contextlib.contextmanager
+    def session(self):
+        '''
+        A CLASS instance that is always cleaned up on the way out of the with
+        block, also when compute() raises. You HAVE TO run struct_cleanup()
+        after every compute step, it adds 20 MB per compute call otherwise, so
+        call it yourself between computations inside the block.
+        '''
+        cosmo = self._acquire()
+        try:
+            yield cosmo
+        finally:
+            cosmo.struct_cleanup()
+            cosmo.empty()
+            self._release(cosmo)
+
+    def stats(self):
+        '''
+        Number of instances in this process, how many are in use, and how
+        many compute() calls each one has served.
+        '''
+        with self.lock:
+            if os.getpid() != self.pid:
+                self._reset()
+            return {'pid': self.pid,
+                    'instances': len(self.instances),
+                    'in_use': len(self.instances) - len(self.free),
+                    'computes': [c.ncompute for c in self.instances]}
+
+CLASS_POOL = ClassPool()
+
+def class_session():
+    '''
+    A CLASS instance from this process's ClassPool, see ClassPool.session.
+    '''
+    return CLASS_POOL.session()
+
+def run_class(params, rescale=True, tau0=0.0544, A_s0=None,
+        thermo_only=False, cached_only=False):
+    '''
+    Runs CLASS for params and returns the lensed spectra (unlensed if lensing
+    is off), the thermodynamics table and T_cmb.
+
+    With thermo_only, CLASS only computes the background and thermodynamics
+    (a few tenths of a second instead of seconds) and the spectra are None.
+
+    rescale sets how A_s is changed so that A_s*exp(-2tau) is the same as
+    A_s0*exp(-2tau0):
+        True/'exact'  CLASS is run a second time with the new A_s.
+        'analytic'    CLASS is run once and the spectra are multiplied by
+                      exp(2tau-2tau0), and the lensing BB, which goes as
+                      A_s^2 exp(-2tau), by its square. This is exact for the
+                      unlensed spectra; lensing makes it slightly off, which
+                      rescale_residual() measures. Not with tensor modes,
+                      whose BB is linear in A_s.
+        False         No rescaling.
+
+    Results are kept in the on-disk cache in spectra_cache.py, so a given set
+    of parameters is only computed once across processes and runs. With
+    cached_only, None is returned instead of running CLASS if they aren't.
+    '''
+    if thermo_only:
+        return run_class_thermo(params)
+    if A_s0 is None:
+        A_s0 = params['A_s']
+    if rescale == 'analytic':
+        if ('t' in params.get('modes', 's')) and ('pCl' in params['output']):
+            raise ValueError("rescale='analytic' can't separate the lensing "
+                    "and tensor BB, which scale differently with A_s; use "
+                    "rescale=True")
+        # The single pass is exactly the rescale=False run, so share its cache
+        # entry.
+        out = run_class(params, rescale=False, cached_only=cached_only)
+        if out is None:
+            return None
+        cls, thermo, T_cmb = out
+        # The exact rescaling runs at A_s0*exp(2tau-2tau0) instead of A_s
+        fac = A_s0/params['A_s']*np.exp(2*get_tau(thermo)-2*tau0)
+        # The scalar BB is all lensing, C^EE times C^phiphi
+        cls = {k: (v if k == 'ell' else v*fac**2 if k == 'bb' else v*fac)
+                for k, v in cls.items()}
+        if VALIDATE_ANALYTIC_RESCALE:
+            exact = run_class(params, rescale=True, tau0=tau0, A_s0=A_s0)
+            print('analytic rescaling residual:', spectra_residual(
+                ClassResult(cls, thermo, 1), ClassResult(*exact[:2], 1)))
+        return cls, thermo, T_cmb
+    elif rescale:
+        key = spectra_cache.params_key(params, rescale=True, tau0=tau0,
+                A_s0=A_s0)
+    else:
+        key = spectra_cache.params_key(params, rescale=False)
+    cached = spectra_cache.load(key)
+    if cached is not None:
+        return cached['cls'], cached['thermo'], cached['T_cmb']
+    if cached_only:
+        return None
+
+    params = dict(params)
+    with class_session() as cosmo:
         cosmo.set(params)
         cosmo.compute()
-    Z = (cosmo.T_cmb()*1e6)**2
-    if both:
         thermo = cosmo.get_thermodynamics()
-        z, xe = thermo['z'], thermo['x_e']
-        cls = cosmo.lensed_cl(lmax)
-        cosmo.struct_cleanup()
-        ell, EE, TE, TT = cls['ell'], cls['ee'], cls['te'], cls['tt']
-        if all_spectra:
-            return z, xe, ell, EE*Z, TE*Z, TT*Z
+        if rescale:
+            tau = get_tau(thermo)
+            params['A_s'] = A_s0*np.exp(-2*tau0)/np.exp(-2*tau)
+            cosmo.struct_cleanup()
+            cosmo.set(params)
+            cosmo.compute()
+            thermo = cosmo.get_thermodynamics()
+        if params.get('lensing', 'no') == 'yes':
+            cls = cosmo.lensed_cl(params['l_max_scalars'])
         else:
-            return z, xe, ell, EE*Z, TE*Z
-    elif only_BB:
-        cls = cosmo.lensed_cl(lmax)
-        cosmo.struct_cleanup()
-        ell, BB = cls['ell'], cls['bb']*Z
-        return ell, BB
-
-    elif therm:
-        therm = cosmo.get_thermodynamics()
-        cosmo.struct_cleanup()
-        return therm
-    elif spectra:
-        cls = cosmo.lensed_cl(lmax)
-        cosmo.struct_cleanup()
-        ell, TT, EE, TE = cls['ell'], cls['tt']*Z, cls['ee']*Z, cls['te']*Z
-        if all_spectra:
-            return ell, EE, TE, TT
-        else:
-            return ell, EE, TE
+            cls = cosmo.raw_cl(params['l_max_scalars'])
+        T_cmb = cosmo.T_cmb()
 
-    elif history:
-        thermo = cosmo.get_thermodynamics()
-        cosmo.struct_cleanup()
-        z, xe = thermo['z'], thermo['x_e']
-        return z, xe
-    else:
-        return
+    spectra_cache.save(key, params, cls, thermo, T_cmb)
+    return cls, thermo, T_cmb
 
-@lru_cache(maxsize=2**10)
-def get_spectra_tau(tau, dz=0.5, z_t=28, history=False, spectra=False, both=False, 
-                all_spectra=False, lmax=100, therm=False, zstartmax=50,
-                rescale=True, only_BB=False, r=0):
-    cosmo = Class()
-    # The Planck baseline results are TT,TE,EE+lowE+lensing
-    tau0 = 0.0544
-    ln1010A_s = 3.044
-    A_s0 = np.exp(ln1010A_s-10*np.log(10))
-    params = {
-        'modes': 's, t',
-        'output': 'tCl pCl lCl',
-        'l_max_scalars': lmax,
-        'lensing': 'yes',
-        'A_s': A_s0,
-        'n_s': 0.9649,
-        'omega_b': 0.02237,
-        'omega_cdm': 0.1200,
-        'H0': 67.36,
-        'tau_reio': tau,
-        'r': r}
-
-    params['hyper_flat_approximation_nu'] = 7000. # The higher this is, the more exact
-    params['transfer_neglect_delta_k_S_t0'] = 0.17 # The higher these are, the more exact
-    params['transfer_neglect_delta_k_S_t1'] = 0.05
-    params['transfer_neglect_delta_k_S_t2'] = 0.17
-    params['transfer_neglect_delta_k_S_e'] = 0.13
-    params['delta_l_max'] = 1000 # difference between l_max in unlensed and lensed spectra
-
-
-    params['tol_thermo_integration'] = 1e-10
-
-
-    # You HAVE TO run struct_cleanup() after every compute step. It adds 20 MB
-    # per compute call otherwise.
-    cosmo.set(params)
-    cosmo.compute()
-    thermo = cosmo.get_thermodynamics()
-    if rescale:
-        tau = get_tau(thermo)
-        params['A_s'] = A_s0*np.exp(-2*tau0)/np.exp(-2*tau)
-        cosmo.struct_cleanup()
+def lensing_template(params, tau0, delta_l_max=None):
+    '''
+    Correction to add to the unlensed lensing='template' spectra of params:
+    the fully lensed spectra minus the lensing='template' ones, both for the
+    cosmology in params with its reionization history replaced by CLASS's
+    default tanh at tau0. Units are T_cmb^2, like lensed_cl.
+
+    At low ell the lensing corrections to TT, EE and TE come from the
+    high-ell power and depend on A_s*exp(-2tau), so once A_s has been rescaled
+    to A_s0*exp(-2tau0) the same correction applies to every reionization
+    history. The lensing BB goes as C^EE at high ell times C^phiphi, which is
+    proportional to A_s, so it depends on A_s^2*exp(-2tau) and compute_model
+    multiplies its correction by exp(2tau-2tau0) of each model. The template
+    runs also only go up to k ~ lmax/tau0 (times
+    TEMPLATE_K_MAX_TAU0_OVER_L_MAX), which loses a little power in TT near
+    lmax; the correction takes that out as well.
+
+    delta_l_max is used for the lensed spectra, CLASS's default if None.
+    '''
+    params = {k: v for k, v in params.items() if not k.startswith(REIO_PARAMS)}
+    params['tau_reio'] = tau0
+    key = spectra_cache.params_key(params, lensing_template=True,
+            delta_l_max=delta_l_max)
+    if key not in _lensing_templates:
+        full = dict(params)
+        full['output'] = params['output'] + ' lCl'
+        full['lensing'] = 'yes'
+        if delta_l_max is not None:
+            full['delta_l_max'] = delta_l_max
+        del full['k_max_tau0_over_l_max']
+        lensed, _, _ = run_class(full, rescale=False)
+        unlensed, _, _ = run_class(params, rescale=False)
+        template = {k: lensed[k] - unlensed[k] for k in unlensed if k != 'ell'}
+        _lensing_templates[key] = template
+    return _lensing_templates[key]
+
+def run_class_thermo(params):
+    '''
+    Thermodynamics-only version of run_class. Anything in SPECTRA_PARAMS is
+    dropped, so there are no perturbations or transfer functions to compute
+    and A_s doesn't need rescaling.
+    '''
+    params = {k: v for k, v in params.items() if k not in SPECTRA_PARAMS}
+    key = spectra_cache.params_key(params, thermo_only=True)
+    cached = spectra_cache.load(key)
+    if cached is not None:
+        return None, cached['thermo'], cached['T_cmb']
+
+    with class_session() as cosmo:
         cosmo.set(params)
         cosmo.compute()
-    Z = (cosmo.T_cmb()*1e6)**2
-    if both:
         thermo = cosmo.get_thermodynamics()
-        z, xe = thermo['z'], thermo['x_e']
-        cls = cosmo.lensed_cl(lmax)
-        cosmo.struct_cleanup()
-        ell, EE, TE = cls['ell'], cls['ee'], cls['te']
-        if all_spectra:
-            return z, xe, ell, EE*Z, TE*Z, cls['tt']*Z
+        T_cmb = cosmo.T_cmb()
+
+    spectra_cache.save(key, params, None, thermo, T_cmb)
+    return None, thermo, T_cmb
+
+class ClassResult(object):
+    '''
+    The output of one CLASS run: the lensed spectra (in uK^2) and the
+    thermodynamics table. tau, tau_lo and tau_hi are only computed when they
+    are first asked for. For thermodynamics-only runs the spectra are None,
+    and so are any spectra that were not asked for (see compute_model).
+
+    The same object is handed to everyone who asks for this model, so the
+    arrays are read-only and the attributes can't be reassigned.
+    '''
+    def __init__(self, cls, thermo, Z):
+        def freeze(arr):
+            arr = np.array(arr)
+            arr.flags.writeable = False
+            return arr
+        thermo = MappingProxyType({k: freeze(v) for k, v in thermo.items()})
+        set_ = object.__setattr__
+        set_(self, 'thermo', thermo)
+        set_(self, 'z', thermo['z'])
+        set_(self, 'x_e', thermo['x_e'])
+        if cls is None:
+            cls = {}
+            Z = 1
+        for k in ['ell', 'tt', 'ee', 'te', 'bb']:
+            name = k if k == 'ell' else k.upper()
+            if cls.get(k) is None:
+                value = None
+            elif k == 'ell':
+                value = freeze(cls[k])
+            else:
+                value = freeze(cls[k]*Z)
+            set_(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ClassResult is immutable')
+
+    @property
+    def outputs(self):
+        return tuple(s for s in SPECTRA if getattr(self, s) is not None)
+
+    def truncate(self, lmax):
+        '''
+        The same result with the spectra only up to lmax. The arrays (and tau)
+        are shared with this one, not copied.
+        '''
+        if (self.ell is None) or (len(self.ell) <= lmax+1):
+            return self
+        result = object.__new__(ClassResult)
+        for k, v in self.__dict__.items():
+            if (k == 'ell' or k in SPECTRA) and v is not None:
+                v = v[:lmax+1]
+            object.__setattr__(result, k, v)
+        return result
+
+    @property
+    def nbytes(self):
+        arrays = list(self.thermo.values()) + [self.ell, self.TT, self.EE,
+                self.TE, self.BB]
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    def __reduce__(self):
+        # So that results can come back from worker processes. The spectra
+        # are already in uK^2.
+        if self.ell is None:
+            cls = None
         else:
-            return z, xe, ell, EE*Z, TE*Z
-    elif only_BB:
-        cls = cosmo.lensed_cl(lmax)
-        cosmo.struct_cleanup()
-        ell, BB = cls['ell'], cls['bb']*Z
-        return ell, BB
-
-    elif therm:
-        therm = cosmo.get_thermodynamics()
-        cosmo.struct_cleanup()
-        return therm
-    elif spectra:
-        cls = cosmo.lensed_cl(lmax)
-        cosmo.struct_cleanup()
-        ell, TT, EE, TE = cls['ell'], cls['tt']*Z, cls['ee']*Z, cls['te']*Z, 
-        if all_spectra:
-            return ell, EE, TE, TT
+            cls = {'ell': self.ell, 'tt': self.TT, 'ee': self.EE,
+                    'te': self.TE, 'bb': self.BB}
+        return (ClassResult, (cls, dict(self.thermo), 1))
+
+    @cached_property
+    def tau(self):
+        return get_tau(self.thermo)
+
+    @cached_property
+    def _twotau(self):
+        return get_twotau(self.thermo)
+
+    @property
+    def zsplit(self):
+        return self._twotau[0]
+
+    @property
+    def tau_lo(self):
+        return self._twotau[1]
+
+    @property
+    def tau_hi(self):
+        return self._twotau[2]
+
+    def unpack(self, history=False, spectra=False, both=False,
+            all_spectra=False, therm=False, only_BB=False):
+        '''
+        Returns what get_spectra used to return for this combination of flags.
+        '''
+        if both:
+            if all_spectra:
+                return self.z, self.x_e, self.ell, self.EE, self.TE, self.TT
+            else:
+                return self.z, self.x_e, self.ell, self.EE, self.TE
+        elif only_BB:
+            return self.ell, self.BB
+        elif therm:
+            return self.thermo
+        elif spectra:
+            if all_spectra:
+                return self.ell, self.EE, self.TE, self.TT
+            else:
+                return self.ell, self.EE, self.TE
+        elif history:
+            return self.z, self.x_e
         else:
-            return ell, EE, TE
+            return
 
-    elif history:
-        thermo = cosmo.get_thermodynamics()
-        cosmo.struct_cleanup()
-        z, xe = thermo['z'], thermo['x_e']
-        return z, xe
-    else:
-        return
+def spectra_residual(approx, exact, lmax=100):
+    '''
+    Maximum fractional difference between two ClassResults for each spectrum
+    they both have, over 2 <= ell <= lmax. TE goes through zero, so its
+    difference is compared to sqrt(TT*EE) instead.
+    '''
+    lmax = min(lmax, len(exact.ell)-1, len(approx.ell)-1)
+    l = slice(2, lmax+1)
+    residual = {}
+    for spec in ['TT', 'EE', 'TE', 'BB']:
+        if (getattr(approx, spec) is None) or (getattr(exact, spec) is None):
+            continue
+        if spec == 'TE':
+            norm = np.sqrt(exact.TT[l]*exact.EE[l])
+        else:
+            norm = np.abs(getattr(exact, spec)[l])
+        diff = getattr(approx, spec)[l] - getattr(exact, spec)[l]
+        residual[spec] = float(np.max(np.abs(diff)/norm))
+    return residual
 
-def get_spectra_complex(zarr, x_earr, dz=0.5, history=False, spectra=False, both=False, 
-                all_spectra=False, lmax=100, therm=False, zstartmax=50):
-    cosmo = Class()
-    #cosmo.struct_cleanup()
-    #cosmo.empty()
+def rescale_residual(zreio, x_e, lmax=100, **kwargs):
+    '''
+    Measures how far the one-pass rescale='analytic' spectra are from the
+    exact two-pass rescaling for a reio_many_tanh model, over 2 <= ell <= 100.
+    The difference comes from lensing, which is not linear in A_s, beyond the
+    A_s^2 that the lensing BB is rescaled with.
+    '''
+    exact = get_model(zreio, x_e, lmax=lmax, rescale=True, **kwargs)
+    approx = get_model(zreio, x_e, lmax=lmax, rescale='analytic', **kwargs)
+    return spectra_residual(approx, exact, lmax=min(lmax, 100))
+
+def lensing_template_residual(zreio, x_e, lmax=100, **kwargs):
+    '''
+    Measures how far the lensing='template' spectra are from the fully
+    lensed ones for a reio_many_tanh model, over 2 <= ell <= lmax.
+    '''
+    exact = get_model(zreio, x_e, lmax=lmax, **kwargs)
+    approx = get_model(zreio, x_e, lmax=lmax, lensing='template', **kwargs)
+    return spectra_residual(approx, exact, lmax=lmax)
+
+# Reionization models. Each one only turns its parameters into a CLASS params
+# dict; compute_model runs them all with the same caching and rescaling.
+MODELS = {}
+
+# CLASS accuracy settings, from cheapest to most exact. 'paper' is what the
+# paper used. benchmark_precision.py measures the time and error of each.
+PRECISION_PRESETS = {
+    'draft': {
+        'delta_l_max': 500,
+        'l_logstep': 1.2},
+    'sampling': {
+        'hyper_flat_approximation_nu': 7000.,
+        'transfer_neglect_delta_k_S_t0': 0.17,
+        'transfer_neglect_delta_k_S_t1': 0.05,
+        'transfer_neglect_delta_k_S_t2': 0.17,
+        'transfer_neglect_delta_k_S_e': 0.13,
+        'delta_l_max': 750},
+    'paper': {
+        'hyper_flat_approximation_nu': 7000., # The higher this is, the more exact
+        'transfer_neglect_delta_k_S_t0': 0.17, # The higher these are, the more exact
+        'transfer_neglect_delta_k_S_t1': 0.05,
+        'transfer_neglect_delta_k_S_t2': 0.17,
+        'transfer_neglect_delta_k_S_e': 0.13,
+        'delta_l_max': 1000}, # difference between l_max in unlensed and lensed spectra
+    'reference': {
+        'hyper_flat_approximation_nu': 1e4,
+        'transfer_neglect_delta_k_S_t0': 0.3,
+        'transfer_neglect_delta_k_S_t1': 0.1,
+        'transfer_neglect_delta_k_S_t2': 0.3,
+        'transfer_neglect_delta_k_S_e': 0.25,
+        'delta_l_max': 1500,
+        'l_logstep': 1.026, # every ell up to ~40
+        'l_linstep': 10},
+    }
+# The preset used when none is given, e.g. tools.PRECISION = 'sampling' for
+# a burn-in
+PRECISION = os.environ.get('LOW_ELL_PRECISION', 'paper')
+
+# The Planck baseline results are TT,TE,EE+lowE+lensing
+PLANCK_2018 = {
+    'A_s': np.exp(3.044-10*np.log(10)),
+    'n_s': 0.9649,
+    'omega_b': 0.02237,
+    'omega_cdm': 0.1200,
+    'H0': 67.36}
+PLANCK_2018_TAU = 0.0544
+
+def register_model(name, T_cmb=None, canonical=None):
+    '''
+    Decorator that adds a reionization model to MODELS. The model function
+    takes the model parameters and returns the CLASS params dict (cosmology
+    and reionization only), and the tau0 and A_s0 that A_s is rescaled to.
+
+    T_cmb: temperature in K used to convert the spectra to uK^2. By default
+        it is the T_cmb that CLASS returns.
+    canonical: maps the model parameters to what CLASS actually sees, for the
+        cache key.
+    '''
+    def register(func):
+        func.T_cmb = T_cmb
+        func.canonical = canonical
+        MODELS[name] = func
+        return func
+    return register
+
+def _floor_x_e(args):
+    # CLASS only sees max(x_e, 2e-4), so x_e = 0 and x_e = 1e-5 are the same
+    # model.
+    args['x_e'] = max(args['x_e'], 2e-4)
+    return args
+
+@register_model('many_tanh', canonical=_floor_x_e)
+def many_tanh_params(zreio, x_e, dz=0.5, z_t=28, zstartmax=50):
+    '''
+    Helium reionization at z = 3.5, hydrogen at zreio, and a second step up
+    to x_e at z_t, all tanh steps of width dz.
+    '''
+    params = dict(PLANCK_2018)
+    params['reio_parametrization'] = 'reio_many_tanh'
+    params['many_tanh_num'] = 3
+    params['many_tanh_z'] = '3.5,' + str(zreio) +',' + str(z_t)
+    params['many_tanh_xe'] = '-2,-1,'+str(max(x_e, 2e-4))
+    params['many_tanh_width'] = dz
+    params['reionization_z_start_max'] = zstartmax
+    return params, PLANCK_2018_TAU, PLANCK_2018['A_s']
+
+# z_reio grid of tau_map
+TAU_MAP_Z = np.arange(3, 25.001, 0.25)
+_tau_maps = {}
+
+def tau_map(params):
+    '''
+    CLASS's tau_reio for its default tanh history on the TAU_MAP_Z grid of
+    z_reio, for the cosmology in params (any reionization parameters in it
+    are ignored). Returns z_reio and tau_reio.
+
+    It takes a thermodynamics-only run per grid point, about 7 s in all, and
+    is kept on disk and in memory, so it is only computed once per cosmology.
+    '''
+    params = {k: v for k, v in params.items() if (k not in SPECTRA_PARAMS)
+            and not k.startswith(REIO_PARAMS)}
+    key = spectra_cache.params_key(params, tau_map=TAU_MAP_Z.tolist())
+    if key not in _tau_maps:
+        cached = spectra_cache.load(key)
+        if cached is not None:
+            table = cached['thermo']
+        else:
+            taus = []
+            with class_session() as cosmo:
+                for z in TAU_MAP_Z:
+                    cosmo.set(dict(params, z_reio=z))
+                    cosmo.compute()
+                    taus.append(cosmo.get_current_derived_parameters(
+                        ['tau_reio'])['tau_reio'])
+                    T_cmb = cosmo.T_cmb()
+                    cosmo.struct_cleanup()
+            table = {'z_reio': TAU_MAP_Z, 'tau_reio': np.array(taus)}
+            spectra_cache.save(key, params, None, table, T_cmb)
+        _tau_maps[key] = table
+    return _tau_maps[key]['z_reio'], _tau_maps[key]['tau_reio']
+
+def z_reio_of_tau(tau, params=PLANCK_2018):
+    '''
+    z_reio of CLASS's default tanh history with optical depth tau, from a
+    cubic spline through tau_map(params). CLASS can be run with this z_reio
+    instead of tau_reio, which saves it from searching for z_reio itself.
+    '''
+    z, taus = tau_map(params)
+    if not (taus[0] <= tau <= taus[-1]):
+        raise ValueError('tau = {0} is outside of the range [{1:.4f}, '
+                '{2:.4f}] of tau_map'.format(tau, taus[0], taus[-1]))
+    return float(CubicSpline(taus, z)(tau))
+
+def test_z_reio_of_tau(taus=[0.03, 0.0544, 0.08, 0.12]):
+    '''
+    Compares CLASS's tau_reio at z_reio_of_tau(tau) to tau.
+    '''
+    for tau in taus:
+        with class_session() as cosmo:
+            cosmo.set(dict(PLANCK_2018, z_reio=z_reio_of_tau(tau)))
+            cosmo.compute()
+            tau_class = cosmo.get_current_derived_parameters(
+                    ['tau_reio'])['tau_reio']
+        print('tau = {0}: z_reio = {1:.5f}, tau_reio - tau = {2:.1e}'.format(
+            tau, z_reio_of_tau(tau), tau_class - tau))
+    return
+
+@register_model('tau_reio')
+def tau_reio_params(tau):
+    '''
+    CLASS's default tanh history with optical depth tau, which is set
+    through z_reio_of_tau.
+    '''
+    params = dict(PLANCK_2018)
+    params['z_reio'] = z_reio_of_tau(tau)
+    return params, PLANCK_2018_TAU, PLANCK_2018['A_s']
+
+@register_model('reio_inter', T_cmb=2.7)
+def reio_inter_params(zarr, x_earr):
+    '''
+    x_e(z) interpolated linearly between the points (zarr, x_earr) above
+    z = 6, and fully ionized (including helium) below.
+    '''
     ln1010A_s = 3.0448
     #10*np.log(10)+np.log(A_s) = 3.0448
     A_s0 = np.exp(ln1010A_s-10*np.log(10))
     tau0 = 0.0568
     params = {
-        'output': 'tCl pCl lCl',
-        'l_max_scalars': lmax,
-        'lensing': 'yes',
         'A_s': A_s0,
         'n_s': 0.96824,
         'omega_b': 0.022447,
@@ -319,167 +728,472 @@ def get_spectra_complex(zarr, x_earr, dz=0.5, history=False, spectra=False, both
         'H0': 67.70,
         'reio_parametrization' : 'reio_inter'}
 
+    zarr, x_earr = np.asarray(zarr), np.asarray(x_earr)
     inds = (zarr > 6)
     zarr = zarr[inds]
     x_earr = x_earr[inds]
-    #der = np.diff(x_earr)/np.diff(zarr)
-    #inds = (abs(der)/x_earr[:-1] > 0.1)
-    #zarr = zarr[:-1][inds]
-    #x_earr = x_earr[:-1][inds]
-    print(len(zarr)+4)
     params['reio_inter_num'] = len(zarr) + 4
     params['reio_inter_z'] = '0, 3, 4, 6,' + ','.join([str(num) for num in zarr])
-    #params['reio_inter_z'] =   '0,  3,  4,   8,   9,  10,  11, 12'
-    #params['reio_inter_xe']= '-2, -2, -1,  -1, 0.9, 0.5, 0.1,  0'
     params['reio_inter_xe'] = '-2, -2, -1, -1,' + ','.join([str(num) for num in x_earr])
+    return params, tau0, A_s0
 
-    print(len(params['reio_inter_z'].split(',')))
-    print(len(params['reio_inter_xe'].split(',')))
-    print(params['reio_inter_num'])
-
-
-
-    
-    params['hyper_flat_approximation_nu'] = 7000. # The higher this is, the more exact
-    params['transfer_neglect_delta_k_S_t0'] = 0.17 # The lower these are, the more exact
-    params['transfer_neglect_delta_k_S_t1'] = 0.05
-    params['transfer_neglect_delta_k_S_t2'] = 0.17
-    params['transfer_neglect_delta_k_S_e'] = 0.13
-    params['delta_l_max'] = 1000 # difference between l_max in unlensed and lensed spectra
-
-
-    # You HAVE TO run struct_cleanup() after every compute step. It adds 20 MB
-    # per compute call otherwise.
-    cosmo.set(params)
-    cosmo.compute()
-    thermo = cosmo.get_thermodynamics()
-    tau = get_tau(thermo)
-    params['A_s'] = A_s0*np.exp(-2*tau0)/np.exp(-2*tau)
-    cosmo.struct_cleanup()
-    cosmo.set(params)
-    cosmo.compute()
-    Z = (2.7e6)**2
-    if both:
-        thermo = cosmo.get_thermodynamics()
-        z, xe = thermo['z'], thermo['x_e']
-        cls = cosmo.lensed_cl(lmax)
-        cosmo.struct_cleanup()
-        ell, EE, TE = cls['ell'], cls['ee'], cls['te']
-        if all_spectra:
-            return z, xe, ell, EE*Z, TE*Z, cls['tt']*Z
-        else:
-            return z, xe, ell, EE*Z, TE*Z
-
-    elif therm:
-        therm = cosmo.get_thermodynamics()
-        cosmo.struct_cleanup()
-        return therm
-    elif spectra:
-        cls = cosmo.lensed_cl(lmax)
-        cosmo.struct_cleanup()
-        ell, TT, EE, TE = cls['ell'], cls['tt']*Z, cls['ee']*Z, cls['te']*Z
-        if all_spectra:
-            return ell, EE, TE, TT
-        else:
-            return ell, EE, TE
-
-    elif history:
-        thermo = cosmo.get_thermodynamics()
-        cosmo.struct_cleanup()
-        z, xe = thermo['z'], thermo['x_e']
-        return z, xe
-    else:
-        return
-
-def get_spectra_simple(zreio, x_e, dz=0.5, history=False, spectra=False, both=False, 
-                all_spectra=False, lmax=100, therm=False, zstartmax=50):
-    #cosmo.struct_cleanup()
-    #cosmo.empty()
-    cosmo = Class()
+@register_model('reio_camb', T_cmb=2.7)
+def reio_camb_params(zreio, dz=0.5, zstartmax=50):
+    '''
+    CAMB-like tanh in (1+z)^1.5 centered on zreio with width dz, with CLASS's
+    default cosmology.
+    '''
     params = {
-        'output': 'tCl pCl lCl',
-        'l_max_scalars': lmax,
-        'lensing': 'yes',
         'A_s': 2.3e-9,
         'n_s': 0.965,
         'reio_parametrization' : 'reio_camb'}
-
     params['z_reio'] = zreio
     params['reionization_width'] = dz
     params['reionization_z_start_max'] = zstartmax
+    return params, 0.06, 2.3e-9
+
+def _freeze(value):
+    # Hashable, quantized version of a model parameter
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(spectra_cache.quantize(float(v)) for v in np.ravel(value))
+    return spectra_cache.quantize(value)
+
+def _outputs(outputs):
+    # Sorted tuple of spectrum names, so that the order doesn't matter
+    outputs = tuple(sorted(set(outputs)))
+    unknown = set(outputs) - set(SPECTRA)
+    if unknown or not outputs:
+        raise ValueError('outputs has to be a non-empty subset of {0}, got '
+                '{1}'.format(SPECTRA, outputs))
+    return outputs
+
+def _compute_canonical(args):
+    # Flattens the model parameters into the key with their defaults filled
+    # in. The thermodynamics don't depend on lmax, r, the rescaling, the
+    # lensing or the outputs, so thermo_only runs share one entry for those.
+    args = dict(args)
+    model = MODELS[args['model']]
+    bound = inspect.signature(model).bind(**args.pop('kwargs'))
+    bound.apply_defaults()
+    kwargs = dict(bound.arguments)
+    if model.canonical is not None:
+        kwargs = model.canonical(kwargs)
+    if args['precision'] is None:
+        args['precision'] = PRECISION
+    if args['precision'] not in PRECISION_PRESETS:
+        raise ValueError('precision has to be one of {0}, got {1}'.format(
+            list(PRECISION_PRESETS), args['precision']))
+    if args['thermo_only']:
+        args.update(lmax=100, rescale=True, r=0, lensing='full',
+                outputs=SPECTRA, A_s=None, n_s=None)
+    outputs = _outputs(args.pop('outputs'))
+    args.update(kwargs)
+    args = {k: _freeze(v) for k, v in args.items()}
+    args['outputs'] = outputs
+    return args
+
+def _compute_reuse(cached, value, args):
+    # A result with more spectra than were asked for serves the request. The
+    # lmax has to be the same: a run up to a larger lmax and cut down is not
+    # the same as a run at lmax (see _compute_lmax).
+    if any(cached[k] != v for k, v in args.items() if k != 'outputs'):
+        return None
+    if set(args['outputs']) <= set(cached['outputs']):
+        return value
+    return None
+
+def _class_output(outputs, lensing, r=0):
+    # CLASS output for the spectra in outputs: TT and TE need the
+    # temperature, EE, TE and BB the polarization. CLASS can't do tensor
+    # polarization without the temperature (there's no Limber approximation
+    # for it), so tensor runs always have both.
+    output = []
+    if (set(outputs) & {'TT', 'TE'}) or (r != 0):
+        output.append('tCl')
+    if set(outputs) & {'EE', 'TE', 'BB'}:
+        output.append('pCl')
+    if lensing != 'template':
+        output.append('lCl')
+    return ' '.join(output)
+
+@spectra_cache.memory_cache(maxsize=2**10,
+        maxbytes=spectra_cache.MEMORY_LIMIT_MB*1e6, canonical=_compute_canonical,
+        reuse=_compute_reuse)
+def compute_model(model, lmax=100, rescale=True, r=0, thermo_only=False,
+        lensing='full', outputs=SPECTRA, precision=None, A_s=None, n_s=None,
+        **kwargs):
+    '''
+    Runs CLASS for one of the MODELS with parameters kwargs, and returns a
+    ClassResult with the spectra and the thermodynamics, or only the
+    thermodynamics if thermo_only is set. Results are cached in memory and on
+    disk.
+
+    outputs are the spectra that are needed, e.g. ('EE',) for an EE-only
+    likelihood. CLASS then skips the temperature (or the polarization) and
+    the other spectra are None, unless a cached result that has them all is
+    already around, in which case that one is returned. Tensor modes are only
+    computed for r != 0.
+
+    precision is one of the PRECISION_PRESETS, PRECISION if None. A_s and
+    n_s replace the model's primordial amplitude and tilt if given; A_s only
+    with rescale=False, since the rescaling sets A_s itself.
+
+    CLASS is run at exactly lmax. get_model and the other wrappers instead
+    run at _compute_lmax(lmax) and cut the spectra down, so that the same
+    models serve every lmax.
+
+    With lensing='template', CLASS only computes the unlensed spectra up to
+    lmax, instead of up to lmax + delta_l_max plus the lensing potential, and
+    the correction from lensing_template() is added to them. This assumes A_s
+    is rescaled (rescale=True or 'analytic'); lensing_template_residual()
+    measures how well it works.
+    '''
+    func = MODELS[model]
+    params, tau0, A_s0 = func(**kwargs)
+    if A_s is not None:
+        if rescale:
+            raise ValueError('A_s can only be set with rescale=False')
+        params['A_s'] = A_s
+    if n_s is not None:
+        params['n_s'] = n_s
+    params['output'] = _class_output(outputs, lensing, r)
+    params['lensing'] = 'no' if lensing == 'template' else 'yes'
+    params['l_max_scalars'] = lmax
+    if r != 0:
+        params['modes'] = 's, t'
+        params['r'] = r
+        params.update(TENSOR_TILT)
+    params.update(PRECISION_PRESETS[precision])
+    if lensing == 'template':
+        # Only matters for the lensed spectra
+        delta_l_max = params.pop('delta_l_max', None)
+        params['k_max_tau0_over_l_max'] = TEMPLATE_K_MAX_TAU0_OVER_L_MAX
+
+    out = None
+    if set(outputs) != set(SPECTRA) and not thermo_only:
+        # The same model with all the spectra may already be on disk
+        full = dict(params, output=_class_output(SPECTRA, lensing, r))
+        out = run_class(full, rescale=rescale, tau0=tau0, A_s0=A_s0,
+                cached_only=True)
+        if out is not None:
+            params = full
+    if out is None:
+        out = run_class(params, rescale=rescale, tau0=tau0, A_s0=A_s0,
+                thermo_only=thermo_only)
+    cls, thermo, T_cmb = out
+    if (lensing == 'template') and not thermo_only:
+        template = dict(lensing_template(params, tau0, delta_l_max))
+        # The rescaled A_s is A_s0*exp(2tau-2tau0), and the lensing BB goes as
+        # A_s^2*exp(-2tau)
+        if 'bb' in template:
+            template['bb'] = template['bb']*np.exp(2*get_tau(thermo)-2*tau0)
+        cls = {k: (v + template[k] if k in template else v)
+                for k, v in cls.items()}
+    if func.T_cmb is not None:
+        T_cmb = func.T_cmb
+    result = ClassResult(cls, thermo, (T_cmb*1e6)**2)
+    if (lensing == 'template') and VALIDATE_LENSING_TEMPLATE and not thermo_only:
+        exact = compute_model(model, lmax=lmax, rescale=rescale, r=r,
+                outputs=outputs, precision=precision, **kwargs)
+        print('lensing template residual:', spectra_residual(result, exact,
+            lmax=lmax))
+    return result
+
+# get_model and friends run CLASS up to lmax rounded up to a multiple of this
+LMAX_STEP = 100
+
+def _compute_lmax(lmax, thermo_only=False):
+    # lmax to run compute_model at, which only depends on the lmax asked for.
+    # The spectra cut down from a larger lmax differ from a run at lmax (CLASS
+    # loses some power close to l_max_scalars, lensed BB at ell < 30 is off by
+    # tens of percent at lmax = 30), so every model, and every point of a
+    # finite difference, has to come from the same lmax.
+    if thermo_only:
+        return lmax
+    return LMAX_STEP*int(np.ceil(lmax/LMAX_STEP))
+
+def get_model(zreio, x_e, dz=0.5, z_t=28, lmax=100, zstartmax=50,
+        rescale=True, r=0, thermo_only=False, lensing='full',
+        outputs=SPECTRA, precision=None):
+    '''
+    ClassResult for a reio_many_tanh history.
+    '''
+    result = compute_model('many_tanh', lmax=_compute_lmax(lmax, thermo_only),
+            rescale=rescale, r=r, thermo_only=thermo_only, lensing=lensing,
+            outputs=outputs, precision=precision, zreio=zreio, x_e=x_e, dz=dz,
+            z_t=z_t, zstartmax=zstartmax)
+    return result.truncate(lmax)
+
+def get_model_tau(tau, lmax=100, rescale=True, r=0, thermo_only=False,
+        lensing='full', outputs=SPECTRA, precision=None):
+    '''
+    Same as get_model, but for CLASS's default tanh history with a given
+    optical depth.
+    '''
+    result = compute_model('tau_reio', lmax=_compute_lmax(lmax, thermo_only),
+            rescale=rescale, r=r, thermo_only=thermo_only, lensing=lensing,
+            outputs=outputs, precision=precision, tau=tau)
+    return result.truncate(lmax)
 
+def get_BB(model, r, lmax=100, rescale=True, lensing='full', precision=None,
+        **kwargs):
+    '''
+    ell and the lensed BB spectrum of one of the MODELS (with parameters
+    kwargs) for tensor-to-scalar ratio r, which can be a number or an array,
+    in which case BB has shape (len(r), lmax+1).
+
+    With the fixed TENSOR_TILT, BB is linear in r, so it is
+    BB(r=0) + r*(BB(r=1) - BB(r=0)), and only those two models are ever
+    computed with CLASS (and cached) for each reionization history, whatever
+    r is. tensor_BB_residual() checks this against a run at r.
+    '''
+    args = dict(lmax=_compute_lmax(lmax), rescale=rescale, lensing=lensing,
+            outputs=('BB',), precision=precision, **kwargs)
+    r = np.asarray(r, dtype=float)
+    scalar = compute_model(model, r=0, **args).truncate(lmax)
+    if not np.any(r):
+        return scalar.ell, scalar.BB + np.multiply.outer(r, 0*scalar.BB)
+    tensor = compute_model(model, r=1, **args).truncate(lmax)
+    return scalar.ell, scalar.BB + np.multiply.outer(r, tensor.BB - scalar.BB)
+
+def tensor_BB_residual(zreio, x_e, r=0.05, lmax=100, **kwargs):
+    '''
+    Maximum fractional difference between get_BB and CLASS run at r for a
+    reio_many_tanh model, over 2 <= ell <= lmax.
+    '''
+    ell, BB = get_BB('many_tanh', r, lmax=lmax, zreio=zreio, x_e=x_e,
+            **kwargs)
+    exact = get_model(zreio, x_e, lmax=lmax, r=r, outputs=('BB',), **kwargs)
+    return float(np.max(np.abs(BB[2:]/exact.BB[2:] - 1)))
 
-    
-    params['hyper_flat_approximation_nu'] = 7000. # The higher this is, the more exact
-    params['transfer_neglect_delta_k_S_t0'] = 0.17 # The lower these are, the more exact
-    params['transfer_neglect_delta_k_S_t1'] = 0.05
-    params['transfer_neglect_delta_k_S_t2'] = 0.17
-    params['transfer_neglect_delta_k_S_e'] = 0.13
-    params['delta_l_max'] = 1000 # difference between l_max in unlensed and lensed spectra
-
-
-    # You HAVE TO run struct_cleanup() after every compute step. It adds 20 MB
-    # per compute call otherwise.
-    cosmo.set(params)
-    cosmo.compute()
-    thermo = cosmo.get_thermodynamics()
-    tau = get_tau(thermo)
-    params['A_s'] = 2.3e-9*np.exp(-2*0.06)/np.exp(-2*tau)
-    cosmo.struct_cleanup()
-    cosmo.set(params)
-    cosmo.compute()
-    Z = (2.7e6)**2
-    if both:
-        thermo = cosmo.get_thermodynamics()
-        z, xe = thermo['z'], thermo['x_e']
-        cls = cosmo.lensed_cl(lmax)
-        cosmo.struct_cleanup()
-        ell, EE, TE = cls['ell'], cls['ee'], cls['te']
-        if all_spectra:
-            return z, xe, ell, EE*Z, TE*Z, cls['tt']*Z
-        else:
-            return z, xe, ell, EE*Z, TE*Z
-
-    elif therm:
-        therm = cosmo.get_thermodynamics()
-        cosmo.struct_cleanup()
-        return therm
-    elif spectra:
-        cls = cosmo.lensed_cl(lmax)
-        cosmo.struct_cleanup()
-        ell, TT, EE, TE = cls['ell'], cls['tt']*Z, cls['ee']*Z, cls['te']*Z
-        if all_spectra:
-            return ell, EE, TE, TT
-        else:
-            return ell, EE, TE
-
-    elif history:
-        thermo = cosmo.get_thermodynamics()
-        cosmo.struct_cleanup()
-        z, xe = thermo['z'], thermo['x_e']
-        return z, xe
+class PrimordialSpectra(object):
+    '''
+    The spectra of one of the MODELS (with parameters kwargs) as a function
+    of the primordial A_s, n_s and r, without running CLASS again.
+
+    classy doesn't give access to the harmonic transfer functions, so what
+    is cached instead is how they respond to the primordial spectrum: CLASS
+    is run at the model's n_s, at n_s +- dn and at r = 1, all with the
+    model's A_s. Then
+        - the spectra are linear in A_s, apart from the lensing BB, which goes
+          as A_s^2 (lensing potential times E),
+        - ln TT, ln EE and ln BB are expanded to second order in n_s for each
+          ell, and TE (which goes through zero) itself,
+        - the tensor part is linear in r and doesn't depend on n_s, since the
+          tensor tilt is fixed (TENSOR_TILT).
+    residual() compares the result to a full CLASS run.
+    '''
+    def __init__(self, model, lmax=100, dn=0.02, lensing='full',
+            precision=None, **kwargs):
+        params, self.tau0, self.A_s0 = MODELS[model](**kwargs)
+        self.model = model
+        self.kwargs = kwargs
+        self.A_s_ref = params['A_s']
+        self.n_s_ref = params['n_s']
+        self.dn = dn
+        args = dict(lmax=_compute_lmax(lmax), rescale=False, lensing=lensing,
+                precision=precision, **kwargs)
+        self.args = args
+        self.lmax = lmax
+        mid, lo, hi, tensor = [compute_model(model, **dict(args, **a)
+            ).truncate(lmax) for a in [{}, {'n_s': self.n_s_ref-dn},
+                {'n_s': self.n_s_ref+dn}, {'r': 1}]]
+        self.ell = mid.ell
+        self.thermo = mid.thermo
+        self.tau = mid.tau
+        self.scalar, self.d1, self.d2, self.tensor = {}, {}, {}, {}
+        for spec in SPECTRA:
+            # TE goes through zero, so it is expanded itself rather than its
+            # log. ell = 0, 1 are zero and stay that way.
+            f = (lambda c: c) if spec == 'TE' else np.log
+            with np.errstate(divide='ignore', invalid='ignore'):
+                f0, fm, fp = [f(getattr(x, spec)) for x in [mid, lo, hi]]
+                d1 = (fp - fm)/(2*dn)
+                d2 = (fp - 2*f0 + fm)/dn**2
+            d1[~np.isfinite(d1)] = 0
+            d2[~np.isfinite(d2)] = 0
+            self.scalar[spec], self.d1[spec], self.d2[spec] = f0, d1, d2
+            self.tensor[spec] = getattr(tensor, spec) - getattr(mid, spec)
+
+    def get_spectra(self, A_s=None, n_s=None, r=0):
+        '''
+        Returns ell and a dict with the TT, EE, TE and BB spectra, each of shape
+        np.broadcast(A_s, n_s, r).shape + (lmax+1,). A_s=None is the A_s that
+        rescale=True gives, n_s=None the model's n_s.
+        '''
+        if A_s is None:
+            A_s = self.A_s0*np.exp(2*self.tau - 2*self.tau0)
+        if n_s is None:
+            n_s = self.n_s_ref
+        A_s, n_s, r = [np.asarray(x, dtype=float)[..., None] for x in
+                np.broadcast_arrays(A_s, n_s, r)]
+        amp = A_s/self.A_s_ref
+        dn = n_s - self.n_s_ref
+        out = {}
+        for spec in SPECTRA:
+            f = self.scalar[spec] + self.d1[spec]*dn + self.d2[spec]*dn**2/2
+            scalar = f if spec == 'TE' else np.exp(f)
+            # The scalar BB at low ell is all lensing
+            scale = amp**2 if spec == 'BB' else amp
+            out[spec] = scale*scalar + amp*r*self.tensor[spec]
+        return self.ell, out
+
+    def residual(self, A_s=None, n_s=None, r=0):
+        '''
+        Maximum fractional difference from a full CLASS run for one
+        (A_s, n_s, r), see spectra_residual.
+        '''
+        if A_s is None:
+            A_s = self.A_s0*np.exp(2*self.tau - 2*self.tau0)
+        ell, spectra = self.get_spectra(A_s, n_s, r)
+        cls = {k.lower(): v for k, v in spectra.items()}
+        cls['ell'] = ell
+        approx = ClassResult(cls, self.thermo, 1)
+        exact = compute_model(self.model, A_s=A_s, n_s=n_s, r=r,
+                **self.args).truncate(self.lmax)
+        return spectra_residual(approx, exact, lmax=len(ell)-1)
+
+def _thermo_only(history, spectra, both, therm, only_BB=False):
+    # Requests for the history alone only need the thermodynamics
+    return (therm or history) and not (both or spectra or only_BB)
+
+def _compute_model_worker(args):
+    # Runs in a pool process. run_class also writes the result to the disk
+    # cache, so other processes can load it later.
+    return compute_model(**args)
+
+def get_spectra_many(param_list, workers=None, model='many_tanh', lmax=100,
+        thermo_only=False, rescale=True, r=0, outputs=SPECTRA, precision=None,
+        verbose=False):
+    '''
+    get_spectra for many models at once, with the CLASS runs spread over a pool
+    of worker processes (all cores by default, or workers of them).
+
+    param_list is a list of tuples with the model parameters in order, e.g.
+    (zreio, x_e), (zreio, x_e, dz) or (zreio, x_e, dz, z_t) for many_tanh, or
+    of dicts of them, which can also set r, A_s and n_s per model. Repeated models are only computed once, models that are
+    already cached aren't recomputed, and the new results are added to the
+    in-memory cache of this process, so later get_spectra calls for the same
+    models are free.
+
+    Returns a dict with ell and the TT, EE, TE and BB spectra stacked into
+    (n_models, lmax+1) arrays (None if thermo_only or not in outputs), tau,
+    tau_lo, tau_hi and zsplit as (n_models,) arrays, and the list of
+    thermodynamics tables.
+    '''
+    import multiprocessing
+    names = list(inspect.signature(MODELS[model]).parameters)
+    args = []
+    for p in param_list:
+        p = dict(p) if isinstance(p, dict) else dict(zip(names, p))
+        a = dict(model=model, lmax=_compute_lmax(lmax, thermo_only),
+            rescale=rescale, r=r, thermo_only=thermo_only, outputs=outputs,
+            precision=precision)
+        a.update(p)
+        args.append(a)
+    keys = [compute_model.key(**a) for a in args]
+
+    todo = {}
+    for k, a in zip(keys, args):
+        if (k not in compute_model) and (k not in todo):
+            todo[k] = a
+    if verbose:
+        print('{0} models, {1} unique, {2} to compute'.format(len(args),
+            len(set(keys)), len(todo)))
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(todo))
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_compute_model_worker, list(todo.values()),
+                    chunksize=1)
+        for a, result in zip(todo.values(), results):
+            compute_model.insert(result, **a)
+
+    results = [compute_model(**a).truncate(lmax) for a in args]
+    out = {'thermo': [res.thermo for res in results]}
+    for name in ['tau', 'tau_lo', 'tau_hi', 'zsplit']:
+        out[name] = np.array([getattr(res, name) for res in results])
+    if thermo_only:
+        out.update(dict.fromkeys(['ell', 'TT', 'EE', 'TE', 'BB']))
     else:
-        return
+        out['ell'] = results[0].ell
+        for name in ['TT', 'EE', 'TE', 'BB']:
+            if any(getattr(res, name) is None for res in results):
+                out[name] = None
+            else:
+                out[name] = np.array([getattr(res, name) for res in results])
+    return out
+
+def get_spectra(zreio, x_e, dz=0.5, z_t=28, history=False, spectra=False, both=False, 
+                all_spectra=False, lmax=100, therm=False, zstartmax=50,
+                verbose=False, rescale=True, only_BB=False, r=0,
+                lensing='full', outputs=SPECTRA, precision=None):
+    # outputs are the spectra the caller actually uses, the rest are None.
+    # precision is one of PRECISION_PRESETS.
+    if verbose: print(compute_model.cache_info())
+    result = get_model(zreio, x_e, dz=dz, z_t=z_t, lmax=lmax,
+            zstartmax=zstartmax, rescale=rescale, r=r, lensing=lensing,
+            outputs=outputs, precision=precision,
+            thermo_only=_thermo_only(history, spectra, both, therm, only_BB))
+    return result.unpack(history=history, spectra=spectra, both=both,
+            all_spectra=all_spectra, therm=therm, only_BB=only_BB)
+
+def get_spectra_tau(tau, dz=0.5, z_t=28, history=False, spectra=False, both=False, 
+                all_spectra=False, lmax=100, therm=False, zstartmax=50,
+                rescale=True, only_BB=False, r=0, lensing='full',
+                outputs=SPECTRA, precision=None):
+    # dz, z_t and zstartmax are not used by CLASS's default tanh history.
+    result = get_model_tau(tau, lmax=lmax, rescale=rescale, r=r,
+            lensing=lensing, outputs=outputs, precision=precision,
+            thermo_only=_thermo_only(history, spectra, both, therm, only_BB))
+    return result.unpack(history=history, spectra=spectra, both=both,
+            all_spectra=all_spectra, therm=therm, only_BB=only_BB)
+
+def get_spectra_complex(zarr, x_earr, dz=0.5, history=False, spectra=False, both=False, 
+                all_spectra=False, lmax=100, therm=False, zstartmax=50,
+                rescale=True):
+    # dz and zstartmax are not used by reio_inter.
+    thermo_only = _thermo_only(history, spectra, both, therm)
+    result = compute_model('reio_inter', lmax=_compute_lmax(lmax, thermo_only),
+            rescale=rescale, thermo_only=thermo_only, zarr=zarr,
+            x_earr=x_earr).truncate(lmax)
+    return result.unpack(history=history, spectra=spectra, both=both,
+            all_spectra=all_spectra, therm=therm)
+
+def get_spectra_simple(zreio, x_e, dz=0.5, history=False, spectra=False, both=False, 
+                all_spectra=False, lmax=100, therm=False, zstartmax=50,
+                rescale=True):
+    # x_e is not used by reio_camb.
+    thermo_only = _thermo_only(history, spectra, both, therm)
+    result = compute_model('reio_camb', lmax=_compute_lmax(lmax, thermo_only),
+            rescale=rescale, thermo_only=thermo_only, zreio=zreio, dz=dz,
+            zstartmax=zstartmax).truncate(lmax)
+    return result.unpack(history=history, spectra=spectra, both=both,
+            all_spectra=all_spectra, therm=therm)
 
 def lnprob_BB_ell(zre, x_e, r, Clhat, N_l=0):
-    # This returns log(P)
-    ell, BB = get_spectra(zre, x_e,  r=r, spectra=True, lmax=len(Clhat)-1, only_BB=True)
+    # This returns log(P). r can be an array, then there's one row per r.
+    ell, BB = get_BB('many_tanh', r, lmax=len(Clhat)-1, zreio=zre, x_e=x_e)
     Cl = BB + N_l
-    chi2_ell = (2*ell[2:]+1)*(Clhat[2:]/Cl[2:] + np.log(Cl[2:]) - np.log(Clhat[2:])-1)
-    chi2_ell = np.insert(chi2_ell, [0,0], 0)
+    chi2_ell = (2*ell[2:]+1)*(Clhat[2:]/Cl[...,2:] + np.log(Cl[...,2:]) - np.log(Clhat[2:])-1)
+    chi2_ell = np.insert(chi2_ell, [0,0], 0, axis=-1)
     return -chi2_ell/2
 
 def lnprob_BB_ell_tau(tau, r, Clhat, N_l=0):
-    # This returns log(P)
-    ell, B = get_spectra_tau(tau, r=r, lmax=len(Clhat)-1, only_BB=True)
+    # This returns log(P). r can be an array, then there's one row per r.
+    ell, BB = get_BB('tau_reio', r, lmax=len(Clhat)-1, tau=tau)
     Cl = BB + N_l
-    chi2_ell = (2*ell[2:]+1)*(Clhat[2:]/Cl[2:] + np.log(Cl[2:]) - np.log(Clhat[2:])-1)
-    chi2_ell = np.insert(chi2_ell, [0,0], 0)
+    chi2_ell = (2*ell[2:]+1)*(Clhat[2:]/Cl[...,2:] + np.log(Cl[...,2:]) - np.log(Clhat[2:])-1)
+    chi2_ell = np.insert(chi2_ell, [0,0], 0, axis=-1)
     return -chi2_ell/2
 
-def lnprob_EE_ell(zre, x_e, Clhat, N_l=0):
-    # This returns log(P)
-    ell, EE, TE, TT = get_spectra(zre, x_e,  spectra=True, lmax=len(Clhat)-1, all_spectra=True)
+def lnprob_EE_ell(zre, x_e, Clhat, N_l=0, backend=None):
+    # This returns log(P). backend can be anything with a get_spectra method,
+    # e.g. an emulator.SpectraEmulator; by default the spectra come from CLASS.
+    spectra = get_spectra if backend is None else backend.get_spectra
+    ell, EE, TE, TT = spectra(zre, x_e,  spectra=True, lmax=len(Clhat)-1, all_spectra=True,
+            outputs=('EE',))
     Cl = EE + N_l
     chi2_ell = (2*ell[2:]+1)*(Clhat[2:]/Cl[2:] + np.log(Cl[2:]) - np.log(Clhat[2:])-1)
     chi2_ell = np.insert(chi2_ell, [0,0], 0)
@@ -487,7 +1201,8 @@ def lnprob_EE_ell(zre, x_e, Clhat, N_l=0):
 
 def lnprob_EE_ell_tau(tau, Clhat, N_l=0):
     # This returns log(P)
-    ell, EE, TE = get_spectra_tau(tau, lmax=len(Clhat)-1, spectra=True)
+    ell, EE, TE = get_spectra_tau(tau, lmax=len(Clhat)-1, spectra=True,
+            outputs=('EE',))
     Cl = EE + N_l
     chi2_ell = (2*ell[2:]+1)*(Clhat[2:]/Cl[2:] + np.log(Cl[2:]) - np.log(Clhat[2:])-1)
     chi2_ell = np.insert(chi2_ell, [0,0], 0)
@@ -532,7 +1247,8 @@ def test_chi2():
 
 
 def lnprob_TE_ell_tau(tau, TEhat, N_lT=0, N_lE=0):
-    ell, ee, te, tt = get_spectra_tau(tau,  spectra=True, lmax=len(TEhat)-1, all_spectra=True)
+    ell, ee, te, tt = get_spectra_tau(tau,  spectra=True, lmax=len(TEhat)-1, all_spectra=True,
+            outputs=('TT', 'EE', 'TE'))
     sigmas = np.sqrt((ee+N_lE)*(tt+N_lT))
     rho = te/sigmas
     z = (1-rho**2)*sigmas
@@ -540,8 +1256,10 @@ def lnprob_TE_ell_tau(tau, TEhat, N_lT=0, N_lE=0):
     L = VG(TEhat, N, rho*sigmas/N, sigmas*np.sqrt(1-rho**2)/N, 0)
     return np.log(L)
 
-def lnprob_TE_ell(zre, x_e, TEhat, N_lT=0, N_lE=0):
-    ell, ee, te, tt = get_spectra(zre, x_e,  spectra=True, lmax=len(TEhat)-1, all_spectra=True)
+def lnprob_TE_ell(zre, x_e, TEhat, N_lT=0, N_lE=0, backend=None):
+    spectra = get_spectra if backend is None else backend.get_spectra
+    ell, ee, te, tt = spectra(zre, x_e,  spectra=True, lmax=len(TEhat)-1, all_spectra=True,
+            outputs=('TT', 'EE', 'TE'))
     sigmas = np.sqrt((ee+N_lE)*(tt+N_lT))
     rho = te/sigmas
     z = (1-rho**2)*sigmas
@@ -549,10 +1267,12 @@ def lnprob_TE_ell(zre, x_e, TEhat, N_lT=0, N_lE=0):
     L = VG(TEhat, N, rho*sigmas/N, sigmas*np.sqrt(1-rho**2)/N, 0)
     return np.log(L)
 
-def lnprob_wish_ell(zre, x_e, Clhat, N_lT=0, N_lE=0):
+def lnprob_wish_ell(zre, x_e, Clhat, N_lT=0, N_lE=0, backend=None):
     # This returns log(P)
     TThat, EEhat, BBhat, TEhat, TBhat, EBhat = Clhat
-    ell, EE, TE, TT = get_spectra(zre, x_e,  spectra=True, lmax=len(EEhat)-1, all_spectra=True)
+    spectra = get_spectra if backend is None else backend.get_spectra
+    ell, EE, TE, TT = spectra(zre, x_e,  spectra=True, lmax=len(EEhat)-1, all_spectra=True,
+            outputs=('TT', 'EE', 'TE'))
 
     tt = TT + N_lT
     ee = EE + N_lE
@@ -580,7 +1300,8 @@ def lnprob_wish_ell(zre, x_e, Clhat, N_lT=0, N_lE=0):
 def lnprob_wish_ell_tau(tau, Clhat, N_lT=0, N_lE=0):
     # This returns log(P)
     TThat, EEhat, BBhat, TEhat, TBhat, EBhat = Clhat
-    ell, EE, TE, TT = get_spectra_tau(tau,  spectra=True, lmax=len(EEhat)-1, all_spectra=True)
+    ell, EE, TE, TT = get_spectra_tau(tau,  spectra=True, lmax=len(EEhat)-1, all_spectra=True,
+            outputs=('TT', 'EE', 'TE'))
 
     tt = TT + N_lT
     ee = EE + N_lE
@@ -605,430 +1326,271 @@ def lnprob_wish_ell_tau(tau, Clhat, N_lT=0, N_lE=0):
 
     return -chi2_ell/2
 
-def get_F_ell(zre, x_e, dzre=5e-5, dxre=1e-5, ell_arr=False, lmin=2, lmax=100,
-        N_lT=0, N_lE=0, test=False, test2=False, tau_vars=False):
-    ell = np.arange(lmax+1)
-    if type(N_lT) != np.ndarray:
-        N_lT = N_lT * np.ones_like(ell)
-    if type(N_lE) != np.ndarray:
-        N_lE = N_lE * np.ones_like(ell)
-    Fs = []
-    Fs_EE = []
+def _F_ell_derivatives(zre, x_e, dzre, dxre, lmax, tau_vars, zsplit=False):
+    # Spectra and their one-sided derivatives with respect to (zre, x_e), or
+    # (taulo, tauhi) with tau_vars, each with shape (2, lmax+1). taulo and
+    # tauhi of the shifted models are split at the fiducial model's zsplit
+    # (or at zsplit if given), like derivatives.jacobian does; with each model
+    # at its own zsplit, a step that moves it changes what taulo means.
     ell, EE, TE, TT = get_spectra(zre, x_e, lmax=lmax, spectra=True, all_spectra=True)
     ell, dEEx, dTEx, dTTx = get_spectra(zre, x_e+dxre, lmax=lmax, spectra=True, all_spectra=True)
     ell, dEEz, dTEz, dTTz = get_spectra(zre+dzre, x_e, lmax=lmax, spectra=True, all_spectra=True)
-    dEEdz = (dEEz - EE)/dzre
-    dTEdz = (dTEz - TE)/dzre
-    dTTdz = (dTTz - TT)/dzre
-    dEEdx = (dEEx - EE)/dxre
-    dTEdx = (dTEx - TE)/dxre
-    dTTdx = (dTTx - TT)/dxre
-
-    if tau_vars:
-        zsplit, taulo, tauhi = get_twotau(get_spectra(zre, x_e, therm=True))
-        zsplit, d_taulo, _tauhi = get_twotau(get_spectra(zre+dzre, x_e, therm=True))
-        zsplit, _taulo, d_tauhi = get_twotau(get_spectra(zre, x_e+dxre, therm=True))
-
-        dtaulo = d_taulo-taulo
-        dtauhi = d_tauhi-tauhi
-
-        dEEdz *= dzre/dtaulo
-        dTEdz *= dzre/dtaulo
-        dTTdz *= dzre/dtaulo
-        dEEdx *= dxre/dtauhi
-        dTEdx *= dxre/dtauhi
-        dTTdx *= dxre/dtauhi
-
-    ders = [[ [], [], [] ],
-            [ [], [], [] ]]
-    for l in np.arange(lmin, lmax+1):
-        if test:
-            ders[0][0].append(dTTdx[l])
-            ders[0][1].append(dEEdx[l])
-            ders[0][2].append(dTEdx[l])
-            ders[1][0].append(dTTdz[l])
-            ders[1][1].append(dEEdz[l])
-            ders[1][2].append(dTEdz[l])
-            return dTTdx, dEEdx, dTEdx, dTTdz, dEEdz, dTEdz
-        F = np.zeros((2,2))
-        Cl = np.array([[TT[l] + N_lT[l], TE[l]],[TE[l],EE[l] + N_lE[l]]])
-        dCldx = np.array([[dTTdx[l], dTEdx[l]], [dTEdx[l], dEEdx[l]]])
-        dCldz = np.array([[dTTdz[l], dTEdz[l]], [dTEdz[l], dEEdz[l]]])
-        Clinv = np.linalg.inv(Cl)
-        xx = np.trace(Clinv.dot(dCldx.dot(Clinv.dot(dCldx))))*(2*l+1)/2
-        xz = np.trace(Clinv.dot(dCldx.dot(Clinv.dot(dCldz))))*(2*l+1)/2
-        zz = np.trace(Clinv.dot(dCldz.dot(Clinv.dot(dCldz))))*(2*l+1)/2
-        F[0,0] += zz
-        F[1,0] += xz
-        F[0,1] += xz
-        F[1,1] += xx
-        Fs.append(F)
-
-        Cl = EE[l] + N_lE[l]
-        dCldx = dEEdx[l]
-        dCldz = dEEdz[l]
-        Clinv = 1/Cl
-        xx = Clinv*dCldx*Clinv*dCldx*(2*l+1)/2
-        xz = Clinv*dCldx*Clinv*dCldz*(2*l+1)/2
-        zz = Clinv*dCldz*Clinv*dCldz*(2*l+1)/2
-        FEE = np.array([[zz, xz],
-                        [xz, xx]])
-
-        Fs_EE.append(FEE)
-    if test2:
-        return Fs, Fs_EE, dTTdx[lmin:lmax+1], dEEdx[lmin:lmax+1],\
-    dTEdx[lmin:lmax+1], dTTdz[lmin:lmax+1], dEEdz[lmin:lmax+1],\
-    dTEdz[lmin:lmax+1]
-    return Fs
-
-def get_F_ell_forcezsplit(zre, x_e, dzre=5e-5, dxre=1e-5, ell_arr=False, lmin=2, lmax=100,
-        N_lT=0, N_lE=0, test=False, test2=False, tau_vars=True):
-    Fs = []
-    Fs_EE = []
-    ell, EE, TE, TT = get_spectra(zre, x_e, lmax=lmax, spectra=True, all_spectra=True)
-    ell, dEEx, dTEx, dTTx = get_spectra(zre, x_e+dxre, lmax=lmax, spectra=True, all_spectra=True)
-    ell, dEEz, dTEz, dTTz = get_spectra(zre+dzre, x_e, lmax=lmax, spectra=True, all_spectra=True)
-    dEEdz = (dEEz - EE)/dzre
-    dTEdz = (dTEz - TE)/dzre
-    dTTdz = (dTTz - TT)/dzre
-    dEEdx = (dEEx - EE)/dxre
-    dTEdx = (dTEx - TE)/dxre
-    dTTdx = (dTTx - TT)/dxre
+    dTT = np.array([(dTTz - TT)/dzre, (dTTx - TT)/dxre])
+    dEE = np.array([(dEEz - EE)/dzre, (dEEx - EE)/dxre])
+    dTE = np.array([(dTEz - TE)/dzre, (dTEx - TE)/dxre])
 
+    taulo, tauhi = None, None
     if tau_vars:
         zsplit, taulo, tauhi = get_twotau(get_spectra(zre, x_e, therm=True),
-                zsplit=15)
+                zsplit=zsplit)
         zsplit, d_taulo, _tauhi = get_twotau(get_spectra(zre+dzre, x_e,
-            therm=True), zsplit=15)
+            therm=True), zsplit=zsplit)
         zsplit, _taulo, d_tauhi = get_twotau(get_spectra(zre, x_e+dxre,
-            therm=True), zsplit=15)
+            therm=True), zsplit=zsplit)
 
         dtaulo = d_taulo-taulo
         dtauhi = d_tauhi-tauhi
 
-        dEEdz *= dzre/dtaulo
-        dTEdz *= dzre/dtaulo
-        dTTdz *= dzre/dtaulo
-        dEEdx *= dxre/dtauhi
-        dTEdx *= dxre/dtauhi
-        dTTdx *= dxre/dtauhi
+        jac = np.array([dzre/dtaulo, dxre/dtauhi])[:,None]
+        dTT, dEE, dTE = dTT*jac, dEE*jac, dTE*jac
+    return ell, TT, EE, TE, dTT, dEE, dTE, taulo, tauhi
 
-    ders = [[ [], [], [] ],
-            [ [], [], [] ]]
-    for l in np.arange(lmin, lmax+1):
-        F = np.zeros((2,2))
-        Cl = np.array([[TT[l] + N_lT, TE[l]],[TE[l],EE[l] + N_lE]])
-        dCldx = np.array([[dTTdx[l], dTEdx[l]], [dTEdx[l], dEEdx[l]]])
-        dCldz = np.array([[dTTdz[l], dTEdz[l]], [dTEdz[l], dEEdz[l]]])
-        Clinv = np.linalg.inv(Cl)
-        xx = np.trace(Clinv.dot(dCldx.dot(Clinv.dot(dCldx))))*(2*l+1)/2
-        xz = np.trace(Clinv.dot(dCldx.dot(Clinv.dot(dCldz))))*(2*l+1)/2
-        zz = np.trace(Clinv.dot(dCldz.dot(Clinv.dot(dCldz))))*(2*l+1)/2
-        F[0,0] += zz
-        F[1,0] += xz
-        F[0,1] += xz
-        F[1,1] += xx
-        Fs.append(F)
+def test_F_ell_zsplit(zre=7, x_e=0.05, dzre=0.5, dxre=1e-5, lmax=30):
+    '''
+    Checks that the taulo derivative of _F_ell_derivatives keeps the
+    fiducial zsplit for a zre step large enough to move it.
+    '''
+    thermo = get_spectra(zre, x_e, therm=True)
+    shifted = get_spectra(zre+dzre, x_e, therm=True)
+    zsplit, taulo, tauhi = get_twotau(thermo)
+    assert get_twotau(shifted)[0] != zsplit, 'dzre does not move zsplit'
+    dtaulo = get_twotau(shifted, zsplit=zsplit)[1] - taulo
+    dtaulo_own = get_twotau(shifted)[1] - taulo
+    dEE = _F_ell_derivatives(zre, x_e, dzre, dxre, lmax, False)[5]
+    dEE_tau = _F_ell_derivatives(zre, x_e, dzre, dxre, lmax, True)[5]
+    l = slice(2, lmax+1)
+    jac = dEE_tau[0,l]/dEE[0,l]
+    err = np.max(abs(jac*dtaulo/dzre - 1))
+    print('zsplit {0:.3f} -> {1:.3f}: dtaulo/dzre {2:.4e} at the fiducial '
+            'zsplit, {3:.4e} at its own, difference from '
+            '_F_ell_derivatives {4:.1e}'.format(zsplit,
+                get_twotau(shifted)[0], dtaulo/dzre, dtaulo_own/dzre, err))
+    assert err < 1e-12
+    return
 
-        Cl = EE[l] + N_lE
-        dCldx = dEEdx[l]
-        dCldz = dEEdz[l]
-        Clinv = 1/Cl
-        xx = Clinv*dCldx*Clinv*dCldx*(2*l+1)/2
-        xz = Clinv*dCldx*Clinv*dCldz*(2*l+1)/2
-        zz = Clinv*dCldz*Clinv*dCldz*(2*l+1)/2
-        FEE = np.array([[zz, xz],
-                        [xz, xx]])
-
-        Fs_EE.append(FEE)
-    dTEdx[lmin:lmax+1], dTTdz[lmin:lmax+1], dEEdz[lmin:lmax+1],\
-    dTEdz[lmin:lmax+1]
-    return Fs, taulo, tauhi
+def _N_ell(N_l, lmin, lmax):
+    # N_l is a number, or an array whose last axis is either indexed by ell
+    # (at least lmax+1 long) or has length 1 for white noise. Leading axes are
+    # a stack of noise configurations, so a stack of white noise levels has
+    # shape (n, 1); a 1d array of levels would be taken as indexed by ell.
+    if np.ndim(N_l) == 0:
+        return N_l
+    N_l = np.asarray(N_l)
+    if N_l.shape[-1] == 1:
+        return N_l
+    if N_l.shape[-1] < lmax + 1:
+        raise ValueError('The last axis of the noise, of length {0}, has to be '
+                'indexed by ell up to lmax = {1}, or have length 1 for white '
+                'noise levels, e.g. N_l[:, None]'.format(N_l.shape[-1], lmax))
+    return N_l[..., lmin:lmax+1]
+
+def _get_F_ell(zre, x_e, dzre, dxre, lmin, lmax, N_lT, N_lE, test, test2,
+        tau_vars, mask=None, TE_cov=True, zsplit=False):
+    # The get_F_ell* functions below, which only differ in the mask
+    ell, TT, EE, TE, dTT, dEE, dTE, taulo, tauhi = _F_ell_derivatives(zre,
+            x_e, dzre, dxre, lmax, tau_vars, zsplit=zsplit)
+    if test:
+        return dTT[1], dEE[1], dTE[1], dTT[0], dEE[0], dTE[0]
+    l = slice(lmin, lmax+1)
+    N_lT, N_lE = _N_ell(N_lT, lmin, lmax), _N_ell(N_lE, lmin, lmax)
+    # one [[zz, xz], [xz, xx]] matrix per ell
+    Fs = fisher.fisher_TE(ell[l], TT[l], EE[l], TE[l], dTT[:,l], dEE[:,l],
+            dTE[:,l], N_lT=N_lT, N_lE=N_lE, mask=mask, TE_cov=TE_cov)
+    Fs_EE = fisher.fisher_EE(ell[l], EE[l], dEE[:,l], N_lE=N_lE)
+    return list(Fs), list(Fs_EE), (dTT, dEE, dTE), (taulo, tauhi)
 
-def get_F_ell_2(zre, x_e, dzre=5e-5, dxre=1e-5, ell_arr=False, lmin=2, lmax=100,
+def get_F_ell(zre, x_e, dzre=5e-5, dxre=1e-5, ell_arr=False, lmin=2, lmax=100,
         N_lT=0, N_lE=0, test=False, test2=False, tau_vars=False):
-    Fs = []
-    Fs_EE = []
-    ell, EE, TE, TT = get_spectra(zre, x_e, lmax=lmax, spectra=True, all_spectra=True)
-    ell, dEEx, dTEx, dTTx = get_spectra(zre, x_e+dxre, lmax=lmax, spectra=True, all_spectra=True)
-    ell, dEEz, dTEz, dTTz = get_spectra(zre+dzre, x_e, lmax=lmax, spectra=True, all_spectra=True)
-    dEEdz = (dEEz - EE)/dzre
-    dTEdz = (dTEz - TE)/dzre
-    dTTdz = (dTTz - TT)/dzre
-    dEEdx = (dEEx - EE)/dxre
-    dTEdx = (dTEx - TE)/dxre
-    dTTdx = (dTTx - TT)/dxre
-
-    if tau_vars:
-        zsplit, taulo, tauhi = get_twotau(get_spectra(zre, x_e, therm=True))
-        zsplit, d_taulo, _tauhi = get_twotau(get_spectra(zre+dzre, x_e, therm=True))
-        zsplit, _taulo, d_tauhi = get_twotau(get_spectra(zre, x_e+dxre, therm=True))
-
-        dtaulo = d_taulo-taulo
-        dtauhi = d_tauhi-tauhi
-
-        dEEdz *= dzre/dtaulo
-        dTEdz *= dzre/dtaulo
-        dTTdz *= dzre/dtaulo
-        dEEdx *= dxre/dtauhi
-        dTEdx *= dxre/dtauhi
-        dTTdx *= dxre/dtauhi
+    out = _get_F_ell(zre, x_e, dzre, dxre, lmin, lmax, N_lT, N_lE, test,
+            test2, tau_vars)
+    if test:
+        return out
+    Fs, Fs_EE, (dTT, dEE, dTE), _ = out
+    if test2:
+        return Fs, Fs_EE, dTT[1,lmin:lmax+1], dEE[1,lmin:lmax+1],\
+    dTE[1,lmin:lmax+1], dTT[0,lmin:lmax+1], dEE[0,lmin:lmax+1],\
+    dTE[0,lmin:lmax+1]
+    return Fs
 
-    ders = [[ [], [], [] ],
-            [ [], [], [] ]]
-    for l in np.arange(lmin, lmax+1):
-        if test:
-            ders[0][0].append(dTTdx[l])
-            ders[0][1].append(dEEdx[l])
-            ders[0][2].append(dTEdx[l])
-            ders[1][0].append(dTTdz[l])
-            ders[1][1].append(dEEdz[l])
-            ders[1][2].append(dTEdz[l])
-            return dTTdx, dEEdx, dTEdx, dTTdz, dEEdz, dTEdz
-        F = np.zeros((2,2))
-        Cl = np.array([[TT[l] + N_lT, 0*TE[l]],[0*TE[l],EE[l] + N_lE]])
-        dCldx = np.array([[dTTdx[l], 0*dTEdx[l]], [0*dTEdx[l], dEEdx[l]]])
-        dCldz = np.array([[dTTdz[l], 0*dTEdz[l]], [0*dTEdz[l], dEEdz[l]]])
-        Clinv = np.linalg.inv(Cl)
-        xx = np.trace(Clinv.dot(dCldx.dot(Clinv.dot(dCldx))))*(2*l+1)/2
-        xz = np.trace(Clinv.dot(dCldx.dot(Clinv.dot(dCldz))))*(2*l+1)/2
-        zz = np.trace(Clinv.dot(dCldz.dot(Clinv.dot(dCldz))))*(2*l+1)/2
-        F[0,0] += zz
-        F[1,0] += xz
-        F[0,1] += xz
-        F[1,1] += xx
-        Fs.append(F)
+def get_F_ell_forcezsplit(zre, x_e, dzre=5e-5, dxre=1e-5, ell_arr=False, lmin=2, lmax=100,
+        N_lT=0, N_lE=0, test=False, test2=False, tau_vars=True):
+    Fs, Fs_EE, ders, (taulo, tauhi) = _get_F_ell(zre, x_e, dzre, dxre, lmin,
+            lmax, N_lT, N_lE, False, test2, tau_vars, zsplit=15)
+    return Fs, taulo, tauhi
 
-        Cl = EE[l] + N_lE
-        dCldx = dEEdx[l]
-        dCldz = dEEdz[l]
-        Clinv = 1/Cl
-        xx = Clinv*dCldx*Clinv*dCldx*(2*l+1)/2
-        xz = Clinv*dCldx*Clinv*dCldz*(2*l+1)/2
-        zz = Clinv*dCldz*Clinv*dCldz*(2*l+1)/2
-        FEE = np.array([[zz, xz],
-                        [xz, xx]])
-
-        Fs_EE.append(FEE)
+def _get_F_ell_masked(zre, x_e, dzre, dxre, lmin, lmax, N_lT, N_lE, test,
+        test2, tau_vars, mask=None, TE_cov=True):
+    out = _get_F_ell(zre, x_e, dzre, dxre, lmin, lmax, N_lT, N_lE, test,
+            test2, tau_vars, mask=mask, TE_cov=TE_cov)
+    if test:
+        return out
+    Fs, Fs_EE, (dTT, dEE, dTE), _ = out
     if test2:
-        return Fs, Fs_EE, dTTdx, dEEdx, dTEdx, dTTdz, dEEdz, dTEdz
+        return Fs, Fs_EE, dTT[1], dEE[1], dTE[1], dTT[0], dEE[0], dTE[0]
     return Fs
 
+def get_F_ell_2(zre, x_e, dzre=5e-5, dxre=1e-5, ell_arr=False, lmin=2, lmax=100,
+        N_lT=0, N_lE=0, test=False, test2=False, tau_vars=False):
+    '''
+    Sets the TE correlation, and its derivative, equal to zero.
+    '''
+    return _get_F_ell_masked(zre, x_e, dzre, dxre, lmin, lmax, N_lT, N_lE,
+            test, test2, tau_vars, TE_cov=False)
+
 def get_F_ell_3(zre, x_e, dzre=5e-5, dxre=1e-5, ell_arr=False, lmin=2, lmax=100,
         N_lT=0, N_lE=0, test=False, test2=False, tau_vars=False):
     '''
     Sets the derivative of T and E with respect to tau equal to zero.
     '''
-    Fs = []
-    Fs_EE = []
-    ell, EE, TE, TT = get_spectra(zre, x_e, lmax=lmax, spectra=True, all_spectra=True)
-    ell, dEEx, dTEx, dTTx = get_spectra(zre, x_e+dxre, lmax=lmax, spectra=True, all_spectra=True)
-    ell, dEEz, dTEz, dTTz = get_spectra(zre+dzre, x_e, lmax=lmax, spectra=True, all_spectra=True)
-    dEEdz = (dEEz - EE)/dzre
-    dTEdz = (dTEz - TE)/dzre
-    dTTdz = (dTTz - TT)/dzre
-    dEEdx = (dEEx - EE)/dxre
-    dTEdx = (dTEx - TE)/dxre
-    dTTdx = (dTTx - TT)/dxre
-
-    if tau_vars:
-        zsplit, taulo, tauhi = get_twotau(get_spectra(zre, x_e, therm=True))
-        zsplit, d_taulo, _tauhi = get_twotau(get_spectra(zre+dzre, x_e, therm=True))
-        zsplit, _taulo, d_tauhi = get_twotau(get_spectra(zre, x_e+dxre, therm=True))
-
-        dtaulo = d_taulo-taulo
-        dtauhi = d_tauhi-tauhi
-
-        dEEdz *= dzre/dtaulo
-        dTEdz *= dzre/dtaulo
-        dTTdz *= dzre/dtaulo
-        dEEdx *= dxre/dtauhi
-        dTEdx *= dxre/dtauhi
-        dTTdx *= dxre/dtauhi
-
-    ders = [[ [], [], [] ],
-            [ [], [], [] ]]
-    for l in np.arange(lmin, lmax+1):
-        if test:
-            ders[0][0].append(dTTdx[l])
-            ders[0][1].append(dEEdx[l])
-            ders[0][2].append(dTEdx[l])
-            ders[1][0].append(dTTdz[l])
-            ders[1][1].append(dEEdz[l])
-            ders[1][2].append(dTEdz[l])
-            return dTTdx, dEEdx, dTEdx, dTTdz, dEEdz, dTEdz
-        F = np.zeros((2,2))
-        Cl = np.array([[TT[l] + N_lT, TE[l]],[TE[l],EE[l] + N_lE]])
-        dCldx = np.array([[0*dTTdx[l], dTEdx[l]], [dTEdx[l], 0*dEEdx[l]]])
-        dCldz = np.array([[0*dTTdz[l], dTEdz[l]], [dTEdz[l], 0*dEEdz[l]]])
-        Clinv = np.linalg.inv(Cl)
-        xx = np.trace(Clinv.dot(dCldx.dot(Clinv.dot(dCldx))))*(2*l+1)/2
-        xz = np.trace(Clinv.dot(dCldx.dot(Clinv.dot(dCldz))))*(2*l+1)/2
-        zz = np.trace(Clinv.dot(dCldz.dot(Clinv.dot(dCldz))))*(2*l+1)/2
-        F[0,0] += zz
-        F[1,0] += xz
-        F[0,1] += xz
-        F[1,1] += xx
-        Fs.append(F)
-
-        Cl = EE[l] + N_lE
-        dCldx = dEEdx[l]
-        dCldz = dEEdz[l]
-        Clinv = 1/Cl
-        xx = Clinv*dCldx*Clinv*dCldx*(2*l+1)/2
-        xz = Clinv*dCldx*Clinv*dCldz*(2*l+1)/2
-        zz = Clinv*dCldz*Clinv*dCldz*(2*l+1)/2
-        FEE = np.array([[zz, xz],
-                        [xz, xx]])
-
-        Fs_EE.append(FEE)
-    if test2:
-        return Fs, Fs_EE, dTTdx, dEEdx, dTEdx, dTTdz, dEEdz, dTEdz
-    return Fs
+    return _get_F_ell_masked(zre, x_e, dzre, dxre, lmin, lmax, N_lT, N_lE,
+            test, test2, tau_vars, mask={'TT': 0, 'EE': 0})
 
 def get_F_ell_4(zre, x_e, dzre=5e-5, dxre=1e-5, ell_arr=False, lmin=2, lmax=100,
         N_lT=0, N_lE=0, test=False, test2=False, tau_vars=False):
     '''
     Sets the derivative of E with respect to tau equal to zero.
     '''
-    Fs = []
-    Fs_EE = []
-    ell, EE, TE, TT = get_spectra(zre, x_e, lmax=lmax, spectra=True, all_spectra=True)
-    ell, dEEx, dTEx, dTTx = get_spectra(zre, x_e+dxre, lmax=lmax, spectra=True, all_spectra=True)
-    ell, dEEz, dTEz, dTTz = get_spectra(zre+dzre, x_e, lmax=lmax, spectra=True, all_spectra=True)
-    dEEdz = (dEEz - EE)/dzre
-    dTEdz = (dTEz - TE)/dzre
-    dTTdz = (dTTz - TT)/dzre
-    dEEdx = (dEEx - EE)/dxre
-    dTEdx = (dTEx - TE)/dxre
-    dTTdx = (dTTx - TT)/dxre
-
-    if tau_vars:
-        zsplit, taulo, tauhi = get_twotau(get_spectra(zre, x_e, therm=True))
-        zsplit, d_taulo, _tauhi = get_twotau(get_spectra(zre+dzre, x_e, therm=True))
-        zsplit, _taulo, d_tauhi = get_twotau(get_spectra(zre, x_e+dxre, therm=True))
-
-        dtaulo = d_taulo-taulo
-        dtauhi = d_tauhi-tauhi
-
-        dEEdz *= dzre/dtaulo
-        dTEdz *= dzre/dtaulo
-        dTTdz *= dzre/dtaulo
-        dEEdx *= dxre/dtauhi
-        dTEdx *= dxre/dtauhi
-        dTTdx *= dxre/dtauhi
-
-    ders = [[ [], [], [] ],
-            [ [], [], [] ]]
-    for l in np.arange(lmin, lmax+1):
-        if test:
-            ders[0][0].append(dTTdx[l])
-            ders[0][1].append(dEEdx[l])
-            ders[0][2].append(dTEdx[l])
-            ders[1][0].append(dTTdz[l])
-            ders[1][1].append(dEEdz[l])
-            ders[1][2].append(dTEdz[l])
-            return dTTdx, dEEdx, dTEdx, dTTdz, dEEdz, dTEdz
-        F = np.zeros((2,2))
-        Cl = np.array([[TT[l] + N_lT, TE[l]],[TE[l],EE[l] + N_lE]])
-        dCldx = np.array([[dTTdx[l], dTEdx[l]], [dTEdx[l], 0*dEEdx[l]]])
-        dCldz = np.array([[dTTdz[l], dTEdz[l]], [dTEdz[l], 0*dEEdz[l]]])
-        Clinv = np.linalg.inv(Cl)
-        xx = np.trace(Clinv.dot(dCldx.dot(Clinv.dot(dCldx))))*(2*l+1)/2
-        xz = np.trace(Clinv.dot(dCldx.dot(Clinv.dot(dCldz))))*(2*l+1)/2
-        zz = np.trace(Clinv.dot(dCldz.dot(Clinv.dot(dCldz))))*(2*l+1)/2
-        F[0,0] += zz
-        F[1,0] += xz
-        F[0,1] += xz
-        F[1,1] += xx
-        Fs.append(F)
-
-        Cl = EE[l] + N_lE
-        dCldx = dEEdx[l]
-        dCldz = dEEdz[l]
-        Clinv = 1/Cl
-        xx = Clinv*dCldx*Clinv*dCldx*(2*l+1)/2
-        xz = Clinv*dCldx*Clinv*dCldz*(2*l+1)/2
-        zz = Clinv*dCldz*Clinv*dCldz*(2*l+1)/2
-        FEE = np.array([[zz, xz],
-                        [xz, xx]])
-
-        Fs_EE.append(FEE)
-    if test2:
-        return Fs, Fs_EE, dTTdx, dEEdx, dTEdx, dTTdz, dEEdz, dTEdz
-    return Fs
+    return _get_F_ell_masked(zre, x_e, dzre, dxre, lmin, lmax, N_lT, N_lE,
+            test, test2, tau_vars, mask={'EE': 0})
 
 def get_F_ell_5(zre, x_e, dzre=5e-5, dxre=1e-5, ell_arr=False, lmin=2, lmax=100,
         N_lT=0, N_lE=0, test=False, test2=False, tau_vars=False):
     '''
     Sets the derivative of T with respect to tau equal to zero.
     '''
-    Fs = []
-    Fs_EE = []
-    ell, EE, TE, TT = get_spectra(zre, x_e, lmax=lmax, spectra=True, all_spectra=True)
-    ell, dEEx, dTEx, dTTx = get_spectra(zre, x_e+dxre, lmax=lmax, spectra=True, all_spectra=True)
-    ell, dEEz, dTEz, dTTz = get_spectra(zre+dzre, x_e, lmax=lmax, spectra=True, all_spectra=True)
-    dEEdz = (dEEz - EE)/dzre
-    dTEdz = (dTEz - TE)/dzre
-    dTTdz = (dTTz - TT)/dzre
-    dEEdx = (dEEx - EE)/dxre
-    dTEdx = (dTEx - TE)/dxre
-    dTTdx = (dTTx - TT)/dxre
-
-    if tau_vars:
-        zsplit, taulo, tauhi = get_twotau(get_spectra(zre, x_e, therm=True))
-        zsplit, d_taulo, _tauhi = get_twotau(get_spectra(zre+dzre, x_e, therm=True))
-        zsplit, _taulo, d_tauhi = get_twotau(get_spectra(zre, x_e+dxre, therm=True))
+    return _get_F_ell_masked(zre, x_e, dzre, dxre, lmin, lmax, N_lT, N_lE,
+            test, test2, tau_vars, mask={'TT': 0})
 
-        dtaulo = d_taulo-taulo
-        dtauhi = d_tauhi-tauhi
-
-        dEEdz *= dzre/dtaulo
-        dTEdz *= dzre/dtaulo
-        dTTdz *= dzre/dtaulo
-        dEEdx *= dxre/dtauhi
-        dTEdx *= dxre/dtauhi
-        dTTdx *= dxre/dtauhi
-
-    ders = [[ [], [], [] ],
-            [ [], [], [] ]]
-    for l in np.arange(lmin, lmax+1):
-        if test:
-            ders[0][0].append(dTTdx[l])
-            ders[0][1].append(dEEdx[l])
-            ders[0][2].append(dTEdx[l])
-            ders[1][0].append(dTTdz[l])
-            ders[1][1].append(dEEdz[l])
-            ders[1][2].append(dTEdz[l])
-            return dTTdx, dEEdx, dTEdx, dTTdz, dEEdz, dTEdz
-        F = np.zeros((2,2))
-        Cl = np.array([[TT[l] + N_lT, TE[l]],[TE[l],EE[l] + N_lE]])
-        dCldx = np.array([[0*dTTdx[l], dTEdx[l]], [dTEdx[l], dEEdx[l]]])
-        dCldz = np.array([[0*dTTdz[l], dTEdz[l]], [dTEdz[l], dEEdz[l]]])
-        Clinv = np.linalg.inv(Cl)
-        xx = np.trace(Clinv.dot(dCldx.dot(Clinv.dot(dCldx))))*(2*l+1)/2
-        xz = np.trace(Clinv.dot(dCldx.dot(Clinv.dot(dCldz))))*(2*l+1)/2
-        zz = np.trace(Clinv.dot(dCldz.dot(Clinv.dot(dCldz))))*(2*l+1)/2
-        F[0,0] += zz
-        F[1,0] += xz
-        F[0,1] += xz
-        F[1,1] += xx
-        Fs.append(F)
+def get_F_result(zre, x_e, N_lT=0, N_lE=0, dzre=5e-5, dxre=1e-5, lmin=2,
+        lmax=100, tau_vars=True, mask=None, TE_cov=True):
+    '''
+    fisher.FisherResult with the Fisher matrix of every lmin <= ell <= lmax,
+    for one noise configuration or a whole stack of them. N_lT and N_lE
+    broadcast against each other: each is a number, an N_ell array indexed
+    by ell (at least lmax+1 long), or a stack of either with leading axes,
+    e.g. fisher.white_noise(w_p, np.arange(lmax+1), fwhm) for an array of
+    depths w_p and beams fwhm. A stack of numbers needs a last axis of
+    length 1, e.g. N_lE=np.array([1e-5, 1e-4])[:, None]; anything else
+    raises a ValueError. The parameters are (taulo, tauhi), or (zre, x_e)
+    without tau_vars. result.F(lmin, lmax) and result.sigma(lmin, lmax) then
+    give any smaller multipole range without recomputing anything.
+    '''
+    ell, TT, EE, TE, dTT, dEE, dTE, _, _ = _F_ell_derivatives(zre, x_e, dzre,
+            dxre, lmax, tau_vars)
+    l = slice(lmin, lmax+1)
+    F = fisher.fisher_TE(ell[l], TT[l], EE[l], TE[l], dTT[:,l], dEE[:,l],
+            dTE[:,l], N_lT=_N_ell(N_lT, lmin, lmax),
+            N_lE=_N_ell(N_lE, lmin, lmax), mask=mask, TE_cov=TE_cov)
+    params = ['taulo', 'tauhi'] if tau_vars else ['zre', 'x_e']
+    return fisher.FisherResult(ell[l], F, params=params)
+
+def get_F_noise(zre, x_e, N_lT=0, N_lE=0, dzre=5e-5, dxre=1e-5, lmin=2,
+        lmax=100, tau_vars=True, mask=None, TE_cov=True):
+    '''
+    Fisher matrices summed over lmin <= ell <= lmax for a stack of noise
+    configurations, shape (..., 2, 2), and the marginalized uncertainties,
+    shape (..., 2); the arguments are as in get_F_result.
+    '''
+    result = get_F_result(zre, x_e, N_lT=N_lT, N_lE=N_lE, dzre=dzre,
+            dxre=dxre, lmin=lmin, lmax=lmax, tau_vars=tau_vars, mask=mask,
+            TE_cov=TE_cov)
+    F = result.F()
+    return F, fisher.marginal_sigma(F)
+
+def get_F_forecast(model='many_tanh', fiducial=None, params=None,
+        reparam=None, N_lT=0, N_lE=0, N_lB=None, lmin=2, lmax=100,
+        outputs=('TT', 'EE', 'TE'), mask=None, TE_cov=True, **kwargs):
+    '''
+    fisher.FisherResult for any parameters of model (and r, A_s, n_s) at the
+    fiducial parameters, e.g.
+
+        get_F_forecast('many_tanh', dict(zreio=7, x_e=0.05, dz=0.5, z_t=28,
+            A_s=2.1e-9, n_s=0.965), rescale=False)
+
+    for all six. The derivatives come from derivatives.jacobian, which runs
+    every CLASS model they need as one parallel batch and keeps them on disk;
+    kwargs (steps, n_steps, rescale, r, precision, workers, ...) go to it.
+
+    outputs are the spectra used: TT, EE and TE together, or EE alone, plus
+    BB (needs r in fiducial) with noise N_lB, by default N_lE. The noise is as
+    in get_F_result. reparam gives the Fisher matrix of other parameters: a
+    list with an entry per parameter, either one of params or one of
+    derivatives.DERIVED (e.g. ['tau_lo', 'tau_hi'] for zreio, x_e), or a
+    matrix of dq_i/dp_j.
+    '''
+    from derivatives import jacobian
+    outputs = _outputs(outputs)
+    J = jacobian(model, fiducial, params, lmax=lmax, outputs=outputs,
+            **kwargs)
+    params = J['params']
+    l = slice(lmin, lmax+1)
+    ell = J['ell'][l]
+    N_lT, N_lE = _N_ell(N_lT, lmin, lmax), _N_ell(N_lE, lmin, lmax)
+    if {'TT', 'EE', 'TE'} <= set(outputs):
+        F = fisher.fisher_TE(ell, J['TT'][l], J['EE'][l], J['TE'][l],
+                J['dTT'][:,l], J['dEE'][:,l], J['dTE'][:,l], N_lT=N_lT,
+                N_lE=N_lE, mask=mask, TE_cov=TE_cov)
+    elif 'EE' in outputs:
+        F = fisher.fisher_EE(ell, J['EE'][l], J['dEE'][:,l], N_lE=N_lE)
+    else:
+        raise ValueError('outputs have to include TT, EE and TE, or EE, got '
+                '{0}'.format(outputs))
+    if 'BB' in outputs:
+        N_lB = N_lE if N_lB is None else _N_ell(N_lB, lmin, lmax)
+        # B is uncorrelated with T and E
+        F = F + fisher.fisher_EE(ell, J['BB'][l], J['dBB'][:,l], N_lE=N_lB)
+
+    if reparam is not None:
+        if all(isinstance(q, str) for q in reparam):
+            dq_dp = []
+            for q in reparam:
+                if q in params:
+                    dq_dp.append(np.eye(len(params))[params.index(q)])
+                elif ('d' + q) in J and np.ndim(J[q]) == 0:
+                    dq_dp.append(J['d' + q])
+                else:
+                    raise ValueError('{0} is neither one of {1} nor a derived '
+                            'parameter'.format(q, params))
+            params = list(reparam)
+        else:
+            dq_dp = reparam
+            params = None
+        F = fisher.reparameterize(F, np.array(dq_dp))
+    return fisher.FisherResult(ell, F, params=params)
 
-        Cl = EE[l] + N_lE
-        dCldx = dEEdx[l]
-        dCldz = dEEdz[l]
-        Clinv = 1/Cl
-        xx = Clinv*dCldx*Clinv*dCldx*(2*l+1)/2
-        xz = Clinv*dCldx*Clinv*dCldz*(2*l+1)/2
-        zz = Clinv*dCldz*Clinv*dCldz*(2*l+1)/2
-        FEE = np.array([[zz, xz],
-                        [xz, xx]])
-
-        Fs_EE.append(FEE)
-    if test2:
-        return Fs, Fs_EE, dTTdx, dEEdx, dTEdx, dTTdz, dEEdz, dTEdz
-    return Fs
+def test_F_forecast(zre=7, x_e=0.05, lmax=30):
+    '''
+    Compares get_F_forecast to get_F_ell for (zreio, x_e) and, keeping only
+    dtau_lo/dzreio and dtau_hi/dx_e of the Jacobian as get_F_ell does, for
+    (tau_lo, tau_hi). The full Jacobian's errors are printed as well.
+    '''
+    from derivatives import jacobian
+    fiducial = {'zreio': zre, 'x_e': x_e}
+    result = get_F_forecast('many_tanh', fiducial, lmax=lmax)
+    J = jacobian('many_tanh', fiducial, lmax=lmax)
+    dq_dp = np.diag([J['dtau_lo'][0], J['dtau_hi'][1]])
+    sigma_diag = fisher.marginal_sigma(fisher.reparameterize(result.F(),
+        dq_dp))
+    sigma_full = get_F_forecast('many_tanh', fiducial, lmax=lmax,
+            reparam=['tau_lo', 'tau_hi']).sigma()
+    for sigma, tau_vars in [(result.sigma(), False), (sigma_diag, True)]:
+        sigma_ell = fisher.marginal_sigma(np.sum(get_F_ell(zre, x_e,
+            lmax=lmax, tau_vars=tau_vars), axis=0))
+        print('tau_vars={0}: get_F_forecast {1}, get_F_ell {2}, largest '
+                'fractional difference {3:.1e}'.format(tau_vars, sigma,
+                    sigma_ell, np.max(abs(sigma/sigma_ell - 1))))
+    print('(tau_lo, tau_hi) with the full Jacobian: {0}'.format(sigma_full))
+    return
 
 def get_F_ell_3_tau(tau, dtau=1e-4, ell_arr=False, lmin=2, lmax=100,
         N_lT=0, N_lE=0, test=False, test2=False, tau_vars=False, TT_fac=0,
@@ -1097,25 +1659,18 @@ def get_F_ell_3_tau(tau, dtau=1e-4, ell_arr=False, lmin=2, lmax=100,
 def get_F_ell_tau(tau, dtau=1e-4, ell_arr=False, lmin=2, lmax=100,
         N_lT=0, N_lE=0, test=False, test2=False, tau_vars=False,
         TT_fac=1, TE_fac=1, EE_fac=1):
-    Fs = []
-    Fs_EE = []
     ell, EE, TE, TT = get_spectra_tau(tau, lmax=lmax, spectra=True, all_spectra=True)
     ell, dEEx, dTEx, dTTx = get_spectra_tau(tau+dtau, lmax=lmax, spectra=True, all_spectra=True)
     dEEdx = (dEEx - EE)/dtau
     dTEdx = (dTEx - TE)/dtau
     dTTdx = (dTTx - TT)/dtau
 
-    for l in np.arange(lmin, lmax+1):
-        F = 0
-        Cl = np.array([[TT[l] + N_lT, TE[l]],[TE[l],EE[l] + N_lE]])
-        dCldx = np.array([[TT_fac*dTTdx[l], TE_fac*dTEdx[l]], 
-                          [TE_fac*dTEdx[l], EE_fac*dEEdx[l]]])
-        Clinv = np.linalg.inv(Cl)
-        xx = np.trace(Clinv.dot(dCldx.dot(Clinv.dot(dCldx))))*(2*l+1)/2
-        F += xx
-        Fs.append(F)
-
-    return Fs
+    l = slice(lmin, lmax+1)
+    F = fisher.fisher_TE(ell[l], TT[l], EE[l], TE[l], dTTdx[None,l],
+            dEEdx[None,l], dTEdx[None,l], N_lT=_N_ell(N_lT, lmin, lmax),
+            N_lE=_N_ell(N_lE, lmin, lmax),
+            mask={'TT': TT_fac, 'TE': TE_fac, 'EE': EE_fac})
+    return list(F[:,0,0])
 
 from classtools.users.djw.tools import (med_subtract, spice_wrap, bin_spectra,
         bin_noisy_spectra, twinx_whitenoise, read_classmap,